@@ -0,0 +1,356 @@
+# cosmo-analyze : batch analysis of many ships, for offline jobs like the leaderboard
+# usage : python batch.py ships/ "more/*.ship.png" urls.txt -o results.jsonl [--jobs 8] [--render renders/]
+# inputs are directories (searched for *.png), globs, png files, urls, or .txt files with one path or url per line
+# a thread pool fetches the pngs while a process pool decodes and analyzes them, rows are written as they finish
+# the output is JSONL, CSV or Parquet (needs pyarrow), picked from --format or the extension of the output
+# an interrupted run is resumed by running the same command again, sources already analyzed in the output are skipped,
+# the sources with an error are tried again and get a new row, remove the output to start over,
+# --library also stores every analysis in the ship library
+# pip install . puts the cosmo-analyze command on the path
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import ship_library
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DIRECTIONS = ["NW", "N", "NE", "E", "SE", "S", "SW", "W"]
+# columns of the flat formats, the speeds are split into one column per direction
+COLUMNS = ["source", "name", "parts", "author", "center_of_mass_x", "center_of_mass_y", "total_mass", "top_speed",
+           "crew", "price", "tags"] + [f"speed_{direction}" for direction in DIRECTIONS] + ["sections", "crew_average", "crew_worst", "url_com", "error"]
+PARQUET_ROWS = 1000 # rows per parquet part file
+PROGRESS_EVERY = 100
+
+def expand_inputs(inputs):
+    """
+    Turn the command line inputs into a list of ship sources.
+
+    Args:
+        inputs (list): Directories, globs, png files, urls or .txt files listing any of those.
+
+    Returns:
+        list: The paths and urls of the ships, without duplicates, in the order they were given.
+    """
+    sources = []
+    for item in inputs:
+        if item.startswith("http://") or item.startswith("https://"):
+            sources.append(item)
+        elif os.path.isdir(item):
+            for directory, _, filenames in sorted(os.walk(item)):
+                sources += [os.path.join(directory, filename) for filename in sorted(filenames) if filename.lower().endswith(".png")]
+        elif item.endswith(".txt") and os.path.isfile(item):
+            with open(item) as f:
+                lines = [line.strip() for line in f]
+            sources += expand_inputs([line for line in lines if line and not line.startswith("#")])
+        elif os.path.isfile(item):
+            sources.append(item)
+        else:
+            sources += sorted(glob.glob(item, recursive=True))
+    return list(dict.fromkeys(sources))
+
+def fetch(source, timeout):
+    """
+    Read the png bytes of a ship from a file or a url.
+    """
+    if source.startswith("http://") or source.startswith("https://"):
+        import requests
+        response = requests.get(source, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+    with open(source, "rb") as f:
+        return f.read()
+
+def render_path(render_dir, source, extension):
+    """
+    File name of the drawing of a ship, unique per source.
+    """
+    stem = os.path.basename(source.rstrip("/")).split(".")[0] or "ship"
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(render_dir, f"{stem}-{digest}.{extension}")
+
+def init_worker():
+    # sprite paths are relative to the repository
+    os.chdir(ROOT)
+
+def analyze_source(source, png_data, args, render_dir, library):
+    """
+    Decode and analyze one ship, runs in a worker process.
+
+    Args:
+        source (str): The path or url of the ship, stored in the row.
+        png_data (bytes): The png of the ship.
+        args (dict): The arguments of analyze_ship.
+        render_dir (str): Where the drawings are written when args["draw"] is set.
+        library (bool): Also return the entry of the ship for the ship library.
+
+    Returns:
+        tuple: A row with the analysis of the ship, or with the error that stopped it, and the library entry or None.
+    """
+    import base64
+    import cosmoteer_save_tools
+    from center_of_mass import analyze_ship
+
+    def save_render(base64_output):
+        path = render_path(render_dir, source, "png")
+        with open(path, "wb") as f:
+            f.write(base64.b64decode(base64_output))
+        return path
+
+    try:
+        ship = cosmoteer_save_tools.Ship(png_data)
+        structure = ship_library.structure_key(ship) if library else None
+        data = analyze_ship(ship, args, upload=save_render, variants_kept=library)
+        if "svg" in data:
+            path = render_path(render_dir, source, "svg")
+            with open(path, "w") as f:
+                f.write(data.pop("svg"))
+            data["url_com"] = path
+        entry = None
+        if library:
+            entry = ship_library.record(ship, data, structure)
+            data = ship_library.with_boost(data, args["boost"])
+        return {"source": source, "name": ship.data.get("Name"), "parts": len(ship.data["Parts"]), **data, "error": None}, entry
+    except Exception as e:
+        return {"source": source, "error": f"{type(e).__name__}: {e}"}, None
+
+def flat_row(row):
+    """
+    A row of the flat formats, with the tags joined by ";", one speed column per direction, the number of sections
+    and the crew walking distances.
+    """
+    flat = {column: row.get(column) for column in COLUMNS}
+    if row.get("tags") is not None:
+        flat["tags"] = ";".join(sorted(row["tags"]))
+    for direction, speed in (row.get("all_direction_speeds") or {}).items():
+        flat[f"speed_{direction}"] = speed
+    if row.get("connectivity") is not None:
+        flat["sections"] = row["connectivity"]["sections"]
+    if row.get("crew_distance") is not None:
+        flat["crew_average"] = row["crew_distance"]["average"]
+        flat["crew_worst"] = row["crew_distance"]["worst"]
+    return flat
+
+def end_with_newline(path):
+    # a run killed in the middle of a write leaves a partial last line, start the next row on its own line
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+class JSONLWriter():
+    def __init__(self, path):
+        self.path = path
+
+    def done(self):
+        sources = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(row, dict) and row.get("source") and row.get("error") is None:
+                        sources.add(row["source"])
+        return sources
+
+    def open(self):
+        end_with_newline(self.path)
+        self.file = open(self.path, "a")
+
+    def write(self, row):
+        self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class CSVWriter():
+    def __init__(self, path):
+        self.path = path
+
+    def done(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, newline="") as f:
+            return {row["source"] for row in csv.DictReader(f) if row.get("source") and not row.get("error")}
+
+    def open(self):
+        end_with_newline(self.path)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.DictWriter(self.file, COLUMNS)
+        if new:
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(flat_row(row))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter():
+    """
+    Writes a directory of parquet part files, a part is written every PARQUET_ROWS rows.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+
+    def parts(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".parquet"))
+
+    def done(self):
+        import pyarrow.parquet as pq
+        sources = set()
+        for part in self.parts():
+            table = pq.read_table(part, columns=["source", "error"]).to_pydict()
+            sources.update(source for source, error in zip(table["source"], table["error"]) if error is None)
+        return sources
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.count = len(self.parts())
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self.rows:
+            return
+        table = pa.Table.from_pylist(self.rows, schema=parquet_schema())
+        # write under a temporary name so an interrupted write is not read back as a part
+        path = os.path.join(self.path, f"part-{self.count:05d}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.count += 1
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(flat_row(row))
+        if len(self.rows) >= PARQUET_ROWS:
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+def parquet_schema():
+    import pyarrow as pa
+    types = {"source": pa.string(), "name": pa.string(), "author": pa.string(), "tags": pa.string(),
+             "url_com": pa.string(), "error": pa.string(), "parts": pa.int64(), "crew": pa.int64(), "sections": pa.int64()}
+    return pa.schema([(column, types.get(column, pa.float64())) for column in COLUMNS])
+
+WRITERS = {"jsonl": JSONLWriter, "csv": CSVWriter, "parquet": ParquetWriter}
+
+def output_format(path, format):
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    return {"json": "jsonl", "ndjson": "jsonl"}.get(extension, extension if extension in WRITERS else "jsonl")
+
+def run(sources, writer, args, render_dir, jobs, fetchers, timeout, library=None):
+    """
+    Fetch, analyze and write every source, the three steps overlap.
+    The analyses are also stored in the ship library at library when it is given.
+
+    Returns:
+        tuple: The number of rows written and the number of rows with an error.
+    """
+    # enough work in flight to keep every worker busy without holding every png in memory
+    window = jobs * 2 + fetchers
+    remaining = iter(sources)
+    pending = {}
+    written = errors = 0
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(fetchers) as fetch_pool, ProcessPoolExecutor(jobs, initializer=init_worker) as pool:
+        def refill():
+            while len(pending) < window:
+                source = next(remaining, None)
+                if source is None:
+                    return
+                pending[fetch_pool.submit(fetch, source, timeout)] = ("fetch", source)
+
+        refill()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                kind, source = pending.pop(future)
+                if kind == "fetch":
+                    try:
+                        png_data = future.result()
+                    except Exception as e:
+                        row = {"source": source, "error": f"{type(e).__name__}: {e}"}
+                    else:
+                        pending[pool.submit(analyze_source, source, png_data, args, render_dir, library is not None)] = ("analyze", source)
+                        continue
+                else:
+                    row, entry = future.result()
+                    if entry is not None:
+                        ship_library.store(entry, library)
+                writer.write(row)
+                written += 1
+                errors += row["error"] is not None
+                if written % PROGRESS_EVERY == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"{written}/{len(sources)} ships, {written / elapsed:.1f}/s, {errors} errors", file=sys.stderr)
+            refill()
+    return written, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cosmo-analyze", description="analyze many ships in parallel")
+    parser.add_argument("inputs", nargs="+", help="directories, globs, png files, urls or .txt lists of them")
+    parser.add_argument("-o", "--output", required=True, help="output file, or directory for parquet")
+    parser.add_argument("--format", choices=list(WRITERS), help="defaults to the extension of the output")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="analysis processes")
+    parser.add_argument("--fetchers", type=int, default=8, help="threads reading files and downloading urls")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a download fails")
+    parser.add_argument("--render", metavar="DIR", help="also draw every ship into this directory")
+    parser.add_argument("--render-format", choices=["png", "svg"], default="png")
+    parser.add_argument("--scale", type=float, default=1, help="scale of the drawings")
+    parser.add_argument("--no-boost", action="store_true", help="compute the speeds without boost")
+    parser.add_argument("--library", metavar="DB", help="also store the analyses in this ship library")
+    options = parser.parse_args(argv)
+
+    format = output_format(options.output, options.format)
+    if format == "parquet":
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("the parquet format needs pyarrow, pip install pyarrow")
+    writer = WRITERS[format](options.output)
+
+    sources = expand_inputs(options.inputs)
+    done = writer.done()
+    todo = [source for source in sources if source not in done]
+    print(f"{len(sources)} ships, {len(sources) - len(todo)} already in {options.output}", file=sys.stderr)
+
+    render_dir = None
+    if options.render:
+        render_dir = os.path.abspath(options.render)
+        os.makedirs(render_dir, exist_ok=True)
+    args = {"draw": render_dir is not None, "boost": not options.no_boost, "scale": options.scale,
+            "format": options.render_format}
+
+    writer.open()
+    start = time.perf_counter()
+    try:
+        written, errors = run(todo, writer, args, render_dir, max(1, options.jobs), max(1, options.fetchers), options.timeout, options.library)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    print(f"analyzed {written} ships in {elapsed:.1f}s, {errors} errors", file=sys.stderr)
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,84 @@
+# import time budget check for the serverless cold start
+# usage : python bench/importtime.py [--budget-ms 1500] [--ship path/to/ship.png]
+#   imports server with python -X importtime in a fresh interpreter and fails if the
+#   import takes longer than the budget or loads a module that only drawing needs
+#   with --ship, also times a fresh interpreter up to the first /analyze response (draw=false)
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that must stay out of the import chain of server
+FORBIDDEN = ["cv2", "requests", "uvicorn"]
+
+FIRST_RESPONSE = """
+import sys, time
+start = time.perf_counter()
+from fastapi.testclient import TestClient
+import server
+client = TestClient(server.app)
+response = client.get("/analyze", params={"url": sys.argv[1], "draw": "false"})
+response.raise_for_status()
+print(time.perf_counter() - start)
+print(",".join(sorted(m for m in %r if m in sys.modules)))
+""" % (FORBIDDEN,)
+
+def import_times(module="server"):
+    """
+    Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        dict: A dictionary mapping every imported module to its cumulative import time in microseconds.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="check the import time of server against a budget")
+    parser.add_argument("--budget-ms", type=float, default=1500, help="largest allowed import time of server")
+    parser.add_argument("--ship", help="ship png used to time the first /analyze response")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to print")
+    options = parser.parse_args()
+
+    failed = False
+    times = import_times()
+    total_ms = times["server"] / 1000
+    print(f"import server: {total_ms:.0f} ms (budget {options.budget_ms:.0f} ms)")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[1:options.top + 1]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    if total_ms > options.budget_ms:
+        print("FAIL: import time is over budget")
+        failed = True
+
+    loaded = [name for name in FORBIDDEN if name in times]
+    if loaded:
+        print("FAIL: imported at startup: " + ", ".join(loaded))
+        failed = True
+
+    if options.ship:
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", FIRST_RESPONSE, os.path.abspath(options.ship)],
+                                cwd=ROOT, capture_output=True, text=True, check=True)
+        in_process, loaded = result.stdout.splitlines()[-2:]
+        print(f"cold start to first /analyze: {(time.perf_counter() - start) * 1000:.0f} ms "
+              f"({float(in_process) * 1000:.0f} ms after interpreter start)")
+        if loaded:
+            print("FAIL: imported by a draw=false request: " + loaded)
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+if(__name__ == "__main__"):
+    main()
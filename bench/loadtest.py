@@ -0,0 +1,199 @@
+# load test of the FastAPI app, without touching imgbb, cloudinary or remote ship urls
+# usage : python bench/loadtest.py [--workers 2] [--concurrency 8] [--requests 200] [--sizes 10 100 1000]
+#   starts a mock upload server standing in for imgbb and cloudinary, a static server for the ship pngs
+#   made by shipgen, and uvicorn running server:app, then replays a mix of GET and POST /analyze calls
+#   and reports throughput, p50/p95/p99 latency and error rates, overall and per kind of request
+
+import argparse
+import http.server
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import shipgen
+
+class MockUploadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers like imgbb on /1/upload and like cloudinary on any other path.
+    """
+    uploads = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        MockUploadHandler.uploads += 1
+        url = f"http://mock.invalid/{MockUploadHandler.uploads}.png"
+        if self.path.startswith("/1/upload"):
+            body = {"data": {"url": url}}
+        else:
+            body = {"secure_url": url}
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class QuietFileHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def serve(handler):
+    """
+    Run an http server on a free port in a background thread.
+
+    Returns:
+        str: The base url of the server.
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", free_port()), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def start_app(workers, upload_url):
+    """
+    Start uvicorn with server:app, uploads go to the mock server.
+
+    Returns:
+        tuple: The uvicorn process and the base url of the app.
+    """
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "imagebb_url": upload_url + "/1/upload",
+        "imagebb_api": "loadtest",
+        "cloudinary_url": upload_url + "/v1_1/{cloud_name}/image/upload",
+        "secret_session": env.get("secret_session", "loadtest"),
+    })
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+                                "--workers", str(workers), "--log-level", "warning"], cwd=ROOT, env=env)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return process, base_url
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("uvicorn did not start")
+
+def request_mix(ship_urls, count, post_ratio, draw_ratio, seed):
+    """
+    Build a reproducible list of requests.
+
+    Returns:
+        list: (kind, method, ship url, args) tuples, kind is e.g. "GET draw 100".
+    """
+    rnd = random.Random(seed)
+    mix = []
+    for _ in range(count):
+        size, url = rnd.choice(ship_urls)
+        method = "POST" if rnd.random() < post_ratio else "GET"
+        draw = rnd.random() < draw_ratio
+        args = {"draw": draw, "boost": rnd.random() < 0.5}
+        mix.append((f"{method} {'draw' if draw else 'nodraw'} {size}", method, url, args))
+    return mix
+
+def send(session, base_url, method, url, args):
+    start = time.perf_counter()
+    try:
+        if method == "GET":
+            params = {"url": url, **{key: str(value).lower() for key, value in args.items()}}
+            response = session.get(base_url + "/analyze", params=params, timeout=300)
+        else:
+            # the POST endpoint expects a json string holding the json object
+            response = session.post(base_url + "/analyze", json=json.dumps({"image": url, "args": args}), timeout=300)
+        ok = response.status_code == 200 and "center_of_mass_x" in response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        ok = False
+    return time.perf_counter() - start, ok
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(name, results, elapsed=None):
+    latencies = [latency for latency, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    line = (f"{name:<22} n={len(results):<5} p50={percentile(latencies, 0.5) * 1000:8.1f}ms "
+            f"p95={percentile(latencies, 0.95) * 1000:8.1f}ms p99={percentile(latencies, 0.99) * 1000:8.1f}ms "
+            f"errors={errors / max(1, len(results)):.1%}")
+    if elapsed is not None:
+        line += f" throughput={len(results) / elapsed:.1f} req/s"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="load test server:app with local stand-ins for every external service")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=200, help="number of requests to send")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000], help="part counts of the ships")
+    parser.add_argument("--variant", default="mixed", choices=shipgen.VARIANTS)
+    parser.add_argument("--post-ratio", type=float, default=0.5, help="share of POST requests")
+    parser.add_argument("--draw-ratio", type=float, default=0.3, help="share of requests with draw=true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--app-url", help="load test an app that is already running instead of starting uvicorn")
+    options = parser.parse_args()
+
+    ship_dir = tempfile.mkdtemp(prefix="cosmo_loadtest_")
+    for size in options.sizes:
+        with open(os.path.join(ship_dir, f"{size}.ship.png"), "wb") as f:
+            f.write(shipgen.ship_png(shipgen.generate_ship(options.variant, size, options.seed)))
+
+    static_url = serve(lambda *args: QuietFileHandler(*args, directory=ship_dir))
+    upload_url = serve(MockUploadHandler)
+    ship_urls = [(size, f"{static_url}/{size}.ship.png") for size in options.sizes]
+
+    process = None
+    if options.app_url:
+        base_url = options.app_url
+    else:
+        process, base_url = start_app(options.workers, upload_url)
+
+    try:
+        mix = request_mix(ship_urls, options.requests, options.post_ratio, options.draw_ratio, options.seed)
+        sessions = threading.local()
+
+        def run(item):
+            if not hasattr(sessions, "session"):
+                sessions.session = requests.Session()
+            kind, method, url, args = item
+            return kind, send(sessions.session, base_url, method, url, args)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options.concurrency) as pool:
+            results = list(pool.map(run, mix))
+        elapsed = time.perf_counter() - start
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(f"workers={options.workers} concurrency={options.concurrency} uploads={MockUploadHandler.uploads}")
+    report("all", [result for _, result in results], elapsed)
+    for kind in sorted(set(kind for kind, _ in results)):
+        report(kind, [result for k, result in results if k == kind])
+
+if(__name__ == "__main__"):
+    main()
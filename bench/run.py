@@ -0,0 +1,255 @@
+# stage benchmarks on synthetic ships, with a check of the results against golden outputs
+# usage : python bench/run.py [--sizes 10 100 1000] [--variants mixed] [--stages decode com_cot] [--repeat 5]
+#         python bench/run.py --check            only compare the results with bench/golden.json and check that lean
+#                                                ships hold less than normal ones
+# the golden outputs include the catalog of the fixture rules of bench/rules and a ship analyzed with it
+#         python bench/run.py --update-golden    rewrite bench/golden.json after an intended change of the numbers
+# every stage is timed on its own, on the same ship, and the fastest of --repeat runs is reported
+
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import base64
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import shipgen
+import cosmoteer_save_tools
+import center_of_mass
+import rules_catalog
+from pricegen import calculate_price
+from tagextractor import PNGTagExtractor
+from connectivity import connectivity
+from crew import crew_distances
+from ship_diff import diff_ships
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules")
+RULES_ID = "bench.rules.1"
+GOLDEN_SIZES = [10, 100, 1000]
+STAGES = ["lsb", "gunzip", "decode", "com_cot", "price", "tags", "connectivity", "crew", "render", "encode"]
+DEFAULT_ARGS = {"draw": True, "flip_vectors": False, "draw_all_com": False, "draw_all_cot": True,
+                "draw_cot": True, "draw_com": True, "boost": True, "scale": 1, "max_size": None}
+
+def analyze(data):
+    """
+    The numbers of a ship that performance work must not change.
+    """
+    parts, error_message = center_of_mass.remove_weird_parts(data["Parts"])
+    arrays = center_of_mass.physics_arrays(parts)
+    comx, comy, mass = center_of_mass.center_of_mass(parts, arrays)
+    result = {"center_of_mass": [comx, comy], "total_mass": mass, "error_message": error_message}
+    for boost in (True, False):
+        _, _, thrust_direction = center_of_mass.diagonal_center_of_thrust(*center_of_mass.center_of_thrust(parts, {"boost": boost}, arrays))
+        result[f"thrust_boost_{boost}".lower()] = thrust_direction
+        result[f"rotation_boost_{boost}".lower()] = center_of_mass.rotation(arrays, comx, comy, boost)
+    # priced and tagged like analyze_ship, with the classic IDs upgraded and the unknown parts marked
+    normalized_data = {**data, "Parts": parts}
+    result["price"], result["crew"] = calculate_price(normalized_data)
+    tags, author = PNGTagExtractor().extract_tags(normalized_data)
+    result["tags"] = sorted(tags)
+    result["author"] = author
+    return result
+
+def diff(data):
+    """
+    The diff of a ship with a copy that lost its first part and got a part of an unknown ID, which the diff leaves out.
+    """
+    unknown = {"ID": "cosmoteer.not_a_part", "Location": [1000, 1000], "Rotation": 0, "FlipX": False}
+    result = diff_ships(data, {**data, "Parts": list(data["Parts"][1:]) + [unknown]})
+    return {"removed": result["removed"], "added": result["added"], "unchanged": result["unchanged"], "delta": result["delta"]}
+
+def rules():
+    """
+    The catalog of the fixture rules of bench/rules, imported like rules_catalog.py does, and the analysis, drawings
+    and diff of a ship with the parts the fixture adds to part_data.
+    """
+    parts, thrusters, prices, found = rules_catalog.read_rules(RULES_PATH)
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = rules_catalog.load_catalog(rules_catalog.save_catalog(rules_catalog.catalog_arrays(parts, thrusters, prices), RULES_ID, directory))
+    with rules_catalog.catalogs_lock:
+        rules_catalog.catalogs[RULES_ID] = catalog
+    part_table, thruster_table = rules_catalog.catalog_tables(catalog)
+    fixture_ids = ["cosmoteer.armor", "cosmoteer.new_gun", "cosmoteer.new_thruster"]
+
+    data = {**shipgen.generate_ship("mixed", 10), "ShipRulesID": RULES_ID, "Parts": [
+        {"ID": "cosmoteer.new_gun", "Location": [0, -2], "Rotation": 0, "FlipX": False},
+        {"ID": "cosmoteer.new_thruster", "Location": [0, 0], "Rotation": 0, "FlipX": False},
+        {"ID": "cosmoteer.new_thruster", "Location": [1, 0], "Rotation": 0, "FlipX": False},
+        {"ID": "cosmoteer.armor", "Location": [2, -2], "Rotation": 0, "FlipX": False},
+        {"ID": "cosmoteer.crew_quarters_small", "Location": [-1, -2], "Rotation": 0, "FlipX": False},
+    ]}
+    analysis = center_of_mass.analyze_ship(types.SimpleNamespace(data=data, image=None), {"draw": False})
+    normalized, _ = center_of_mass.remove_weird_parts(data["Parts"], catalog)
+    data_com = center_of_mass.center_of_mass(normalized, center_of_mass.physics_arrays(normalized, catalog))
+    data_cot = center_of_mass.diagonal_center_of_thrust(*center_of_mass.center_of_thrust(normalized, DEFAULT_ARGS, center_of_mass.physics_arrays(normalized, catalog)))
+    png = center_of_mass.draw_ship(normalized, data_com, data_cot, data["FlightDirection"], "", DEFAULT_ARGS, catalog)
+    svg = center_of_mass.draw_ship_svg(normalized, data_com, data_cot, data["FlightDirection"], DEFAULT_ARGS, catalog)
+    moved = {**data, "Parts": data["Parts"][1:] + [{"ID": "cosmoteer.new_gun", "Location": [0, 2], "Rotation": 1, "FlipX": False}]}
+    ship_diff = diff_ships(data, moved)
+    return {
+        "found": found,
+        "parts": {part_id: {"mass": part_table[part_id]["mass"], "size": list(part_table[part_id]["size"])} for part_id in fixture_ids},
+        "thrusters": {part_id: {"cot": [list(cot) for cot in thruster_table[part_id]["cot"]], "thrust": thruster_table[part_id]["thrust"]}
+                      for part_id in fixture_ids if part_id in thruster_table},
+        "prices": {part_id: catalog["prices"][part_id] for part_id in fixture_ids},
+        "analysis": analysis,
+        "drawn": not png.startswith("error") and svg.count("<rect") == 2 + 3,
+        "diff": {"removed": ship_diff["removed"], "added": ship_diff["added"], "delta": ship_diff["delta"]},
+    }
+
+def lean_check(size):
+    """
+    Bytes held by a lean and a normal ship after the picture is read again and the ship is written.
+
+    Returns:
+        tuple: The total bytes of the lean ship and of the normal ship, the lean one must stay smaller.
+    """
+    png = shipgen.ship_png(shipgen.generate_ship("mixed", size))
+    totals = []
+    for lean in (True, False):
+        ship = cosmoteer_save_tools.Ship(png, lean=lean)
+        ship.image_data
+        ship.write()
+        totals.append(ship.memory_size()["total"])
+    return tuple(totals)
+
+def close(expected, actual, path=""):
+    """
+    Compare two results, floats with a relative tolerance.
+
+    Returns:
+        list: The paths of the values that differ.
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        differences = []
+        for key in sorted(set(expected) | set(actual)):
+            differences += close(expected.get(key), actual.get(key), f"{path}.{key}")
+        return differences
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        differences = []
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            differences += close(a, b, f"{path}[{i}]")
+        return differences
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        return [] if abs(expected - actual) <= 1e-9 * max(1, abs(expected)) else [path]
+    return [] if expected == actual else [path]
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_ship(variant, size, stages, repeat):
+    """
+    Time every stage of the pipeline on one synthetic ship.
+
+    Returns:
+        dict: A dictionary mapping stage names to seconds, None for stages that could not run.
+    """
+    data = shipgen.generate_ship(variant, size)
+    png = shipgen.ship_png(data)
+    ship = cosmoteer_save_tools.Ship(base64.b64encode(png).decode("utf-8"))
+    decompressed = gzip.decompress(ship.compressed_image_data)
+    parts, _ = center_of_mass.remove_weird_parts(ship.data["Parts"])
+    normalized_data = {**ship.data, "Parts": parts}
+    args = dict(DEFAULT_ARGS)
+
+    def decode():
+        ship.buffer = io.BytesIO(decompressed)
+        return ship.decode()
+
+    def com_cot():
+        arrays = center_of_mass.physics_arrays(parts)
+        data_com = list(center_of_mass.center_of_mass(parts, arrays))
+        data_cot = list(center_of_mass.diagonal_center_of_thrust(*center_of_mass.center_of_thrust(parts, args, arrays)))
+        center_of_mass.rotation(arrays, data_com[0], data_com[1], args["boost"])
+        return data_com, data_cot
+
+    data_com, data_cot = com_cot()
+
+    def render():
+        return center_of_mass.draw_ship(parts, data_com, data_cot, ship.data["FlightDirection"], "", args)
+
+    functions = {
+        "lsb": ship.read_bytes,
+        "gunzip": lambda: gzip.decompress(ship.compressed_image_data),
+        "decode": decode,
+        "com_cot": com_cot,
+        "price": lambda: calculate_price(normalized_data),
+        "tags": lambda: PNGTagExtractor().extract_tags(normalized_data),
+        "connectivity": lambda: connectivity(parts),
+        "crew": lambda: crew_distances(parts),
+        "render": render,
+        "encode": ship.write,
+    }
+
+    timings = {}
+    for stage in stages:
+        if stage == "render" and center_of_mass.ship_extent(parts) > 110:
+            # draw_ship only has room for ships within 60 tiles of the center
+            timings[stage] = None
+            continue
+        timings[stage] = best_time(functions[stage], repeat)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the analysis pipeline on synthetic ships")
+    parser.add_argument("--variants", nargs="+", default=shipgen.VARIANTS, choices=shipgen.VARIANTS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=GOLDEN_SIZES)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check", action="store_true", help="only check the results against the golden outputs")
+    parser.add_argument("--update-golden", action="store_true", help="rewrite the golden outputs")
+    options = parser.parse_args()
+
+    # paths of the sprites are relative to the repository
+    os.chdir(ROOT)
+
+    results = {f"{variant}_{size}": analyze(shipgen.generate_ship(variant, size))
+               for variant in shipgen.VARIANTS for size in GOLDEN_SIZES}
+    results.update({f"diff_legacy_{size}": diff(shipgen.generate_ship("legacy", size)) for size in GOLDEN_SIZES})
+    results["rules"] = rules()
+    if options.update_golden:
+        with open(GOLDEN_PATH, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f"wrote {GOLDEN_PATH}")
+        return
+
+    with open(GOLDEN_PATH) as f:
+        golden = json.load(f)
+    failed = False
+    for name, result in results.items():
+        differences = close(golden.get(name), result)
+        if differences:
+            print(f"FAIL {name}: " + ", ".join(differences))
+            failed = True
+    for size in GOLDEN_SIZES:
+        lean, normal = lean_check(size)
+        if lean >= normal:
+            print(f"FAIL lean_{size}: a lean ship holds {lean} bytes, a normal one {normal}")
+            failed = True
+    print("golden outputs: " + ("FAIL" if failed else "ok"))
+    if options.check or failed:
+        sys.exit(1 if failed else 0)
+
+    print(f"{'ship':<16}" + "".join(f"{stage:>11}" for stage in options.stages))
+    for variant in options.variants:
+        for size in options.sizes:
+            timings = bench_ship(variant, size, options.stages, options.repeat)
+            print(f"{variant + '_' + str(size):<16}" + "".join(
+                f"{'-':>11}" if timings[stage] is None else f"{timings[stage] * 1000:>9.2f}ms" for stage in options.stages))
+
+if(__name__ == "__main__"):
+    main()
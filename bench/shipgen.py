@@ -0,0 +1,191 @@
+# synthetic ship generator for benchmarks and load tests
+# usage : python bench/shipgen.py out_dir [--variants mixed thrusters] [--sizes 10 100 1000]
+#   writes one valid ship png per variant and size, built with Ship.from_data and Ship.write
+# variants :
+#   mixed     : a bit of everything, placed at random without overlaps
+#   thrusters : mostly thrusters of every size around a hull of structure
+#   engines   : engine rooms surrounded by thrusters, the worst case of the engine room bonus
+#   legacy    : mixed, with classic part IDs that remove_weird_parts has to upgrade
+#   grid      : a structured hull, corridors every fourth row and rooms packed in between
+
+import argparse
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import part_data
+import cosmoteer_save_tools
+
+VARIANTS = ["mixed", "thrusters", "engines", "legacy", "grid"]
+SIZES = [10, 100, 1000, 5000, 20000]
+
+THRUSTERS = list(part_data.thruster_data)
+HULL = ["cosmoteer.armor", "cosmoteer.structure", "cosmoteer.corridor", "cosmoteer.armor_wedge"]
+ROOMS = [
+    "cosmoteer.reactor_small", "cosmoteer.reactor_med", "cosmoteer.crew_quarters_small", "cosmoteer.crew_quarters_med",
+    "cosmoteer.shield_gen_small", "cosmoteer.laser_blaster_small", "cosmoteer.cannon_med", "cosmoteer.railgun_launcher",
+    "cosmoteer.missile_launcher", "cosmoteer.storage_2x2", "cosmoteer.factory_ammo", "cosmoteer.point_defense",
+    "cosmoteer.control_room_small", "cosmoteer.hyperdrive_small", "cosmoteer.power_storage", "cosmoteer.engine_room",
+]
+# classic IDs and the footprint of the part they are upgraded to
+LEGACY = {
+    "cosmoteer.ammo_factory": "cosmoteer.factory_ammo",
+    "cosmoteer.missile_factory_he": "cosmoteer.factory_he",
+    "cosmoteer.electro_bolter": "cosmoteer.disruptor",
+    "cosmoteer.armor_1x2_wedge_L": "cosmoteer.armor_1x2_wedge",
+    "cosmoteer.structure_1x3_wedge_R": "cosmoteer.structure_1x3_wedge",
+}
+
+def footprint(part_id, rotation):
+    """
+    Size of a part on the tile grid after rotation.
+    """
+    size = part_data.parts[LEGACY.get(part_id, part_id)]["size"]
+    if rotation == 1 or rotation == 3:
+        return size[1], size[0]
+    return size
+
+class Layout():
+    """
+    Places parts on a square tile grid centered on 0, 0 without overlaps.
+    """
+    def __init__(self, count, rnd):
+        # about 2.5 tiles per part leaves room for the bigger parts
+        self.half = max(8, int((count * 2.5) ** 0.5 / 2) + 2)
+        self.rnd = rnd
+        self.taken = set()
+        self.parts = []
+
+    def fits(self, x, y, width, height):
+        if x < -self.half or y < -self.half or x + width > self.half or y + height > self.half:
+            return False
+        return all((x + i, y + j) not in self.taken for i in range(width) for j in range(height))
+
+    def place(self, part_id, x, y, rotation, flipx=False):
+        width, height = footprint(part_id, rotation)
+        if not self.fits(x, y, width, height):
+            return False
+        for i in range(width):
+            for j in range(height):
+                self.taken.add((x + i, y + j))
+        self.parts.append({"ID": part_id, "Location": [x, y], "Rotation": rotation, "FlipX": flipx})
+        return True
+
+    def place_random(self, part_id, attempts=50):
+        for _ in range(attempts):
+            rotation = self.rnd.randint(0, 3)
+            if self.place(part_id, self.rnd.randint(-self.half, self.half), self.rnd.randint(-self.half, self.half),
+                          rotation, self.rnd.random() < 0.5):
+                return True
+        return False
+
+    def fill(self, count, choose):
+        # give up on a part after a few misses, then fill the rest with single tiles
+        while len(self.parts) < count:
+            if not self.place_random(choose()):
+                if not self.place_random("cosmoteer.armor", 500):
+                    self.half += 1
+
+def generate_parts(variant, count, seed=0):
+    """
+    Generate the part list of a synthetic ship.
+
+    Args:
+        variant (str): One of VARIANTS.
+        count (int): The number of parts.
+        seed (int): The seed of the layout, the same arguments always give the same ship.
+
+    Returns:
+        list: The parts, in the format of the "Parts" list of a decoded ship.
+    """
+    rnd = random.Random(f"{variant}-{count}-{seed}")
+    layout = Layout(count, rnd)
+
+    if variant == "grid":
+        # corridors on every fourth row, 2x2 and 1x2 rooms in the rows between
+        y = -layout.half
+        while len(layout.parts) < count and y + 3 <= layout.half:
+            for x in range(-layout.half, layout.half):
+                if len(layout.parts) >= count:
+                    break
+                layout.place("cosmoteer.corridor", x, y, 0)
+            x = -layout.half
+            while len(layout.parts) < count and x + 2 <= layout.half:
+                room = rnd.choice(["cosmoteer.reactor_small", "cosmoteer.storage_2x2", "cosmoteer.power_storage", "cosmoteer.crew_quarters_med"])
+                layout.place(room, x, y + 1, 0)
+                x += 2
+            y += 4
+        layout.fill(count, lambda: "cosmoteer.armor")
+    elif variant == "engines":
+        # every engine room gets a ring of small thrusters
+        while len(layout.parts) < count:
+            x = rnd.randint(-layout.half, layout.half - 3)
+            y = rnd.randint(-layout.half, layout.half - 3)
+            if not layout.place("cosmoteer.engine_room", x, y, 0):
+                if not layout.place_random("cosmoteer.armor", 500):
+                    layout.half += 1
+                continue
+            for i in range(3):
+                for x_ring, y_ring, rotation in ((x + i, y - 1, 2), (x + i, y + 3, 0), (x - 1, y + i, 1), (x + 3, y + i, 3)):
+                    if len(layout.parts) < count:
+                        layout.place("cosmoteer.thruster_small", x_ring, y_ring, rotation)
+    elif variant == "thrusters":
+        layout.fill(count, lambda: rnd.choice(THRUSTERS) if rnd.random() < 0.7 else rnd.choice(HULL))
+    elif variant == "legacy":
+        legacy = list(LEGACY)
+        layout.fill(count, lambda: rnd.choice(legacy) if rnd.random() < 0.2 else rnd.choice(HULL + ROOMS + THRUSTERS))
+    else:
+        layout.fill(count, lambda: rnd.choice(HULL) if rnd.random() < 0.5 else rnd.choice(ROOMS + THRUSTERS))
+
+    return layout.parts
+
+def generate_ship(variant, count, seed=0):
+    """
+    Generate the decoded data of a synthetic ship.
+
+    Returns:
+        dict: The ship data, in the format of Ship(...).data.
+    """
+    parts = generate_parts(variant, count, seed)
+    return {
+        "Version": 2,
+        "Name": f"{variant} {count}",
+        "Author": "shipgen",
+        "FlightDirection": 1,
+        "Parts": parts,
+        "Doors": [{"ID": "cosmoteer.door", "Cell": [part["Location"][0], part["Location"][1]], "Orientation": 0}
+                  for part in parts[:count // 20]],
+        "PartUIToggleStates": [],
+        "NewFlexResourceGridTypes": [{"Key": [0, 0], "Value": "steel"}, {"Key": [1, 0], "Value": "coil"}],
+    }
+
+def ship_png(data):
+    """
+    Write ship data into png bytes, through Ship.write like the game does.
+    """
+    image = cosmoteer_save_tools.Ship.from_data(data).write()
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description="generate synthetic ship pngs")
+    parser.add_argument("out_dir")
+    parser.add_argument("--variants", nargs="+", default=VARIANTS, choices=VARIANTS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+
+    os.makedirs(options.out_dir, exist_ok=True)
+    for variant in options.variants:
+        for size in options.sizes:
+            path = os.path.join(options.out_dir, f"{variant}_{size}.ship.png")
+            with open(path, "wb") as f:
+                f.write(ship_png(generate_ship(variant, size, options.seed)))
+            print(path)
+
+if(__name__ == "__main__"):
+    main()
@@ -21,15 +21,26 @@
 
 import part_data
 import cosmoteer_save_tools
+import sprite_atlas
+import metrics
+import ship_library
+import fleet
+from connectivity import connectivity, part_tile_arrays, tile_keys
+from crew import crew_distances, draw_crew_heatmap
 # from pathlib import Path
 from vector2d import Vector2D
 import base64
-import cv2
+# cv2 is imported inside the drawing functions, requests with draw=false never load OpenCV
 import numpy as np
 from png_upload import upload_image_to_imgbb
 from tagextractor import PNGTagExtractor
-from pricegen import calculate_price
+from pricegen import calculate_price, part_price_catalog
+from rules_catalog import catalog_arrays, catalog_tables, catalog_version, ship_catalog
 import json
+import os
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
 
 FLIP_VECTORS=False
 BOOST=False
@@ -40,6 +51,30 @@ DRAW_ALL_COT=True
 DRAW=True
 SHIP="ships\\nw.png" #set to the name of your ship.png
 
+SPRITE_DIRECTORY="sprites/"
+SPRITE_TILE_SIZE=64 # pixels per tile in the files of the sprites folder
+MIPMAP_LEVELS=[16, 8, 4, 2] # pixels per tile of the prepared sprite variants, full size first
+MISSING_SPRITE_COLOR=(110, 110, 110) # BGR of the parts with no sprite, the parts of catalogs of newer rules
+
+OVERLAY_MARGIN=0.1 # part of the uploaded image left around the ship by the overlay only render
+RENDER_CACHE_BYTES=int(os.getenv("render_cache_bytes", 64 * 2**20)) # sprite layers kept for drawing the same ship again, 0 turns it off
+
+ENGINE_ROOM_BONUS=1.5 # thrust of thrusters touching an engine room
+SIDE_THRUST=0.05 # share of the thrust of a thruster pushing sideways
+UNBOOSTED_THRUST=1/3 # share of the thrust of cosmoteer.thruster_boost without boost
+HALF_TURN=np.pi # angle of the turn timed by rotation()
+
+# arrays of the part numbers the physics needs, built by the first physics_arrays call
+physics_catalog=None
+# part ID -> {pixels per tile: sprite}, filled the first time a part is drawn, None for parts with no sprite
+sprite_mipmaps={}
+# (part ID, pixels per tile) -> svg symbol of the sprite
+sprite_symbols={}
+# (parts, pixels per tile) -> sprites of a ship drawn by draw_ship before the overlay, least recently used first
+sprite_layers=OrderedDict()
+sprite_layers_bytes=0
+sprite_layers_lock=threading.Lock()
+
 
 def parts_touching(part1, part2):
     """
@@ -104,67 +139,65 @@ def thruster_touching_engine_room(parts, thruster):
             return True
     return False
 
-def center_of_thrust(parts, args):
+def center_of_thrust(parts, args, arrays=None):
     """
     Calculate the center of thrust for a given set of parts.
 
     Args:
         parts (list): List of parts.
         args (dict): Dictionary of arguments.
+        arrays (dict, optional): physics_arrays(parts), when already computed.
 
     Returns:
         tuple: A tuple containing the origin thrust, thrust vector, and thrust direction.
     """
+    if arrays is None:
+        arrays = physics_arrays(parts)
+    return center_of_thrust_variants(arrays)[bool(args["boost"])]
 
-    # Initialize origin thrust for each direction
-    origin_thrust = [
-        Vector2D(0, 0),
-        Vector2D(0, 0),
-        Vector2D(0, 0),
-        Vector2D(0, 0)
-    ]
-
-    # Initialize thrust direction for each direction
-    thrust_direction = [0, 0, 0, 0]
-
-    # Iterate over each part
-    for part in parts:
-        # Calculate the center of thrust for the part
-        cots = part_center_of_thrust(part, args["boost"])
-
-        # Skip if center of thrust is zero
-        if cots == 0:
-            continue
-
-        # Iterate over each center of thrust
-        for cot in cots:
-            origin = cot[0]
-            orientation = cot[1]
-            thrust = cot[2]
-
-            # Increase thrust if thruster is touching engine room
-            if thruster_touching_engine_room(parts, part):
-                thrust = thrust * 1.5
+def center_of_thrust_variants(arrays):
+    """
+    center_of_thrust with and without boost, the sums of both come from one pass over the centers of thrust.
 
-            # Update thrust direction and origin thrust for the given orientation
-            thrust_direction[orientation] += thrust
-            origin_thrust[orientation] += origin * thrust
+    Args:
+        arrays (dict): physics_arrays(parts).
 
-    # Calculate the average origin thrust for each direction
-    for i in range(len(thrust_direction)):
-        if thrust_direction[i] == 0:
-            continue
-        origin_thrust[i] = origin_thrust[i] / thrust_direction[i]
-
-    # Calculate the end of the thrust vector
-    thrust_vector = [
-        origin_thrust[0] + Vector2D(0, -thrust_direction[0]),
-        origin_thrust[1] + Vector2D(thrust_direction[1], 0),
-        origin_thrust[2] + Vector2D(0, thrust_direction[2]),
-        origin_thrust[3] + Vector2D(-thrust_direction[3], 0)
-    ]
+    Returns:
+        dict: True and False -> the origin thrust, thrust vector and thrust direction of center_of_thrust.
+    """
+    # one column of thrust per boost state
+    thrust = np.stack([cot_thrust(arrays, True), cot_thrust(arrays, False)], axis=1)
+    moment_x = arrays["x_cot"][:, None] * thrust
+    moment_y = arrays["y_cot"][:, None] * thrust
+
+    # Sum the thrust and the thrust weighted origins of each direction
+    origin_thrust = {True: [], False: []}
+    thrust_direction = {True: [], False: []}
+    for orientation in range(4):
+        selected = arrays["orientation"] == orientation
+        sums = [ordered_sum(values[selected]) for values in (thrust, moment_x, moment_y)]
+        for column, boost in enumerate((True, False)):
+            thrust_direction[boost].append(sums[0][column] if selected.any() else 0)
+            origin_thrust[boost].append(Vector2D(sums[1][column], sums[2][column]) if selected.any() else Vector2D(0, 0))
+
+    variants = {}
+    for boost in (True, False):
+        # Calculate the average origin thrust for each direction
+        for i in range(len(thrust_direction[boost])):
+            if thrust_direction[boost][i] == 0:
+                continue
+            origin_thrust[boost][i] = origin_thrust[boost][i] / thrust_direction[boost][i]
 
-    return origin_thrust, thrust_vector, thrust_direction
+        # Calculate the end of the thrust vector
+        origin, direction = origin_thrust[boost], thrust_direction[boost]
+        thrust_vector = [
+            origin[0] + Vector2D(0, -direction[0]),
+            origin[1] + Vector2D(direction[1], 0),
+            origin[2] + Vector2D(0, direction[2]),
+            origin[3] + Vector2D(-direction[3], 0)
+        ]
+        variants[boost] = (origin, thrust_vector, direction)
+    return variants
 
 
 def diagonal_center_of_thrust(origin_thrust, thrust_vector, thrust_direction):
@@ -239,18 +272,19 @@ def top_speed(mass, thrust):
     
     return speed
 
-def part_center_of_mass(part):
+def part_center_of_mass(part, part_table=None):
     """
     Calculate the center of mass for a given part.
 
     Args:
         part (dict): The part information.
+        part_table (dict, optional): The sizes of the parts, like part_data.parts, see rules_catalog.catalog_tables.
 
     Returns:
         tuple: The x and y coordinates of the center of mass.
     """
     # Get part size
-    part_size = part_data.parts[part["ID"]]["size"]
+    part_size = (part_table or part_data.parts)[part["ID"]]["size"]
     part_rotation = part["Rotation"] # 0, 1, 2, 3
 
     # Calculate center of mass
@@ -265,20 +299,23 @@ def part_center_of_mass(part):
 
     return center_of_mass_x, center_of_mass_y
 
-def part_center_of_thrust(part, boost):
+def part_center_of_thrust(part, boost, part_table=None, thruster_table=None):
     """
     Calculate the center of thrust for a given part.
 
     Args:
         part (dict): The part object.
         boost (bool): Whether the part is boosted or not.
+        part_table (dict, optional): The sizes of the parts, like part_data.parts.
+        thruster_table (dict, optional): The thrusters, like part_data.thruster_data, see rules_catalog.catalog_tables.
 
     Returns:
         list: A list of tuples representing the multiple centers of thrust for the part.
     """
     # Get part center of thrust (cot) and thrust values
-    part_cots = part_data.thruster_data.get(part["ID"], {"cot": 0})["cot"]
-    thrust = part_data.thruster_data.get(part["ID"], {"thrust": 0})["thrust"]
+    thruster_table = thruster_table or part_data.thruster_data
+    part_cots = thruster_table.get(part["ID"], {"cot": 0})["cot"]
+    thrust = thruster_table.get(part["ID"], {"thrust": 0})["thrust"]
     
     # Adjust thrust if part is not boosted and is a specific type
     if not boost and part["ID"] == "cosmoteer.thruster_boost":
@@ -290,7 +327,7 @@ def part_center_of_thrust(part, boost):
     
     # Calculate the absolute centers of thrust for the part
     part_rotation = part["Rotation"]
-    part_size = part_data.parts[part["ID"]]["size"]
+    part_size = (part_table or part_data.parts)[part["ID"]]["size"]
     absolute_cots = []
     
     for part_cot in part_cots:
@@ -322,39 +359,174 @@ def part_center_of_thrust(part, boost):
     
     return absolute_cots
 
-def center_of_mass(parts):
+def part_physics_catalog():
+    """
+    The numbers of every part of part_data the physics needs, see rules_catalog.catalog_arrays.
+    """
+    global physics_catalog
+    if physics_catalog is None:
+        physics_catalog = catalog_arrays(part_data.parts, part_data.thruster_data, part_price_catalog())
+    return physics_catalog
+
+def physics_arrays(parts, catalog=None):
+    """
+    Everything the physics needs about the parts of a ship, for all parts at once with numpy.
+    The centers of thrust come in the order of the loop over part_center_of_thrust of every part.
+
+    Args:
+        parts (list): List of parts, with known IDs.
+        catalog (dict, optional): The catalog of the rules of the ship, see rules_catalog.ship_catalog, part_data by default.
+
+    Returns:
+        dict: Per part "mass", "int_mass", "x" and "y" of the center, "width" and "height" after rotation, and per
+              center of thrust "part", "x_cot", "y_cot", "orientation", "thrust" (with boost, before the shares below), "side"
+              (a sideways share), "boost_only" and "engine_room" (the part touches an engine room).
+    """
+    catalog = catalog or part_physics_catalog()
+    code = np.array([catalog["codes"][part["ID"]] for part in parts], dtype=np.int64)
+    location = np.array([part["Location"] for part in parts], dtype=np.int64).reshape(-1, 2)
+    rotation = np.array([part["Rotation"] for part in parts], dtype=np.int64)
+    size_x, size_y = catalog["width"][code], catalog["height"][code]
+    turned = (rotation == 1) | (rotation == 3)
+    width, height = np.where(turned, size_y, size_x), np.where(turned, size_x, size_y)
+
+    # centers of thrust, the ones of part_data first, then two sideways ones for each of them
+    count = catalog["cot_count"][code]
+    part = np.repeat(np.arange(len(parts)), count)
+    first = np.repeat(np.cumsum(count) - count, count)
+    cot = catalog["cot_start"][code][part] + np.arange(len(part)) - first
+    cot_x, cot_y = catalog["cot_x"][cot], catalog["cot_y"][cot]
+    part_x, part_y = location[part, 0], location[part, 1]
+    sx, sy, turn = size_x[part], size_y[part], rotation[part]
+    x = np.select([turn == 0, turn == 1, turn == 2], [part_x + cot_x, part_x - cot_y + sy, part_x - cot_x + sx], part_x + cot_y)
+    y = np.select([turn == 0, turn == 1, turn == 2], [part_y + cot_y, part_y + cot_x, part_y - cot_y + sy], part_y - cot_x + sx)
+    orientation = (turn + catalog["cot_orientation"][cot]) % 4
+    side = np.repeat(np.arange(3), len(part))
+    # part_center_of_thrust lists the sideways centers after all the centers of their part, interleaved
+    order = np.lexsort((side, np.tile(cot, 3), side > 0, np.tile(part, 3)))
+    part = np.tile(part, 3)[order]
+
+    # thrusters touching an engine room, a tile of the thruster or next to it (except diagonals) is an engine room tile
+    engine = code == catalog["codes"].get("cosmoteer.engine_room", -1)
+    _, engine_x, engine_y = part_tile_arrays(location[engine, 0], location[engine, 1], width[engine], height[engine])
+    engine_keys = np.unique(tile_keys(engine_x, engine_y))
+    thrusters = np.flatnonzero(count > 0)
+    index, tile_x, tile_y = part_tile_arrays(location[thrusters, 0], location[thrusters, 1], width[thrusters], height[thrusters])
+    touching = np.zeros(len(parts), dtype=bool)
+    for step_x, step_y in ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)):
+        keys = tile_keys(tile_x + step_x, tile_y + step_y)
+        position = np.searchsorted(engine_keys, keys)
+        found = position < len(engine_keys)
+        found[found] = engine_keys[position[found]] == keys[found]
+        touching[thrusters[index[found]]] = True
+
+    return {
+        "mass": catalog["mass"][code],
+        "int_mass": catalog["int_mass"][code],
+        "x": location[:, 0] + width / 2,
+        "y": location[:, 1] + height / 2,
+        "width": width,
+        "height": height,
+        "part": part,
+        "x_cot": np.tile(x, 3)[order],
+        "y_cot": np.tile(y, 3)[order],
+        "orientation": np.concatenate([orientation, (orientation + 1) % 4, (orientation + 3) % 4])[order],
+        "thrust": catalog["thrust"][code][part],
+        "side": side[order] > 0,
+        "boost_only": catalog["boost_only"][code][part],
+        "engine_room": touching[part],
+    }
+
+def cot_thrust(arrays, boost):
+    """
+    Thrust of every center of thrust of physics_arrays, with the multiplications of part_center_of_thrust and
+    center_of_thrust in their order so the sums match to the last bit.
+    """
+    thrust = np.where(arrays["boost_only"] & (not boost), arrays["thrust"] / 3, arrays["thrust"])
+    thrust = np.where(arrays["side"], thrust * SIDE_THRUST, thrust)
+    return np.where(arrays["engine_room"], thrust * ENGINE_ROOM_BONUS, thrust)
+
+def ordered_sum(values):
+    """
+    Sum of an array added left to right like a python loop, np.sum adds pairwise and may differ in the last bits.
+    The columns of a 2d array are summed each on their own, into a list.
+    """
+    if values.ndim == 2:
+        return np.cumsum(values, axis=0)[-1].tolist() if len(values) else [0] * values.shape[1]
+    return float(np.cumsum(values)[-1]) if len(values) else 0
+
+def center_of_mass(parts, arrays=None):
     """
     Calculate the center of mass for a given list of parts.
 
     Args:
         parts (list): List of parts.
+        arrays (dict, optional): physics_arrays(parts), when already computed.
 
     Returns:
         tuple: Center of mass coordinates (x, y) and total mass.
 
     """
+    if arrays is None:
+        arrays = physics_arrays(parts)
 
-    total_mass = 0
-    sum_x_mass = 0
-    sum_y_mass = 0
-
-    for part in parts:
-        mass = part_data.parts[part["ID"]]["mass"]
-        x_coord, y_coord = part_center_of_mass(part)
-
-        total_mass += mass
-        sum_x_mass += mass * x_coord
-        sum_y_mass += mass * y_coord
+    total_mass = ordered_sum(arrays["mass"])
+    if arrays["int_mass"].all():
+        total_mass = int(total_mass)
 
     if total_mass == 0:
         center_of_mass_x = 0
         center_of_mass_y = 0
     else:
-        center_of_mass_x = sum_x_mass / total_mass
-        center_of_mass_y = sum_y_mass / total_mass
+        center_of_mass_x = ordered_sum(arrays["mass"] * arrays["x"]) / total_mass
+        center_of_mass_y = ordered_sum(arrays["mass"] * arrays["y"]) / total_mass
 
     return center_of_mass_x, center_of_mass_y, total_mass
 
+def rotation(arrays, center_of_mass_x, center_of_mass_y, boost):
+    """
+    Turning performance of a ship : its moment of inertia about the center of mass and the torque of its thrusters.
+    Parts are solid rectangles of their footprint, thrusters push along their main direction, the sideways share of
+    the speeds is left out. Positive torque turns clockwise on the drawing (y grows downward). Thrust / mass is taken
+    as an acceleration in tiles per second squared.
+
+    Args:
+        arrays (dict): physics_arrays(parts).
+        center_of_mass_x (float): The x of the center of mass, see center_of_mass.
+        center_of_mass_y (float): The y of the center of mass.
+        boost (bool): Whether the thrusters are boosted.
+
+    Returns:
+        dict: "moment_of_inertia" and, for "clockwise" and "counterclockwise", the "torque" of the thrusters pushing
+              that way, the "angular_acceleration" in degrees per second squared, the "turn_time" in seconds to turn
+              half a turn from rest with these thrusters firing, and the "turn_rate", the average degrees per second
+              of that turn.
+    """
+    mass = arrays["mass"]
+    inertia = float(np.sum(mass * ((arrays["width"] ** 2 + arrays["height"] ** 2) / 12
+                                   + (arrays["x"] - center_of_mass_x) ** 2 + (arrays["y"] - center_of_mass_y) ** 2)))
+
+    main = ~arrays["side"]
+    thrust = cot_thrust(arrays, boost)[main]
+    orientation = arrays["orientation"][main]
+    # push of each orientation, see the thrust vectors of center_of_thrust
+    push_x = np.array([0, 1, 0, -1])[orientation]
+    push_y = np.array([-1, 0, 1, 0])[orientation]
+    torque = ((arrays["x_cot"][main] - center_of_mass_x) * push_y - (arrays["y_cot"][main] - center_of_mass_y) * push_x) * thrust
+
+    result = {"moment_of_inertia": inertia}
+    for direction, sign in (("clockwise", 1), ("counterclockwise", -1)):
+        direction_torque = float(np.maximum(sign * torque, 0).sum())
+        acceleration = direction_torque / inertia if inertia else 0.0
+        turn_time = (2 * HALF_TURN / acceleration) ** 0.5 if acceleration else None
+        result[direction] = {
+            "torque": direction_torque,
+            "angular_acceleration": float(np.degrees(acceleration)),
+            "turn_time": turn_time,
+            "turn_rate": float(np.degrees(HALF_TURN) / turn_time) if turn_time else 0.0,
+        }
+    return result
+
 def center_of_thrust_vector(parts, ship_direction):
     """
     Calculate the center of thrust vector of the ship in a given direction.
@@ -451,6 +623,125 @@ def rotate_image(image, angle, flipx):
     else:
         return image
 
+def load_sprite_mipmaps(part_id):
+    """
+    Load the sprite of a part and prepare one variant per mipmap level.
+    The variants are built once and reused by every later render.
+
+    Args:
+        part_id (str): The ID of the part, e.g. "cosmoteer.armor".
+
+    Returns:
+        dict: A dictionary mapping pixels per tile to the resized sprite, None for the parts of the catalogs of newer
+              rules that have no sprite in the sprites folder.
+    """
+    import cv2
+    if part_id in sprite_mipmaps:
+        return sprite_mipmaps[part_id]
+
+    # the atlas already holds every level, decoded once at deploy time
+    mipmaps = {level: sprite_atlas.get_variant(part_id, level, 0, False) for level in MIPMAP_LEVELS}
+    if all(sprite is not None for sprite in mipmaps.values()):
+        sprite_mipmaps[part_id] = mipmaps
+        return mipmaps
+
+    sprite_path = SPRITE_DIRECTORY + part_id.replace("cosmoteer.", "") + ".png"
+    sprite = cv2.imread(sprite_path, cv2.IMREAD_UNCHANGED) if os.path.exists(sprite_path) else None
+    if sprite is None:
+        sprite_mipmaps[part_id] = None
+        return None
+
+    mipmaps = {}
+    previous = sprite
+    for level in MIPMAP_LEVELS:
+        dimensions = (round(sprite.shape[1] * level / SPRITE_TILE_SIZE), round(sprite.shape[0] * level / SPRITE_TILE_SIZE))
+        if previous is sprite:
+            # the full size level is resized like the sprites always were
+            previous = cv2.resize(sprite, dimensions)
+        else:
+            # smaller levels are averaged down from the level above
+            previous = cv2.resize(previous, dimensions, interpolation=cv2.INTER_AREA)
+        mipmaps[level] = previous
+
+    sprite_mipmaps[part_id] = mipmaps
+    return mipmaps
+
+def oriented_sprite(part_id, size_factor, rotation, flipx):
+    """
+    Get the sprite of a part at a mipmap level, already rotated and flipped.
+
+    Args:
+        part_id (str): The ID of the part.
+        size_factor (int): The pixels per tile, one of MIPMAP_LEVELS.
+        rotation (int): The rotation of the part, 0, 1, 2 or 3.
+        flipx (bool): Whether the part is flipped horizontally.
+
+    Returns:
+        numpy.ndarray: The sprite, a read-only view into the atlas when one was built, None for a part with no sprite.
+    """
+    sprite = sprite_atlas.get_variant(part_id, size_factor, rotation, flipx)
+    if sprite is not None:
+        metrics.inc("cosmo_sprite_cache_total", result="atlas")
+        return sprite
+    metrics.inc("cosmo_sprite_cache_total", result="hit" if part_id in sprite_mipmaps else "miss")
+    mipmaps = load_sprite_mipmaps(part_id)
+    return None if mipmaps is None else rotate_image(mipmaps[size_factor], rotation, flipx)
+
+def ship_extent(parts, catalog=None):
+    """
+    Calculate the number of tiles spanned by the ship, including turrets that stick out of their part.
+
+    Args:
+        parts (list): List of parts.
+        catalog (dict, optional): The catalog of the rules of the ship, see rules_catalog.ship_catalog, part_data by default.
+
+    Returns:
+        int: The largest of the width and height of the ship in tiles.
+    """
+    if not parts:
+        return 0
+    part_table, _ = catalog_tables(catalog)
+    min_x = min_y = float("inf")
+    max_x = max_y = float("-inf")
+    for part in parts:
+        size = part_table[part["ID"]].get("sprite_size", part_table[part["ID"]]["size"])
+        if part["Rotation"] == 1 or part["Rotation"] == 3:
+            size = (size[1], size[0])
+        # turrets can stick out on any side depending on the rotation
+        overhang = max(size) - min(size)
+        min_x = min(min_x, part["Location"][0] - overhang)
+        min_y = min(min_y, part["Location"][1] - overhang)
+        max_x = max(max_x, part["Location"][0] + size[0])
+        max_y = max(max_y, part["Location"][1] + size[1])
+    return max(max_x - min_x, max_y - min_y)
+
+def render_size_factor(parts, args, catalog=None):
+    """
+    Pick the number of pixels per tile of a render from the mipmap levels.
+
+    Args:
+        parts (list): List of parts.
+        args (dict): Dictionary of arguments, "scale" multiplies the full size and
+            "max_size" is the largest wanted side of the output image in pixels.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default.
+
+    Returns:
+        int: The pixels per tile, always one of MIPMAP_LEVELS.
+    """
+    wanted = MIPMAP_LEVELS[0] * args.get("scale", 1)
+    levels = [level for level in MIPMAP_LEVELS if level <= wanted] or [MIPMAP_LEVELS[-1]]
+    size_factor = levels[0]
+
+    if args.get("max_size"):
+        extent = ship_extent(parts, catalog)
+        for level in levels:
+            size_factor = level
+            # the crop adds a margin of 10 pixels at full size on each side
+            if extent * level + 20 * level / MIPMAP_LEVELS[0] <= args["max_size"]:
+                break
+
+    return size_factor
+
 def insert_sprite(background, sprite, x, y, rotation, flipx, size):
     """
     Inserts a sprite onto a background image at the specified position.
@@ -467,7 +758,9 @@ def insert_sprite(background, sprite, x, y, rotation, flipx, size):
     Returns:
         numpy.ndarray: The background image with the sprite inserted, or the original background image if the sprite doesn't fit.
     """
-    sprite = cv2.resize(sprite, size)  # Resize the sprite
+    import cv2
+    if (sprite.shape[1], sprite.shape[0]) != size:
+        sprite = cv2.resize(sprite, size)  # Resize the sprite
 
     sprite = rotate_image(sprite, rotation, flipx)  # Rotate the sprite
 
@@ -497,25 +790,27 @@ def insert_sprite(background, sprite, x, y, rotation, flipx, size):
     
     return background
 
-def sprite_position(part, position):
+def sprite_position(part, position, part_table=None):
     """
     Calculate the offset needed to draw a sprite at a given position.
     
     Args:
         part (dict): The part object containing information about the sprite.
         position (list): The current position of the sprite.
+        part_table (dict, optional): The sizes of the parts, like part_data.parts, see rules_catalog.catalog_tables.
         
     Returns:
         list: The updated position of the sprite.
     """
     # Get the sprite size from the part data
-    sprite_size = part_data.parts[part["ID"]].get("sprite_size")
+    part_table = part_table or part_data.parts
+    sprite_size = part_table[part["ID"]].get("sprite_size")
     
     if sprite_size is None:
         return position
     
     # Get the part size and rotation
-    part_size = part_data.parts[part["ID"]]["size"]
+    part_size = part_table[part["ID"]]["size"]
     part_rotation = part["Rotation"]
     
     # Define problematic parts for each rotation
@@ -631,6 +926,7 @@ def draw_legend(output_filename):
     Args:
         output_filename (str): The filename to save the legend image.
     """
+    import cv2
 
     # Set up parameters
     line_sep = 40
@@ -683,68 +979,39 @@ def draw_legend(output_filename):
     cv2.imwrite(output_filename, img)
 
 
-def draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args):
+def overlay_shapes(parts, data_com, data_cot, ship_orientation, args, catalog=None):
     """
-    Draw a ship using OpenCV.
+    List the center of mass and center of thrust overlays of a ship as shapes.
+    Positions and sizes are in tiles, so every backend can draw them at any resolution.
+
     Args:
-    - parts: a list of ship parts
-    - data_com: the center of mass data
-    - data_cot: the center of thrust data
-    - ship_orientation: the orientation of the ship
-    - output_filename: the filename to save the image
-    - args: additional arguments
+        parts (list): List of parts.
+        data_com (list): The center of mass data.
+        data_cot (list): The center of thrust data.
+        ship_orientation (int): The orientation of the ship.
+        args (dict): Dictionary of arguments.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default.
+
     Returns:
-    - an empty string if the image was successfully saved
+        list: ("circle", center, radius, color) and ("arrow", start, end, width, color, tip_length)
+            tuples in drawing order, colors are BGR lists.
     """
-    # Define constants
-    sprite_square_size = 64
-    size_factor = round(sprite_square_size / 4)
-    square_size = round(size_factor)
-    # Create a blank image
-    img = np.zeros((120 * size_factor, 120 * size_factor, 3), np.uint8)
-    # Rearrange parts to draw top turrets last
-    for i in range(len(parts)):
-        if parts[i]["ID"] in ["cosmoteer.cannon_deck", "cosmoteer.ion_beam_prism"]:
-            parts.append(parts.pop(i))
-    # Draw ship parts
-    for part in parts:
-        x_coord = part["Location"][0] + 60
-        y_coord = part["Location"][1] + 60
-        # Check if part is out of bounds
-        if x_coord < 0 or x_coord > 120 or y_coord < 0 or y_coord > 120:
-            return "error drawing ship: out of bounds\n"
-        size = part_data.parts[part["ID"]]["size"]
-        rotation = part["Rotation"]
-        flipx = part.get("FlipX", 0)
-        x_coord, y_coord = sprite_position(part, [x_coord, y_coord])
-        sprite_directory = "sprites/"
-        sprite_id = part["ID"].replace("cosmoteer.", "")
-        sprite_path = sprite_directory + sprite_id + ".png"
-
-        part_image = cv2.imread(sprite_path, cv2.IMREAD_UNCHANGED)
-
-        scaled_x_coord = round(x_coord * size_factor)
-        scaled_y_coord = round(y_coord * size_factor)
+    part_table, thruster_table = catalog_tables(catalog)
+    shapes = []
+    line_width = 2 / MIPMAP_LEVELS[0]
+    dot_size = 3 / MIPMAP_LEVELS[0]
 
-        sprite_dimensions = (round(part_image.shape[1] / 4), round(part_image.shape[0] / 4))
-        # this does the out image
-        insert_sprite(img, part_image, scaled_x_coord, scaled_y_coord, rotation, flipx, sprite_dimensions)
-    # Darken the image
-    img = img * 0.8
     if args["draw_com"]:
         # Add center of mass
-        cv2.circle(img, (round((data_com[0] + 60) * size_factor), round((data_com[1] + 60) * size_factor)), square_size,
-                   [0, 255, 0], -1)
+        shapes.append(("circle", (data_com[0], data_com[1]), 1, [0, 255, 0]))
         if args["draw_all_com"]:
             # Add center of mass of each part
             for part in parts:
-                x_coord, y_coord = part_center_of_mass(part)
-                cv2.circle(img, (round((x_coord + 60) * size_factor), round((y_coord + 60) * size_factor)), 1,
-                           [0, 255, 0], -1)
+                shapes.append(("circle", part_center_of_mass(part, part_table), 1 / MIPMAP_LEVELS[0], [0, 255, 0]))
     if args["draw_all_cot"]:
         # Add center of thrust of each part
         for part in parts:
-            cots = part_center_of_thrust(part, args["boost"])
+            cots = part_center_of_thrust(part, args["boost"], part_table, thruster_table)
             if cots == 0:
                 continue
             for cot in cots:
@@ -764,49 +1031,175 @@ def draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args
                 if(args["flip_vectors"]):
                     end_point = (vector.x * 2 - end_point[0], vector.y * 2 - end_point[1])
                 # Draw a line
-                cv2.arrowedLine(img, (round((vector.x+60)*size_factor), round((vector.y+60)*size_factor)), (round((end_point[0]+60)*size_factor), round((end_point[1]+60)*size_factor)), [0,0,255], 2, tipLength=0.3)
+                shapes.append(("arrow", (vector.x, vector.y), end_point, line_width, [0,0,255], 0.3))
                 # Also draw a dot at the start of the arrow
-                cv2.circle(img, (round((vector.x+60)*size_factor), round((vector.y+60)*size_factor)), 3, [0,0,255], -1)
-    
+                shapes.append(("circle", (vector.x, vector.y), dot_size, [0,0,255]))
+
     # Draw center of thrust of the ship
     if args["draw_cot"]:
         origin_thrust, thrust_vector, thrust_direction = data_cot
         total_thrust = sum(thrust_direction)
-
-        origin_thrust.append(origin_thrust.pop(ship_orientation))
-        thrust_vector.append(thrust_vector.pop(ship_orientation))
-        thrust_direction.append(thrust_direction.pop(ship_orientation))
         size_of_arrow = 35
 
-        for i in range(8):
+        # the direction of the ship is drawn last, on top of the others
+        order = [i for i in range(8) if i != ship_orientation] + [ship_orientation]
+
+        for i, direction in enumerate(order):
             if not args["draw_all_cot"] and i != 7:
                 continue
-            start = (origin_thrust[i] + 60) * size_factor
-            start = (round(start.x), round(start.y))
-            if thrust_direction[i] == 0:
+            start = origin_thrust[direction]
+            if thrust_direction[direction] == 0:
                 continue
-            thrust = (thrust_vector[i] - origin_thrust[i]) / total_thrust
+            thrust = (thrust_vector[direction] - origin_thrust[direction]) / total_thrust
             #flip the direction of the arrow
             if(args["flip_vectors"]):
                 thrust = thrust * -1
-            end = thrust * size_of_arrow + origin_thrust[i]
-            end = (end + 60) * size_factor
-            end = (round(end.x), round(end.y))
+            end = thrust * size_of_arrow + origin_thrust[direction]
             if i == 7:
                 arrow_color = [0, 200, 0]
             else:
                 arrow_color = [0, 255, 255]
             # draw a line
-            cv2.arrowedLine(img, start, end, arrow_color, 2, tipLength=0.2)
+            shapes.append(("arrow", (start.x, start.y), (end.x, end.y), line_width, arrow_color, 0.2))
             # draw a dot
-            cv2.circle(img, start, 3, arrow_color, -1)
+            shapes.append(("circle", (start.x, start.y), dot_size, arrow_color))
+
+    return shapes
+
+def draw_overlay(img, parts, data_com, data_cot, ship_orientation, args, size_factor, offset, catalog=None):
+    """
+    Draw the center of mass and center of thrust overlays onto an image.
+    A point (x, y) in tiles is drawn at ((x + offset[0]) * size_factor, (y + offset[1]) * size_factor).
+
+    Args:
+        img (numpy.ndarray): The BGR or BGRA image to draw on, modified in place.
+        parts (list): List of parts.
+        data_com (list): The center of mass data.
+        data_cot (list): The center of thrust data.
+        ship_orientation (int): The orientation of the ship.
+        args (dict): Dictionary of arguments.
+        size_factor (float): The pixels per tile of the image.
+        offset (tuple): The offset in tiles added to every point before scaling.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default.
+
+    Returns:
+        numpy.ndarray: The image with the overlays drawn.
+    """
+    import cv2
+    offset_x, offset_y = offset
+
+    def pixel(point):
+        return (round((point[0] + offset_x) * size_factor), round((point[1] + offset_y) * size_factor))
+
+    def color(bgr):
+        # transparent images need an opaque alpha value for the drawn shapes
+        return bgr + [255] if img.shape[2] == 4 else bgr
 
-        origin_thrust.insert(ship_orientation, origin_thrust.pop())
-        thrust_vector.insert(ship_orientation, thrust_vector.pop())
-        thrust_direction.insert(ship_orientation, thrust_direction.pop())
+    for shape in overlay_shapes(parts, data_com, data_cot, ship_orientation, args, catalog):
+        if shape[0] == "circle":
+            _, center, radius, bgr = shape
+            cv2.circle(img, pixel(center), max(1, round(radius * size_factor)), color(bgr), -1)
+        elif shape[0] == "arrow":
+            _, start, end, width, bgr, tip_length = shape
+            cv2.arrowedLine(img, pixel(start), pixel(end), color(bgr), max(1, round(width * size_factor)), tipLength=tip_length)
+
+    return img
+
+def cached_sprite_layer(key):
+    """
+    The sprite layer of a ship drawn before with the same parts and resolution, None when it is not cached.
+    """
+    with sprite_layers_lock:
+        layer = sprite_layers.get(key)
+        if layer is not None:
+            sprite_layers.move_to_end(key)
+    metrics.inc("cosmo_render_cache_total", result="hit" if layer is not None else "miss")
+    return layer
+
+def keep_sprite_layer(key, layer):
+    """
+    Cache the sprite layer of a ship, the least recently used layers go past RENDER_CACHE_BYTES.
+    """
+    global sprite_layers_bytes
+    if layer.nbytes > RENDER_CACHE_BYTES:
+        return
+    with sprite_layers_lock:
+        if key in sprite_layers:
+            return
+        sprite_layers[key] = layer
+        sprite_layers_bytes += layer.nbytes
+        while sprite_layers_bytes > RENDER_CACHE_BYTES:
+            _, dropped = sprite_layers.popitem(last=False)
+            sprite_layers_bytes -= dropped.nbytes
+
+def top_turrets_last(parts):
+    """
+    The parts in drawing order, a new list : the top turrets after every other part, both in their own order.
+    """
+    top_turrets = ["cosmoteer.cannon_deck", "cosmoteer.ion_beam_prism"]
+    return [part for part in parts if part["ID"] not in top_turrets] + [part for part in parts if part["ID"] in top_turrets]
+
+def draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args, catalog=None):
+    """
+    Draw a ship using OpenCV.
+    Args:
+    - parts: a list of ship parts
+    - data_com: the center of mass data
+    - data_cot: the center of thrust data
+    - ship_orientation: the orientation of the ship
+    - output_filename: the filename to save the image
+    - args: additional arguments, "scale" and "max_size" lower the resolution of the render
+    - catalog: the catalog of the rules of the ship, part_data by default, its parts with no sprite are drawn as gray tiles
+    Returns:
+    - an empty string if the image was successfully saved
+    """
+    import cv2
+    # Define constants
+    part_table, _ = catalog_tables(catalog)
+    size_factor = render_size_factor(parts, args, catalog)
+    overlay_scale = size_factor / MIPMAP_LEVELS[0]
+    # Rearrange parts to draw top turrets last, in a list of our own, the parts of the caller keep their order
+    parts = top_turrets_last(parts)
+    # the sprites do not depend on the flags, drawing the same ship again only draws the overlay
+    layer_key = (tuple((part["ID"], *part["Location"], part["Rotation"], bool(part.get("FlipX", 0))) for part in parts), size_factor,
+                 catalog_version(catalog))
+    img = cached_sprite_layer(layer_key)
+    if img is None:
+        # Create a blank image
+        img = np.zeros((120 * size_factor, 120 * size_factor, 3), np.uint8)
+        # Draw ship parts
+        for part in parts:
+            x_coord = part["Location"][0] + 60
+            y_coord = part["Location"][1] + 60
+            # Check if part is out of bounds
+            if x_coord < 0 or x_coord > 120 or y_coord < 0 or y_coord > 120:
+                return "error drawing ship: out of bounds\n"
+            size = part_table[part["ID"]]["size"]
+            rotation = part["Rotation"]
+            flipx = part.get("FlipX", 0)
+            x_coord, y_coord = sprite_position(part, [x_coord, y_coord], part_table)
+
+            part_image = oriented_sprite(part["ID"], size_factor, rotation, flipx)
+            if part_image is None:
+                # a part of newer rules than the sprites folder
+                width, height = (size[1], size[0]) if rotation == 1 or rotation == 3 else size
+                cv2.rectangle(img, (round(x_coord * size_factor), round(y_coord * size_factor)),
+                              (round((x_coord + width) * size_factor) - 1, round((y_coord + height) * size_factor) - 1), MISSING_SPRITE_COLOR, -1)
+                continue
+
+            scaled_x_coord = round(x_coord * size_factor)
+            scaled_y_coord = round(y_coord * size_factor)
+
+            sprite_dimensions = (part_image.shape[1], part_image.shape[0])
+            # this does the out image, the sprite is already rotated
+            insert_sprite(img, part_image, scaled_x_coord, scaled_y_coord, 0, False, sprite_dimensions)
+        keep_sprite_layer(layer_key, img)
+    # Darken the image, a new image so the cached layer stays as it is
+    img = img * 0.8
+    draw_overlay(img, parts, data_com, data_cot, ship_orientation, args, size_factor, (60, 60), catalog)
 
     # Crop the image
-    img = crop(img)
+    img = crop(img, round(10 * overlay_scale))
     # Save the image
     if output_filename != "":
         cv2.imwrite(output_filename, img)
@@ -816,93 +1209,287 @@ def draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args
         img_np = np.asarray(img)
 
         # Encode the NumPy array as a base64 string
-        _, buffer = cv2.imencode('.png', img_np)
+        with metrics.stage("imencode"):
+            _, buffer = cv2.imencode('.png', img_np)
         base64_encoded = base64.b64encode(buffer).decode("utf-8")
         return base64_encoded
 
-def remove_weird_parts(parts):
+def svg_color(bgr):
+    """
+    Convert an OpenCV BGR color list to an SVG color.
+    """
+    return "#{:02x}{:02x}{:02x}".format(bgr[2], bgr[1], bgr[0])
+
+def svg_sprite_symbol(part_id, size_factor):
+    """
+    Build the SVG symbol of a part sprite, embedded as a png at the given resolution.
+
+    Args:
+        part_id (str): The ID of the part.
+        size_factor (int): The pixels per tile of the embedded png, one of MIPMAP_LEVELS.
+
+    Returns:
+        str: The <symbol> element, its id is the part ID without the "cosmoteer." prefix.
+    """
+    import cv2
+    if (part_id, size_factor) in sprite_symbols:
+        return sprite_symbols[(part_id, size_factor)]
+
+    sprite = load_sprite_mipmaps(part_id)[size_factor]
+    width = sprite.shape[1] / size_factor
+    height = sprite.shape[0] / size_factor
+    _, buffer = cv2.imencode('.png', sprite)
+    href = "data:image/png;base64," + base64.b64encode(buffer).decode("utf-8")
+    symbol = (f'<symbol id="{part_id.replace("cosmoteer.", "")}" viewBox="0 0 {width:g} {height:g}">'
+              f'<image width="{width:g}" height="{height:g}" href="{href}"/></symbol>')
+    sprite_symbols[(part_id, size_factor)] = symbol
+    return symbol
+
+def draw_ship_svg(parts, data_com, data_cot, ship_orientation, args, catalog=None):
+    """
+    Draw a ship as an SVG document in tile units.
+    Every sprite is defined once as a symbol and each part is a <use> of it with its
+    rotation and flip as a transform, the overlays are native vector shapes.
+
+    Args:
+        parts (list): List of parts.
+        data_com (list): The center of mass data.
+        data_cot (list): The center of thrust data.
+        ship_orientation (int): The orientation of the ship.
+        args (dict): Dictionary of arguments, "scale" and "max_size" choose the resolution of the embedded sprites.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default, its parts with no
+            sprite are drawn as gray tiles.
+
+    Returns:
+        str: The SVG document.
+    """
+    part_table, _ = catalog_tables(catalog)
+    size_factor = render_size_factor(parts, args, catalog)
+    symbols = {}
+    uses = []
+    min_x = min_y = float("inf")
+    max_x = max_y = float("-inf")
+
+    # Draw top turrets last
+    ordered_parts = top_turrets_last(parts)
+
+    for part in ordered_parts:
+        rotation = part["Rotation"]
+        x_coord, y_coord = sprite_position(part, [part["Location"][0], part["Location"][1]], part_table)
+        if load_sprite_mipmaps(part["ID"]) is None:
+            # a part of newer rules than the sprites folder
+            width, height = part_table[part["ID"]]["size"]
+            if rotation == 1 or rotation == 3:
+                width, height = height, width
+            uses.append(f'<rect x="{x_coord:g}" y="{y_coord:g}" width="{width:g}" height="{height:g}" fill="{svg_color(MISSING_SPRITE_COLOR)}"/>')
+            min_x = min(min_x, x_coord)
+            min_y = min(min_y, y_coord)
+            max_x = max(max_x, x_coord + width)
+            max_y = max(max_y, y_coord + height)
+            continue
+        if part["ID"] not in symbols:
+            symbols[part["ID"]] = svg_sprite_symbol(part["ID"], size_factor)
+        sprite = load_sprite_mipmaps(part["ID"])[size_factor]
+        width = sprite.shape[1] / size_factor
+        height = sprite.shape[0] / size_factor
+
+        # same orientation as rotate_image: flip first, then rotate clockwise
+        transform = ""
+        if rotation == 1:
+            transform = f" translate({height:g},0) rotate(90)"
+        elif rotation == 2:
+            transform = f" translate({width:g},{height:g}) rotate(180)"
+        elif rotation == 3:
+            transform = f" translate(0,{width:g}) rotate(270)"
+        if part.get("FlipX", 0):
+            transform += f" translate({width:g},0) scale(-1,1)"
+        uses.append(f'<use href="#{part["ID"].replace("cosmoteer.", "")}" width="{width:g}" height="{height:g}" '
+                    f'transform="translate({x_coord:g},{y_coord:g}){transform}"/>')
+
+        if rotation == 1 or rotation == 3:
+            width, height = height, width
+        min_x = min(min_x, x_coord)
+        min_y = min(min_y, y_coord)
+        max_x = max(max_x, x_coord + width)
+        max_y = max(max_y, y_coord + height)
+
+    overlays = []
+    for shape in overlay_shapes(parts, data_com, data_cot, ship_orientation, args, catalog):
+        if shape[0] == "circle":
+            _, center, radius, bgr = shape
+            overlays.append(f'<circle cx="{center[0]:g}" cy="{center[1]:g}" r="{radius:g}" fill="{svg_color(bgr)}"/>')
+        elif shape[0] == "arrow":
+            _, start, end, width, bgr, tip_length = shape
+            # arrow head like cv2.arrowedLine: two strokes at 45 degrees, tip_length of the arrow long
+            dx = end[0] - start[0]
+            dy = end[1] - start[1]
+            tip_x = (dx + dy) * tip_length * 0.7071
+            tip_y = (dy - dx) * tip_length * 0.7071
+            overlays.append(f'<path d="M{start[0]:g} {start[1]:g}L{end[0]:g} {end[1]:g}'
+                            f'M{end[0] - tip_x:g} {end[1] - tip_y:g}L{end[0]:g} {end[1]:g}L{end[0] + tip_y:g} {end[1] - tip_x:g}" '
+                            f'stroke="{svg_color(bgr)}" stroke-width="{width:g}" fill="none"/>')
+            min_x = min(min_x, start[0], end[0])
+            min_y = min(min_y, start[1], end[1])
+            max_x = max(max_x, start[0], end[0])
+            max_y = max(max_y, start[1], end[1])
+
+    if not uses:
+        min_x = min_y = 0
+        max_x = max_y = 1
+
+    # square view around the ship with the same margin as crop
+    margin = 10 / MIPMAP_LEVELS[0]
+    side = max(max_x - min_x, max_y - min_y) + 2 * margin
+    view_x = (min_x + max_x - side) / 2
+    view_y = (min_y + max_y - side) / 2
+    pixels = round(side * size_factor)
+
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{view_x:g} {view_y:g} {side:g} {side:g}" '
+            f'width="{pixels}" height="{pixels}">'
+            f'<defs>{"".join(symbols.values())}</defs>'
+            f'<rect x="{view_x:g}" y="{view_y:g}" width="{side:g}" height="{side:g}" fill="#000"/>'
+            f'<g>{"".join(uses)}</g>'
+            # Darken the sprites
+            f'<rect x="{view_x:g}" y="{view_y:g}" width="{side:g}" height="{side:g}" fill="#000" fill-opacity="0.2"/>'
+            f'<g>{"".join(overlays)}</g>'
+            '</svg>')
+
+def ship_bounds(parts, catalog=None):
+    """
+    Calculate the bounding box of the tiles covered by the parts.
+
+    Args:
+        parts (list): List of parts.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default.
+
+    Returns:
+        tuple: The min x, min y, max x and max y of the ship in tiles.
+    """
+    part_table, _ = catalog_tables(catalog)
+    min_x = min_y = float("inf")
+    max_x = max_y = float("-inf")
+    for part in parts:
+        size = part_table[part["ID"]]["size"]
+        if part["Rotation"] == 1 or part["Rotation"] == 3:
+            size = (size[1], size[0])
+        min_x = min(min_x, part["Location"][0])
+        min_y = min(min_y, part["Location"][1])
+        max_x = max(max_x, part["Location"][0] + size[0])
+        max_y = max(max_y, part["Location"][1] + size[1])
+    return min_x, min_y, max_x, max_y
+
+def draw_ship_overlay(parts, data_com, data_cot, ship_orientation, image, args, catalog=None):
+    """
+    Draw only the overlays of a ship, sized to the uploaded ship image.
+    The ship is assumed to be centered in the image and fitted inside OVERLAY_MARGIN,
+    no sprite is drawn so this is much cheaper than draw_ship for big ships.
+
+    Args:
+        parts (list): List of parts.
+        data_com (list): The center of mass data.
+        data_cot (list): The center of thrust data.
+        ship_orientation (int): The orientation of the ship.
+        image (PIL.Image.Image): The uploaded ship image.
+        args (dict): Dictionary of arguments, with "overlay" set to "composite" the overlays
+            are drawn onto the image, otherwise onto a transparent image.
+        catalog (dict, optional): The catalog of the rules of the ship, part_data by default.
+
+    Returns:
+        str: The base64 encoded png.
+    """
+    import cv2
+    width, height = image.size
+    min_x, min_y, max_x, max_y = ship_bounds(parts, catalog)
+    usable = 1 - 2 * OVERLAY_MARGIN
+    size_factor = min(width * usable / max(max_x - min_x, 1), height * usable / max(max_y - min_y, 1))
+    # place the center of the ship in the center of the image
+    offset = (width / 2 / size_factor - (min_x + max_x) / 2, height / 2 / size_factor - (min_y + max_y) / 2)
+
+    if args["overlay"] == "composite":
+        img = cv2.cvtColor(np.array(image.convert("RGBA")), cv2.COLOR_RGBA2BGRA)
+    else:
+        img = np.zeros((height, width, 4), np.uint8)
+
+    draw_overlay(img, parts, data_com, data_cot, ship_orientation, args, size_factor, offset, catalog)
+
+    with metrics.stage("imencode"):
+        _, buffer = cv2.imencode('.png', img)
+    return base64.b64encode(buffer).decode("utf-8")
+
+# classic part IDs : the ID of the part that replaced them, and the FlipX it needs, None keeps the FlipX of the part
+legacy_part_ids = {
+    "cosmoteer.ammo_factory": ("cosmoteer.factory_ammo", None),
+    "cosmoteer.missile_factory_nuke": ("cosmoteer.factory_nuke", None),
+    "cosmoteer.missile_factory_he": ("cosmoteer.factory_he", None),
+    "cosmoteer.electro_bolter": ("cosmoteer.disruptor", None),
+    # the old mirror L and R wedges became one wedge, flipped for R
+    "cosmoteer.structure_1x2_wedge_L": ("cosmoteer.structure_1x2_wedge", 0),
+    "cosmoteer.structure_1x3_wedge_L": ("cosmoteer.structure_1x3_wedge", 0),
+    "cosmoteer.armor_1x2_wedge_L": ("cosmoteer.armor_1x2_wedge", 0),
+    "cosmoteer.armor_1x3_wedge_L": ("cosmoteer.armor_1x3_wedge", 0),
+    "cosmoteer.structure_1x2_wedge_R": ("cosmoteer.structure_1x2_wedge", 1),
+    "cosmoteer.structure_1x3_wedge_R": ("cosmoteer.structure_1x3_wedge", 1),
+    "cosmoteer.armor_1x2_wedge_R": ("cosmoteer.armor_1x2_wedge", 1),
+    "cosmoteer.armor_1x3_wedge_R": ("cosmoteer.armor_1x3_wedge", 1),
+}
+
+def upgrade_part(part):
+    """
+    Copy of a part with its classic part ID replaced with its new ID, the given part is not modified.
+
+    Returns:
+        dict: The upgraded copy, a plain copy for the parts without a classic ID.
+    """
+    part = dict(part)
+    if part["ID"] in legacy_part_ids:
+        part["ID"], flipx = legacy_part_ids[part["ID"]]
+        if flipx is not None:
+            part["FlipX"] = flipx
+    return part
+
+def frozen_part(part, **changes):
     """
-    Removes parts from the given list that are not present in the part_data.
-    Replaces certain old part IDs with their corresponding new part IDs.
-    Returns the updated list of parts and any error messages encountered.
+    Read-only copy of a part, with its location as a tuple and the given fields replaced.
     """
+    return MappingProxyType({**part, "Location": tuple(part["Location"]), **changes})
+
+def remove_weird_parts(parts, catalog=None):
+    """
+    Normalize the parts of a ship into a new table, the given parts are not modified.
+    Parts not present in the catalog of the rules of the ship, part_data for no catalog, become "cosmoteer.UNKNOWN",
+    old part IDs are replaced with their new part IDs.
+
+    Returns:
+        tuple: The normalized parts, a tuple of read-only parts (see frozen_part) that can be shared between threads
+               and caches, and the error messages encountered.
+    """
+    part_table, _ = catalog_tables(catalog)
+
     # Set to store unknown part IDs
     unknown_parts = set()
 
     # Boolean flag to indicate if classic ships are present
     classic = False
 
-    # List to store the updated parts
+    # List to store the normalized parts
     new_parts = []
 
     # Iterate over each part in the given list
     for part in parts:
-        # Check if the part ID is present in part_data
-        if part["ID"] in part_data.parts:
-            new_parts.append(part)
+        # Check if the part ID is present in the catalog
+        if part["ID"] in part_table:
+            new_parts.append(frozen_part(part))
+        elif part["ID"] in legacy_part_ids:
+            new_id, flipx = legacy_part_ids[part["ID"]]
+            if flipx is None:
+                new_parts.append(frozen_part(part, ID=new_id))
+            else:
+                new_parts.append(frozen_part(part, ID=new_id, FlipX=flipx))
+            classic = True
         else:
-            # List of old factory IDs and their corresponding new factory IDs
-            old_part_ids = [
-                "cosmoteer.ammo_factory",
-                "cosmoteer.missile_factory_nuke",
-                "cosmoteer.missile_factory_he",
-                "cosmoteer.electro_bolter"
-            ]
-            new_part_ids = [
-                "cosmoteer.factory_ammo",
-                "cosmoteer.factory_nuke",
-                "cosmoteer.factory_he",
-                "cosmoteer.disruptor"
-            ]
-
-            if part["ID"] in old_part_ids:
-                # Replace the part ID with its corresponding new ID
-                part["ID"] = new_part_ids[old_part_ids.index(part["ID"])]
-                # print(part)
-                new_parts.append(part)
-                classic = True
-                continue
-
-            # List of old mirror L IDs and their corresponding updated IDs
-            old_mirror_L = [
-                "cosmoteer.structure_1x2_wedge_L",
-                "cosmoteer.structure_1x3_wedge_L",
-                "cosmoteer.armor_1x2_wedge_L",
-                "cosmoteer.armor_1x3_wedge_L"
-            ]
-
-            # List of old mirror R IDs and their corresponding updated IDs
-            old_mirror_R = [
-                "cosmoteer.structure_1x2_wedge_R",
-                "cosmoteer.structure_1x3_wedge_R",
-                "cosmoteer.armor_1x2_wedge_R",
-                "cosmoteer.armor_1x3_wedge_R"
-            ]
-
-            # Check if the part ID is in the old_mirror_L list
-            if part["ID"] in old_mirror_L:
-                # Update the part ID and FlipX value
-                part["ID"] = part["ID"][:-2]
-                part["FlipX"] = 0
-                new_parts.append(part)
-                classic = True
-                continue
-
-            # Check if the part ID is in the old_mirror_R list
-            if part["ID"] in old_mirror_R:
-                # Update the part ID and FlipX value
-                part["ID"] = part["ID"][:-2]
-                part["FlipX"] = 1
-                new_parts.append(part)
-                classic = True
-                continue
-
             # Add the unknown part ID to the set
             unknown_parts.add(part["ID"])
-
-            # Update the part ID to "cosmoteer.UNKNOWN"
-            part["ID"] = "cosmoteer.UNKNOWN"
-            new_parts.append(part)
+            new_parts.append(frozen_part(part, ID="cosmoteer.UNKNOWN"))
 
     # Generate the error message for unknown parts
     error_msg = ""
@@ -913,7 +1500,23 @@ def remove_weird_parts(parts):
     if classic:
         error_msg += "classic ships are not supported, com and cot may be wrong\n"
 
-    return new_parts, error_msg
+    return tuple(new_parts), error_msg
+
+# define default arguments
+DEFAULT_ARGS = {
+    "draw": True,
+    "flip_vectors": False,
+    "draw_all_com": False,
+    "draw_all_cot": True,
+    "draw_cot": True,
+    "draw_com": True,
+    "boost": True,
+    "scale": 1,
+    "max_size": None,
+    "overlay": None,
+    "format": "png",
+    "crew_heatmap": False
+}
 
 def com(input_filename, output_filename, args={}):
     """
@@ -925,44 +1528,110 @@ def com(input_filename, output_filename, args={}):
         args (dict, optional): Additional arguments. Defaults to {"boost":True,"draw_all_cot":True,"draw_all_coms":False}.
 
     Returns:
-        tuple: A tuple containing the center of mass, center of thrust, speed, and error message.
-
-    """
-    # define default arguments
-    defaults = {
-        "draw": True,
-        "flip_vectors": False,
-        "draw_all_com": False,
-        "draw_all_cot": True,
-        "draw_cot": True,
-        "draw_com": True,
-        "boost": True
-    }
+        str: The analysis of the ship as a JSON string, see analyze_ship.
 
-    args = {**defaults, **args}
-    
-    # Read ship data and extract part data
-    decoded_data = cosmoteer_save_tools.Ship(input_filename).data
+    """
+    args = {**DEFAULT_ARGS, **args}
+    # label the stage timings of this request with its flags, cache hits and fleets return before analyze_ship
+    metrics.current_args.set(metrics.args_label(args))
+
+    # Read ship data, the payload is only decoded when the ship is not in the library
+    ship = cosmoteer_save_tools.Ship(input_filename, decode=False)
+    # the library stores the analysis without drawing, for both boost states
+    cacheable = ship_library.enabled
+    if cacheable and not args["draw"]:
+        data = ship_library.lookup(ship_library.ship_hash(ship))
+        if data is not None and ship_library.with_boost(data, args["boost"]) is not None:
+            return json.dumps(ship_library.with_boost(data, args["boost"]))
+
+    ship.load_data()
+    if fleet.fleet_ships(ship.data) is not None:
+        # a fleet file, every ship is analyzed on its own
+        return json.dumps(fleet.analyze_fleet(ship.data, args))
+    if cacheable:
+        # a copy that only differs in cosmetic fields shares the analysis
+        structure = ship_library.structure_key(ship)
+        if not args["draw"]:
+            data = ship_library.lookup_structure(structure)
+            if data is not None and ship_library.with_boost(data, args["boost"]) is not None:
+                ship_library.ingest(ship, data, structure)
+                return json.dumps(ship_library.with_boost(data, args["boost"]))
+
+    data = analyze_ship(ship, args, variants_kept=cacheable)
+    if cacheable:
+        ship_library.ingest(ship, data, structure)
+        data = ship_library.with_boost(data, args["boost"])
+
+    # Convert the dictionary to a JSON string
+    json_data = json.dumps(data)
+
+    return json_data
+
+def analyze_ship(ship, args={}, upload=None, variants_kept=False):
+    """
+    Calculate the center of mass, center of thrust, speed, turning, price, tags, connectivity and crew walking distances of a decoded ship.
+
+    Args:
+        ship (Ship): The decoded ship.
+        args (dict, optional): Additional arguments, see the defaults below.
+        upload (callable, optional): Called with the base64 png of the drawing, returns its url. Defaults to upload_image_to_imgbb.
+        variants_kept (bool, optional): Also return the fields that depend on boost for both boost states, in
+            "boost_variants", for ship_library.record.
+
+    Returns:
+        dict: The analysis of the ship, with the url of the drawing in "url_com" when args["draw"] is set,
+              and the url of the crew walking distance heatmap in "url_crew" when args["crew_heatmap"] is set too.
+    """
+    args = {**DEFAULT_ARGS, **args}
+    if upload is None:
+        upload = upload_image_to_imgbb
+    # label the stage timings of this analysis with its flags
+    metrics.current_args.set(metrics.args_label(args))
+
+    decoded_data = ship.data
     parts = decoded_data["Parts"]
     ship_orientation = decoded_data["FlightDirection"]
+    metrics.observe("cosmo_ship_parts", len(parts))
     
-    # Remove weird parts
-    parts, error_message = remove_weird_parts(parts)
+    # the numbers of the parts of the rules the ship was built with
+    catalog = ship_catalog(decoded_data)
 
-    # Calculate center of mass
-    comx, comy, mass = list(center_of_mass(parts))
+    # Remove weird parts, the decoded ship is left as it is so it can be shared
+    parts, error_message = remove_weird_parts(parts, catalog)
+    normalized_data = {**decoded_data, "Parts": parts}
+
+    # Calculate center of mass, the mass, size and thrust of every part in one pass
+    with metrics.stage("center_of_mass"):
+        arrays = physics_arrays(parts, catalog)
+        comx, comy, mass = list(center_of_mass(parts, arrays))
     data_com = [comx, comy, mass]
 
-    # Calculate center of thrust
-    origin_thrust, thrust_vector, thrust_direction = center_of_thrust(parts, args)
-    origin_thrust, thrust_vector, thrust_direction = diagonal_center_of_thrust(origin_thrust, thrust_vector, thrust_direction)
+    # Calculate center of thrust, with and without boost in one pass
+    with metrics.stage("center_of_thrust"):
+        cot_variants = {boost: diagonal_center_of_thrust(*cot) for boost, cot in center_of_thrust_variants(arrays).items()}
+    origin_thrust, thrust_vector, thrust_direction = cot_variants[bool(args["boost"])]
     data_cot = [origin_thrust, thrust_vector, thrust_direction]
 
+    # Calculate moment of inertia and torque
+    with metrics.stage("rotation"):
+        turning = {boost: rotation(arrays, comx, comy, boost) for boost in (True, False)}
+
     ## get tags
-    tags, author = PNGTagExtractor().extract_tags(decoded_data)
+    with metrics.stage("tags"):
+        tags, author = PNGTagExtractor().extract_tags(normalized_data)
 
     ## get crew and price
-    price, crew = calculate_price(decoded_data)
+    with metrics.stage("price"):
+        price, crew = calculate_price(normalized_data, catalog and catalog["prices"])
+
+    ## find sections floating apart and overlapping parts
+    with metrics.stage("connectivity"):
+        sections = connectivity(parts, catalog)
+
+    ## walking distances from the crew quarters to the parts crew works in
+    with metrics.stage("crew"):
+        crew_distance = crew_distances(parts, heatmap=args["draw"] and args["crew_heatmap"], catalog=catalog)
+    crew_tiles = crew_distance.pop("tiles", None)
     
     # direction mapping
     direction_mapping = {
@@ -976,58 +1645,69 @@ def com(input_filename, output_filename, args={}):
         7: "W"
     }
     
-    # Calculate speed in all directions   
-    speeds = {}
-    
-    for ship_orientation, direction_ori in direction_mapping.items():
-        speeds[direction_ori] = top_speed(mass, thrust_direction[ship_orientation])
+    # Calculate speed in all directions, the fields that depend on boost are kept for both boost states
+    variants = {}
+    for boost, (_, _, boost_thrust) in cot_variants.items():
+        speeds = {}
+
+        for ship_orientation, direction_ori in direction_mapping.items():
+            speeds[direction_ori] = top_speed(mass, boost_thrust[ship_orientation])
+
+        variants[ship_library.BOOST_VARIANTS[boost]] = {
+            "top_speed": speeds[direction_mapping[decoded_data["FlightDirection"]]],
+            "all_direction_speeds": speeds,
+            "rotation": turning[boost],
+        }
+    selected = variants[ship_library.BOOST_VARIANTS[bool(args["boost"])]]
     
+    data = {
+        # "url_org": url,
+        "center_of_mass_x": comx,
+        "center_of_mass_y": comy,
+        "total_mass": mass,
+        "top_speed": selected["top_speed"],
+        "crew": crew,
+        "price": price,
+        "tags": tags,
+        "author": author, 
+        "all_direction_speeds": selected["all_direction_speeds"],
+        "rotation": selected["rotation"],
+        "connectivity": sections,
+        "crew_distance": crew_distance,
+    }
+    if variants_kept:
+        data["boost_variants"] = variants
+
     if args["draw"]:
         # API override
         output_filename = "" # we dont store file on the server instead we upload it
         # Draw ship and write to output image
-        base64_output = draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args)
-        url_com = upload_image_to_imgbb(base64_output)
-        
-        data = {
-            # "url_org": url,
-            "url_com": url_com,
-            "center_of_mass_x": comx,
-            "center_of_mass_y": comy,
-            "total_mass": mass,
-            "top_speed": speeds[direction_mapping[decoded_data["FlightDirection"]]],
-            "crew": crew,
-            "price": price,
-            "tags": tags,
-            "author": author, 
-            "all_direction_speeds": speeds,
-
-        }
-        # Convert the dictionary to a JSON string
-        json_data = json.dumps(data)
-        
-        return json_data
-        # return data_com, data_cot, speeds[direction_mapping[decoded_data["FlightDirection"]]], error_message, url_com
-    else:
-        # return data_com, data_cot, speeds[direction_mapping[decoded_data["FlightDirection"]]], error_message
-        data = {
-            # "url_org": url,
-            # "url_com": url_com,
-            "center_of_mass_x": comx,
-            "center_of_mass_y": comy,
-            "total_mass": mass,
-            "top_speed": speeds[direction_mapping[decoded_data["FlightDirection"]]],
-            "crew": crew,
-            "price": price,
-            "tags": tags,
-            "author": author, 
-            "all_direction_speeds": speeds,
-
-        }
-        # Convert the dictionary to a JSON string
-        json_data = json.dumps(data)
-        
-        return json_data
+        svg = None
+        url_com = None
+        if args["format"] == "svg":
+            # vector output is returned directly instead of being uploaded
+            with metrics.stage("draw_ship"):
+                svg = draw_ship_svg(parts, data_com, data_cot, ship_orientation, args, catalog)
+        else:
+            with metrics.stage("draw_ship"):
+                if args["overlay"]:
+                    # reuse the uploaded picture of the ship instead of drawing the sprites
+                    base64_output = draw_ship_overlay(parts, data_com, data_cot, ship_orientation, ship.image, args, catalog)
+                else:
+                    base64_output = draw_ship(parts, data_com, data_cot, ship_orientation, output_filename, args, catalog)
+            with metrics.stage("upload"):
+                url_com = upload(base64_output)
+
+        data = {"url_com": url_com, **data}
+        if crew_tiles is not None:
+            with metrics.stage("draw_crew_heatmap"):
+                base64_output = draw_crew_heatmap(parts, crew_tiles, catalog=catalog)
+            with metrics.stage("upload"):
+                data["url_crew"] = upload(base64_output)
+        if svg is not None:
+            data["svg"] = svg
+
+    return data
 
 # if(__name__ == "__main__"):
 #     com(SHIP, "out.png", {"boost":BOOST,"draw_all_cot":DRAW_ALL_COT,"draw_all_com":DRAW_ALL_COM,"draw_cot":DRAW_COT,"draw_com":DRAW_COM})
@@ -0,0 +1,174 @@
+# structural connectivity of a ship : which parts hold together on the tile grid
+# the parts are rasterized into a sparse occupancy grid, the sorted keys of their tiles, so parts far apart cost nothing,
+# two parts are connected when two of their tiles share an edge,
+# the sections of the ship are the connected components, found with a vectorized union-find over the pairs of touching parts
+# a ship in more than one section has parts floating apart, its com and speeds treat it as if it held together
+# tiles covered by more than one part are reported as overlaps, and connect the parts covering them
+# numpy does all the work per tile and per pair, the cost is about linear in the tiles
+# the sizes and masses come from the catalog of the rules of the ship, see rules_catalog.py, part_data by default
+# usage : connectivity(Ship(url).data["Parts"])
+
+import numpy as np
+
+import part_data
+from rules_catalog import catalog_tables
+
+MAX_COMPONENTS = 20 # sections listed in the result, the heaviest first, "sections" counts all of them
+MAX_OVERLAPS = 100 # pairs of overlapping parts listed in the result
+
+def part_boxes(parts, part_table=None):
+    """
+    Location and size on the tile grid of every part, after rotation, part_table gives the sizes of the parts,
+    part_data.parts by default.
+
+    Returns:
+        tuple: The x, y, width and height of the parts as int arrays.
+    """
+    part_table = part_table or part_data.parts
+    sizes = np.array([part_table[part["ID"]]["size"] for part in parts], dtype=np.int64).reshape(-1, 2)
+    locations = np.array([part["Location"] for part in parts], dtype=np.int64).reshape(-1, 2)
+    turned = np.array([part["Rotation"] in (1, 3) for part in parts], dtype=bool)
+    width = np.where(turned, sizes[:, 1], sizes[:, 0])
+    height = np.where(turned, sizes[:, 0], sizes[:, 1])
+    return locations[:, 0], locations[:, 1], width, height
+
+def part_tile_arrays(x, y, width, height):
+    """
+    Every tile of every part.
+
+    Returns:
+        tuple: The index of the part, the x and the y of each tile.
+    """
+    areas = width * height
+    index = np.repeat(np.arange(len(x)), areas)
+    # position of each tile inside its part, row by row
+    offset = np.arange(areas.sum()) - np.repeat(np.cumsum(areas) - areas, areas)
+    return index, x[index] + offset % width[index], y[index] + offset // width[index]
+
+def tile_keys(tile_x, tile_y):
+    """
+    One int64 per tile, ordered by x then y, the tile below is the key + 1 and the tile on the right the key + 2^32.
+    """
+    return (tile_x + 2**31) * 2**32 + (tile_y + 2**31)
+
+def touching_pairs(keys, index, count):
+    """
+    Pairs of different parts with tiles sharing an edge, each pair once.
+
+    Args:
+        keys (np.ndarray): The sorted distinct keys of the occupied tiles, see tile_keys.
+        index (np.ndarray): Index of a part covering each of these tiles.
+        count (int): The number of parts.
+
+    Returns:
+        tuple: Two int arrays, the first and the second part of each pair.
+    """
+    first, second = [], []
+    for step in (1, 2**32):
+        neighbours = np.searchsorted(keys, keys + step)
+        found = neighbours < len(keys)
+        found[found] = keys[neighbours[found]] == keys[found] + step
+        touching = found & (index != index[np.where(found, neighbours, 0)])
+        first.append(index[touching])
+        second.append(index[neighbours[touching]])
+    return unique_pairs(np.concatenate(first), np.concatenate(second), count)
+
+def unique_pairs(first, second, count):
+    """
+    The distinct unordered pairs among first[i] - second[i], for indices below count, sorted.
+    """
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    pairs = np.unique(low * count + high)
+    return pairs // count, pairs % count
+
+def union_find(count, first, second):
+    """
+    Connected components of count nodes joined by the edges first[i] - second[i].
+    Every round hooks the root of each edge with two different roots under the smaller root, then compresses the paths,
+    all with numpy, a few rounds join the parts of a ship.
+
+    Returns:
+        np.ndarray: The root of the component of every node, the smallest node of the component.
+    """
+    parent = np.arange(count)
+    while True:
+        # path compression, every node ends up pointing at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        root_first, root_second = parent[first], parent[second]
+        apart = root_first != root_second
+        if not apart.any():
+            return parent
+        # union, roots only point at smaller roots so no cycle can form
+        np.minimum.at(parent, np.maximum(root_first[apart], root_second[apart]), np.minimum(root_first[apart], root_second[apart]))
+
+def connectivity(parts, catalog=None):
+    """
+    Sections and overlapping parts of a ship.
+
+    Args:
+        parts (list): The parts of the ship, parts with unknown IDs are left out.
+        catalog (dict, optional): The catalog of the rules of the ship, see rules_catalog.ship_catalog, part_data by default.
+
+    Returns:
+        dict: "connected", whether the ship is in one piece, "sections", the number of connected components,
+              "components", the heaviest sections with their number of parts, mass, center of mass and bounding box
+              [min_x, min_y, max_x, max_y] in tiles, "overlapping_tiles", the number of tiles covered by more than one
+              part, and "overlapping_parts", the first pairs of parts sharing a tile.
+    """
+    part_table, _ = catalog_tables(catalog)
+    parts = [part for part in parts if part["ID"] in part_table]
+    if not parts:
+        return {"connected": True, "sections": 0, "components": [], "overlapping_tiles": 0, "overlapping_parts": []}
+
+    x, y, width, height = part_boxes(parts, part_table)
+    index, tile_x, tile_y = part_tile_arrays(x, y, width, height)
+    keys = tile_keys(tile_x, tile_y)
+    order = np.lexsort((index, keys))
+    keys, index = keys[order], index[order]
+
+    # every part on a tile covered more than once is paired with the next part on the same tile
+    same_tile = keys[1:] == keys[:-1]
+    overlapping = same_tile & (index[1:] != index[:-1])
+    overlap_first, overlap_second = unique_pairs(index[:-1][overlapping], index[1:][overlapping], len(parts))
+
+    # the grid keeps one part per tile, the overlapping parts are joined by their pairs
+    first_on_tile = np.concatenate([[True], ~same_tile])
+    touching_first, touching_second = touching_pairs(keys[first_on_tile], index[first_on_tile], len(parts))
+    roots = union_find(len(parts), np.concatenate([touching_first, overlap_first]), np.concatenate([touching_second, overlap_second]))
+    _, component = np.unique(roots, return_inverse=True)
+
+    mass = np.array([part_table[part["ID"]]["mass"] for part in parts], dtype=float)
+    sections = int(component.max()) + 1
+    component_mass = np.bincount(component, weights=mass, minlength=sections)
+    component_parts = np.bincount(component, minlength=sections)
+    com_x = np.bincount(component, weights=mass * (x + width / 2), minlength=sections)
+    com_y = np.bincount(component, weights=mass * (y + height / 2), minlength=sections)
+    box_min_x = np.full(sections, np.iinfo(np.int64).max)
+    box_min_y = np.full(sections, np.iinfo(np.int64).max)
+    box_max_x = np.full(sections, np.iinfo(np.int64).min)
+    box_max_y = np.full(sections, np.iinfo(np.int64).min)
+    np.minimum.at(box_min_x, component, x)
+    np.minimum.at(box_min_y, component, y)
+    np.maximum.at(box_max_x, component, x + width - 1)
+    np.maximum.at(box_max_y, component, y + height - 1)
+
+    components = []
+    for i in np.argsort(-component_mass, kind="stable")[:MAX_COMPONENTS]:
+        components.append({
+            "parts": int(component_parts[i]),
+            "mass": float(component_mass[i]),
+            "center_of_mass": [float(com_x[i] / component_mass[i]), float(com_y[i] / component_mass[i])] if component_mass[i] else None,
+            "bbox": [int(box_min_x[i]), int(box_min_y[i]), int(box_max_x[i]), int(box_max_y[i])],
+        })
+    as_part = lambda i: {"ID": parts[i]["ID"], "Location": list(parts[i]["Location"])}
+    return {
+        "connected": sections == 1,
+        "sections": sections,
+        "components": components,
+        "overlapping_tiles": len(np.unique(keys[1:][same_tile])),
+        "overlapping_parts": [[as_part(a), as_part(b)] for a, b in zip(overlap_first[:MAX_OVERLAPS].tolist(), overlap_second[:MAX_OVERLAPS].tolist())],
+    }
@@ -26,8 +26,12 @@ import enum
 import io
 from io import BytesIO
 import base64
+import os
 import re
-import requests
+import sys
+import zlib
+import metrics
+# requests is imported when a ship is read from a url
 
 
 class OBNodeType(enum.Enum):
@@ -38,40 +42,249 @@ class OBNodeType(enum.Enum):
     Link = 4
     Null = 5
 
+# node types and value formats, looked up once instead of once per node
+UNSET = OBNodeType.Unset.value
+DATA = OBNodeType.Data.value
+CHILD_LIST = OBNodeType.ChildList.value
+CHILD_MAP = OBNodeType.ChildMap.value
+LINK = OBNodeType.Link.value
+NULL = OBNodeType.Null.value
+INT = struct.Struct("<i")
+FLOAT = struct.Struct("<f")
+INT_PAIR = struct.Struct("<ll")
+
+# limits of what a ship may cost to read, a small png can hold a payload that inflates to gigabytes
+# or a tree nested deep enough to overflow the stack, set the environment variables of the same name to change them
+MAX_IMAGE_PIXELS = int(os.getenv("max_image_pixels", 16 * 2**20))
+MAX_SHIP_BYTES = int(os.getenv("max_ship_bytes", 16 * 2**20)) # decompressed, a 20000 part ship is about 1.5MB
+MAX_SHIP_NODES = int(os.getenv("max_ship_nodes", 1000000)) # a part is about 5 nodes
+MAX_SHIP_DEPTH = int(os.getenv("max_ship_depth", 64))
+INFLATE_CHUNK = 64 * 1024
+
+class ShipTooLarge(ValueError):
+    """
+    A ship went over one of the limits above, limit is "pixels", "bytes", "nodes" or "depth".
+    """
+    def __init__(self, message, limit):
+        super().__init__(message)
+        self.limit = limit
+
+class InflateStream():
+    """
+    Read-only file over a gzip payload, inflated one chunk at a time as the decoder reads it.
+
+    Raises ShipTooLarge as soon as more than max_size bytes came out, without inflating the rest.
+    """
+    def __init__(self, compressed, max_size=MAX_SHIP_BYTES):
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.input = compressed
+        self.max_size = max_size
+        self.size = 0
+        self.chunk = b""
+        self.position = 0
+
+    def inflate(self) -> bytes:
+        # next chunk of the payload, b"" at its end
+        if self.inflater.eof:
+            return b""
+        chunk = self.inflater.decompress(self.input, INFLATE_CHUNK)
+        self.input = self.inflater.unconsumed_tail
+        if not chunk and not self.input and not self.inflater.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise ShipTooLarge(f"the ship is more than {self.max_size} bytes decompressed", "bytes")
+        return chunk
+
+    def read(self, size) -> bytes:
+        end = self.position + size
+        if end <= len(self.chunk):
+            data = self.chunk[self.position:end]
+            self.position = end
+            return data
+
+        pieces = [self.chunk[self.position:]]
+        needed = size - len(pieces[0])
+        self.chunk, self.position = b"", 0
+        while needed > 0:
+            chunk = self.inflate()
+            if not chunk:
+                break
+            if len(chunk) > needed:
+                pieces.append(chunk[:needed])
+                self.chunk, self.position = chunk, needed
+                break
+            pieces.append(chunk)
+            needed -= len(chunk)
+        return b"".join(pieces)
+
+def pixel_array(image: Image.Image) -> np.ndarray:
+    """
+    The pixels of an image as a (pixels, channels) uint8 array, row by row.
+    """
+    return np.array(image).reshape(image.size[0] * image.size[1], -1)
+
 class Ship():
-    def __init__(self, image_path) -> None:
+    def __init__(self, image_path, decode=True, lean=False) -> None:
+        """
+        Read a ship from a png file, base64 string, url or png bytes.
+        With decode=False only the compressed payload is read, call load_data() to decode it later.
+        With lean=True only the png and the decoded data are kept, see drop_buffers().
+        """
         self.image_path = image_path
+        self.data = None
+        self.lean = lean
         
-        # read image, base64 image or url
-        input_type = check_input_type(image_path)
+        # read image, base64 image, url or png bytes that were already fetched
+        input_type = "bytes" if isinstance(image_path, bytes) else check_input_type(image_path)
         # print(input_type)
-        if input_type == "base64":
-            self.image = Image.open(BytesIO(base64.b64decode(image_path))) # read base64 string
-        elif input_type == "file_path":
-            self.image = Image.open(image_path)
-        elif input_type == "url":
-            response = requests.get(image_path)
-            self.image = Image.open(BytesIO(response.content))
-        
-        self.image_data = np.array(self.image.getdata())
-
-        self.compressed_image_data = self.read_bytes()
+        with metrics.stage("fetch"):
+            if input_type == "bytes":
+                png_data = image_path
+            elif input_type == "base64":
+                png_data = base64.b64decode(image_path) # read base64 string
+            elif input_type == "file_path":
+                with open(image_path, "rb") as f:
+                    png_data = f.read()
+            elif input_type == "url":
+                import requests
+                response = requests.get(image_path)
+                png_data = response.content
+        metrics.observe("cosmo_payload_bytes", len(png_data), kind="png")
+        self.png_data = png_data
+        if lean and input_type == "base64":
+            # the base64 string would be a second copy of the png
+            self.image_path = None
+
+        self.read_png()
+        metrics.observe("cosmo_payload_bytes", len(self.compressed_image_data), kind="compressed")
+        if lean:
+            self.drop_buffers()
+
+        if decode:
+            self.load_data()
+
+    def read_png(self) -> None:
+        """
+        Read the picture, its pixels and the compressed payload from the png.
+        """
+        with metrics.stage("image_open"):
+            self.image = Image.open(BytesIO(self.png_data))
+            # only the header is read so far, refuse huge pictures before their pixels are
+            if self.image.size[0] * self.image.size[1] > MAX_IMAGE_PIXELS:
+                metrics.inc("cosmo_rejected_ships_total", limit="pixels")
+                raise ShipTooLarge(f"the image is more than {MAX_IMAGE_PIXELS} pixels", "pixels")
+            self.image_data = pixel_array(self.image)
+
+        with metrics.stage("read_bytes"):
+            self.compressed_image_data = self.read_bytes()
         
+        self.version = 1
         if self.compressed_image_data[:9] == b'COSMOSHIP':
             self.compressed_image_data = self.compressed_image_data[9:]
             self.version = 2
 
-        self.buffer = io.BytesIO(gzip.decompress(self.compressed_image_data))
-        self.data = self.decode()
+    def drop_buffers(self) -> None:
+        """
+        Forget what can be read again from the png : the picture and its pixels, and the compressed payload once
+        the data is decoded. They are read again from the png the next time they are used, by write() for example,
+        and a lean ship forgets them again right after.
+        """
+        if self.__dict__.get("png_data") is None:
+            return
+        for name in ("image", "image_data", "in_image"):
+            self.__dict__.pop(name, None)
+        if self.data is not None:
+            self.__dict__.pop("compressed_image_data", None)
+
+    def __getattr__(self, name):
+        # only called for missing attributes, the buffers forgotten by drop_buffers()
+        if name in ("image", "image_data", "compressed_image_data") and self.__dict__.get("png_data") is not None:
+            self.read_png()
+            value = self.__dict__[name]
+            if self.lean:
+                self.drop_buffers()
+            return value
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def memory_size(self) -> dict:
+        """
+        Bytes held by the ship, estimated.
+
+        Returns:
+            dict: Bytes of the "png", the "picture" (the PIL image and the pixel arrays), the "compressed" payload,
+                  the decoded "data" tree and their "total".
+        """
+        attributes = self.__dict__
+        picture = 0
+        if "image" in attributes:
+            image = attributes["image"]
+            picture += image.size[0] * image.size[1] * len(image.getbands())
+        for name in ("image_data", "in_image"):
+            if attributes.get(name) is not None:
+                picture += attributes[name].nbytes
+        sizes = {
+            "png": len(attributes.get("png_data") or b""),
+            "picture": picture,
+            "compressed": len(attributes.get("compressed_image_data") or b""),
+            "data": tree_size(self.data),
+        }
+        sizes["total"] = sum(sizes.values())
+        return sizes
+
+    def load_data(self) -> dict:
+        """
+        Decompress and decode the payload into self.data, the payload is inflated as it is decoded.
+
+        Raises:
+            ShipTooLarge: If the payload goes over MAX_SHIP_BYTES, MAX_SHIP_NODES or MAX_SHIP_DEPTH.
+        """
+        self.buffer = InflateStream(self.compressed_image_data)
+        try:
+            with metrics.stage("decode"):
+                self.data = self.decode()
+        except ShipTooLarge as e:
+            metrics.inc("cosmo_rejected_ships_total", limit=e.limit)
+            raise
+        metrics.observe("cosmo_payload_bytes", self.buffer.size, kind="decompressed")
+        # the stream holds the last inflated chunk
+        self.buffer = None
+        if self.lean:
+            self.drop_buffers()
+        return self.data
+
+    @classmethod
+    def from_data(cls, data, image: Image.Image = None) -> "Ship":
+        """
+        Build a ship from decoded data, ready to be written into a png with write().
+        image is the picture the data is hidden in, when None a gray square just big enough is used.
+        """
+        ship = cls.__new__(cls)
+        ship.image_path = None
+        ship.png_data = None
+        ship.lean = False
+        ship.version = 2
+        ship.data = data
+        if image is None:
+            length = len(b'COSMOSHIP') + len(gzip.compress(ship.encode(data), 6)) + 4
+            side = max(16, int(np.ceil(np.sqrt(length * 8 / 3))))
+            image = Image.new("RGBA", (side, side), (40, 40, 40, 255))
+        ship.image = image.convert("RGBA")
+        ship.image_data = pixel_array(ship.image)
+        return ship
 
     def write(self, new_image: Image.Image = None) -> Image.Image:
+        if self.lean and new_image is None:
+            # one read of the png for both the picture and its pixels, they are forgotten again below
+            self.read_png()
         if new_image is None:
+            new_image = self.image
             self.in_image = self.image_data.copy()
         else:
-            self.in_image = np.array(new_image.getdata())
+            self.in_image = pixel_array(new_image)
 
         data = self.encode(self.data)
-        compressed = gzip.compress(data, 6)
+        compressed = gzip.compress(data, 6, mtime=0)
 
         if self.version == 2:
             b_compressed = bytearray(b'COSMOSHIP')
@@ -79,33 +292,27 @@ class Ship():
             compressed = bytes(b_compressed)
 
         self.write_bytes(compressed)
-        return Image.fromarray(self.in_image.reshape((*self.image.size, 4)).astype(np.uint8))
+        width, height = new_image.size
+        written = Image.fromarray(self.in_image.reshape((height, width, -1)))
+        if self.lean:
+            self.drop_buffers()
+        return written
 
 
     def read_bytes(self) -> bytes:
-        data = [byte for pixel in self.image_data for byte in pixel[:3]]
-        length = int.from_bytes(bytes([self.get_byte(i, data) for i in range(4)]), "big")
-        return bytes([self.get_byte(i + 4, data) for i in range(length)])
-
-    def get_byte(self, offset, data) -> int:
-        out_byte = 0
-        for bits_right in range(8):
-            out_byte |= (data[offset * 8 + bits_right] & 1) << bits_right
-        return out_byte
+        # one bit of the payload in the lowest bit of every red, green and blue value, low bits first
+        channels = self.image_data[:, :3].reshape(-1)
+        length = int.from_bytes(np.packbits(channels[:32] & 1, bitorder="little").tobytes(), "big")
+        return np.packbits(channels[32:32 + length * 8] & 1, bitorder="little").tobytes()
 
     def write_bytes(self, in_bytes) -> None:
         in_bytes = len(in_bytes).to_bytes(4, "big") + in_bytes
-        for offset, byte in enumerate(in_bytes):
-            self.set_byte(offset, byte)
-
-    def set_byte(self, offset, byte) -> None:
-        for bits_right in range(8):
-            image_offset = offset * 8 + bits_right
-            rgb = image_offset % 3
-            pixel_offset = (offset * 8 + bits_right) // 3
-            mask = (1 << 8) - 2
-            bit = (byte >> bits_right) & 1
-            self.in_image[pixel_offset][rgb] = (self.in_image[pixel_offset][rgb] & mask) | bit
+        bits = np.unpackbits(np.frombuffer(in_bytes, dtype=np.uint8), bitorder="little")
+        channels = self.in_image[:, :3].reshape(-1)
+        if len(bits) > len(channels):
+            raise ValueError(f"the image is too small for the ship, {len(in_bytes)} bytes need {len(bits) // 3 + 1} pixels")
+        channels[:len(bits)] = (channels[:len(bits)] & 0xFE) | bits
+        self.in_image[:, :3] = channels.reshape(-1, 3)
 
     def read_varint(self, file: io.BytesIO) -> int:
         byte = file.read(1)[0]
@@ -173,39 +380,44 @@ class Ship():
 
         num = len(text)
         while (num >= 0x80):
-            byte_data.append(num | 0x80)
+            byte_data.append((num & 0x7F) | 0x80)
             num = num >> 7
         
         byte_data.append(num)
         byte_data.extend(text.encode('latin1'))
         return byte_data       
 
-    def is_2int_list(self, data):
-        return isinstance(data, list) and len(data) == 2 and all([isinstance(x, int) for x in data])
+    def decode(self, depth=0):
+        if depth == 0:
+            self.nodes = 0
+        self.nodes += 1
+        if self.nodes > MAX_SHIP_NODES:
+            raise ShipTooLarge(f"the ship has more than {MAX_SHIP_NODES} nodes", "nodes")
+        if depth > MAX_SHIP_DEPTH:
+            raise ShipTooLarge(f"the ship is nested more than {MAX_SHIP_DEPTH} levels deep", "depth")
 
-    def decode(self):
         _type = self.buffer.read(1)[0]
-        if _type == OBNodeType.Unset.value:
+        if _type == UNSET:
             return "Unset"
 
-        elif _type == OBNodeType.Data.value:
+        elif _type == DATA:
             size = self.read_varint(self.buffer)
             return self.buffer.read(size)
 
-        elif _type == OBNodeType.ChildList.value:
+        elif _type == CHILD_LIST:
             count = self.read_varint(self.buffer)
             lst = []
             for _ in range(count):
-                elem = self.decode()
+                elem = self.decode(depth + 1)
                 lst.append(elem)
             return lst
 
-        elif _type == OBNodeType.ChildMap.value:
+        elif _type == CHILD_MAP:
             count = self.read_varint(self.buffer)
             d = {}
             for _ in range(count):
                 key = self.read_string(self.buffer)
-                value = self.decode()
+                value = self.decode(depth + 1)
                 if isinstance(value, bytes):
                     if (
                         key in ('Rotation', 'Orientation', 'Version', 'FlightDirection', 'FormationOrder', 'Key', 'Max', 'Min', "ID")
@@ -239,73 +451,81 @@ class Ship():
 
                 d[key] = value
             return d
-        elif _type == OBNodeType.Link.value:
+        elif _type == LINK:
             subtype = self.buffer.read(1)[0]
             if subtype == 255:
                 _id = self.read_varint(self.buffer)
                 return {'_type': 'link', '_id': _id}
             elif subtype == 254:
                 return None
-        if _type == OBNodeType.Null.value:
+        if _type == NULL:
             return None
         else:
             raise TypeError(f'Unexpected type {_type}')
 
     def encode(self, data_node, byte_data: bytearray=None) -> bytearray:
+        """
+        Encode data the way decode() reads it, the whole tree is appended to one bytearray.
+        """
         if byte_data is None:
             byte_data = bytearray()
-
-        if data_node == "Unset":
-            byte_data.append(OBNodeType.Unset.value)
-            return byte_data
-        
-        elif isinstance(data_node, (str, int, float, bool, tuple, bytes)) or self.is_2int_list(data_node):
-            byte_data.append(OBNodeType.Data.value)
-            
-            if isinstance(data_node, str):
-                string_data = self.write_string(data_node)
-                byte_data = self.write_varint(len(string_data), byte_data)
-                byte_data.extend(string_data)
-                return byte_data
-            elif isinstance(data_node, bool):
-                data = bytearray([data_node])
-            elif isinstance(data_node, int):
-                data = struct.pack("<i", data_node)
-            elif isinstance(data_node, float):
-                data = struct.pack("<f", data_node)
-            elif isinstance(data_node, tuple):
-                data = bytearray.fromhex("".join(data_node))
-            elif isinstance(data_node, list):
-                data = struct.pack("<ll", *data_node)
-            else: 
-                data = data_node
-
-            byte_data = self.write_varint(len(data), byte_data)
-            byte_data.extend(data)
-            return byte_data
-
-        elif isinstance(data_node, list):
-            byte_data.append(OBNodeType.ChildList.value)
-            byte_data = self.write_varint(len(data_node), byte_data)
-            for x in data_node:
-                byte_data = self.encode(x, byte_data)
-            return byte_data
-
-        elif isinstance(data_node, dict):
-            byte_data.append(OBNodeType.ChildMap.value)
-            byte_data = self.write_varint(len(data_node), byte_data)
-
-            for key in data_node.keys():
-                byte_data = self.write_string(key, byte_data)
-                byte_data = self.encode(data_node[key], byte_data)
-            return byte_data
-
-        elif data_node is None:
-            byte_data.append(OBNodeType.Null.value)
-            return byte_data
-        
-        else:
-            raise TypeError(f"Unknown datatype: {type(data_node)}")
+        append = byte_data.append
+        extend = byte_data.extend
+        write_varint = self.write_varint
+
+        def write_data(data):
+            append(DATA)
+            if len(data) < 128:
+                append(len(data) << 1)
+            else:
+                write_varint(len(data), byte_data)
+            extend(data)
+
+        def write_string(text):
+            num = len(text)
+            while num >= 0x80:
+                append((num & 0x7F) | 0x80)
+                num >>= 7
+            append(num)
+            extend(text.encode('latin1'))
+
+        def write_node(node):
+            if isinstance(node, dict):
+                append(CHILD_MAP)
+                write_varint(len(node), byte_data)
+                for key, value in node.items():
+                    write_string(key)
+                    write_node(value)
+            elif isinstance(node, list):
+                if len(node) == 2 and isinstance(node[0], int) and isinstance(node[1], int):
+                    write_data(INT_PAIR.pack(*node))
+                    return
+                append(CHILD_LIST)
+                write_varint(len(node), byte_data)
+                for value in node:
+                    write_node(value)
+            elif isinstance(node, str):
+                if node == "Unset":
+                    append(UNSET)
+                else:
+                    write_data(self.write_string(node))
+            elif isinstance(node, bool):
+                write_data(bytes([node]))
+            elif isinstance(node, int):
+                write_data(INT.pack(node))
+            elif isinstance(node, float):
+                write_data(FLOAT.pack(node))
+            elif isinstance(node, tuple):
+                write_data(bytes.fromhex("".join(node)))
+            elif isinstance(node, bytes):
+                write_data(node)
+            elif node is None:
+                append(NULL)
+            else:
+                raise TypeError(f"Unknown datatype: {type(node)}")
+
+        write_node(data_node)
+        return byte_data
 
 if(JSON_ON):
     class JSONEncoderWithBytes(json.JSONEncoder):
@@ -315,6 +535,26 @@ if(JSON_ON):
                 # wrapped in a special dictionary:
                 return {'__bytes__': obj.decode('latin1')}
             return json.JSONEncoder.default(self, obj)
+def tree_size(node) -> int:
+    """
+    Bytes of a decoded tree, every object counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        size += sys.getsizeof(node)
+        if isinstance(node, dict):
+            stack.extend(node.keys())
+            stack.extend(node.values())
+        elif isinstance(node, (list, tuple)):
+            stack.extend(node)
+    return size
+
 def check_input_type(input_value):
     # Check if it's a valid base64 string
     try:
@@ -0,0 +1,182 @@
+# crew walking distances : how many tiles the crew walks from the crew quarters to the parts they work in
+# every part except armor is walkable, crew walks from tile to tile across edges (doors and part walls are not modeled)
+# a multi-source breadth first search starts from every tile of every crew quarters at once, one numpy step per
+# distance, the tiles are the sparse occupancy grid of connectivity.py, so the work is linear in the tiles
+# the distance to a part is the distance to its nearest tile, the parts are summed up per category
+# draw_crew_heatmap() colors every tile by its distance, blue is close and red is far
+# the sizes come from the catalog of the rules of the ship, see rules_catalog.py, part_data by default
+# usage : crew_distances(Ship(url).data["Parts"])
+
+import base64
+
+import numpy as np
+
+from connectivity import part_boxes, part_tile_arrays, tile_keys
+from rules_catalog import catalog_tables
+
+CREW_QUARTERS = ("cosmoteer.crew_quarters_small", "cosmoteer.crew_quarters_med")
+# parts crew can not walk through
+BLOCKING = ("cosmoteer.armor",)
+# categories of the parts crew works in, by the start of their ID, parts of no category are not reported
+CATEGORIES = {
+    "weapons": ("cosmoteer.cannon", "cosmoteer.laser_blaster", "cosmoteer.railgun", "cosmoteer.missile_launcher",
+                "cosmoteer.ion_beam", "cosmoteer.disruptor", "cosmoteer.flak_cannon", "cosmoteer.point_defense",
+                "cosmoteer.mining_laser", "cosmoteer.tractor_beam", "cosmoteer.explosive_charge"),
+    "thrusters": ("cosmoteer.thruster", "cosmoteer.engine_room"),
+    "power": ("cosmoteer.reactor", "cosmoteer.power_storage"),
+    "shields": ("cosmoteer.shield_gen",),
+    "factories": ("cosmoteer.factory", "cosmoteer.resource_collector"),
+    "storage": ("cosmoteer.storage",),
+    "control": ("cosmoteer.control_room", "cosmoteer.hyperdrive", "cosmoteer.sensor_array", "cosmoteer.fire_extinguisher"),
+}
+# (dx, dy) of the four neighbours of a tile, see tile_keys
+NEIGHBOUR_STEPS = (1, -1, 2**32, -2**32)
+HEATMAP_TILE_SIZE = 8 # pixels per tile of the heatmap, less for big ships
+HEATMAP_MAX_SIZE = 2048 # pixels of the longest side of the heatmap
+BLOCKING_COLOR = (90, 90, 90) # BGR
+UNREACHABLE_COLOR = (40, 40, 40)
+BACKGROUND_COLOR = (20, 20, 20)
+
+def part_category(part_id):
+    """
+    Category of a part, None for parts crew does not work in.
+    """
+    for category, prefixes in CATEGORIES.items():
+        if part_id.startswith(prefixes):
+            return category
+    return None
+
+def walk_grid(parts, catalog=None):
+    """
+    The walkable tiles of a ship and who covers them, with the sizes of the catalog of its rules.
+
+    Returns:
+        tuple: The sorted keys of the walkable tiles, the neighbours of every tile as a (tiles, 4) array of tile
+               indices, -1 where there is no walkable neighbour, the parts that are walkable and, for every tile of
+               these parts, the index of the part and the index of the tile.
+    """
+    part_table, _ = catalog_tables(catalog)
+    walkable = [part for part in parts if part["ID"] in part_table and not part["ID"].startswith(BLOCKING)]
+    index, tile_x, tile_y = part_tile_arrays(*part_boxes(walkable, part_table))
+    keys, tile = np.unique(tile_keys(tile_x, tile_y), return_inverse=True)
+    neighbours = np.full((len(keys), len(NEIGHBOUR_STEPS)), -1, dtype=np.int64)
+    for i, step in enumerate(NEIGHBOUR_STEPS):
+        position = np.searchsorted(keys, keys + step)
+        found = position < len(keys)
+        found[found] = keys[position[found]] == keys[found] + step
+        neighbours[found, i] = position[found]
+    return keys, neighbours, walkable, index, tile
+
+def walk_distances(neighbours, sources):
+    """
+    Multi-source breadth first search.
+
+    Args:
+        neighbours (np.ndarray): The neighbours of every tile, see walk_grid.
+        sources (np.ndarray): The tiles the search starts from.
+
+    Returns:
+        np.ndarray: The number of steps from the nearest source to every tile, -1 for unreachable tiles.
+    """
+    distance = np.full(len(neighbours), -1, dtype=np.int64)
+    frontier = np.unique(sources)
+    distance[frontier] = 0
+    step = 0
+    while len(frontier):
+        step += 1
+        reached = neighbours[frontier].ravel()
+        reached = reached[reached >= 0]
+        frontier = np.unique(reached[distance[reached] < 0])
+        distance[frontier] = step
+    return distance
+
+def crew_distances(parts, heatmap=False, catalog=None):
+    """
+    Walking distances from the crew quarters to the parts crew works in.
+
+    Args:
+        parts (list): The parts of the ship.
+        heatmap (bool): Also return the distance of every walkable tile, for draw_crew_heatmap.
+        catalog (dict, optional): The catalog of the rules of the ship, see rules_catalog.ship_catalog, part_data by default.
+
+    Returns:
+        dict: "quarters", the number of crew quarters, "average" and "worst" distance over every part of a category,
+              and "categories", the number of "parts", the "average" and "worst" distance and the number of
+              "unreachable" parts of every category present. Distances are None without crew quarters.
+              With heatmap, "tiles" holds the keys and the distances of the walkable tiles, it is not json.
+    """
+    keys, neighbours, walkable, index, tile = walk_grid(parts, catalog)
+    quarters = np.array([part["ID"] in CREW_QUARTERS for part in walkable], dtype=bool)
+    distance = walk_distances(neighbours, tile[quarters[index]]) if len(walkable) else np.zeros(0, dtype=np.int64)
+
+    # distance of a part : the distance of its nearest tile
+    part_distance = np.full(len(walkable), np.iinfo(np.int64).max)
+    tile_distance = np.where(distance[tile] >= 0, distance[tile], np.iinfo(np.int64).max)
+    np.minimum.at(part_distance, index, tile_distance)
+    reachable = part_distance < np.iinfo(np.int64).max
+
+    categories = np.array([part_category(part["ID"]) or "" for part in walkable], dtype=object)
+    has_quarters = bool(quarters.any())
+    result = {"quarters": int(quarters.sum()), "average": None, "worst": None, "categories": {}}
+    for category in CATEGORIES:
+        members = categories == category
+        if not members.any():
+            continue
+        reached = members & reachable
+        summary = {"parts": int(members.sum()), "average": None, "worst": None, "unreachable": int((members & ~reachable).sum())}
+        if has_quarters and reached.any():
+            summary["average"] = float(part_distance[reached].mean())
+            summary["worst"] = int(part_distance[reached].max())
+        result["categories"][category] = summary
+
+    worked = (categories != "") & reachable
+    if has_quarters and worked.any():
+        result["average"] = float(part_distance[worked].mean())
+        result["worst"] = int(part_distance[worked].max())
+    if heatmap:
+        result["tiles"] = (keys, distance)
+    return result
+
+def draw_crew_heatmap(parts, tiles, tile_size=HEATMAP_TILE_SIZE, catalog=None):
+    """
+    Draw the walking distance of every tile, armor in gray.
+
+    Args:
+        parts (list): The parts of the ship.
+        tiles (tuple): The keys and distances of the walkable tiles, crew_distances(parts, heatmap=True)["tiles"].
+        catalog (dict, optional): The catalog of the rules of the ship, see rules_catalog.ship_catalog, part_data by default.
+
+    Returns:
+        str: The image as a base64 png, or an error message when the ship is too big to draw.
+    """
+    import cv2
+
+    keys, distance = tiles
+    part_table, _ = catalog_tables(catalog)
+    blocking = [part for part in parts if part["ID"] in part_table and part["ID"].startswith(BLOCKING)]
+    _, block_x, block_y = part_tile_arrays(*part_boxes(blocking, part_table))
+    # the keys wrap around in int64, as unsigned they are the exact tile_keys
+    unsigned = keys.astype(np.uint64)
+    tile_x = np.concatenate([(unsigned >> np.uint64(32)).astype(np.int64) - 2**31, block_x])
+    tile_y = np.concatenate([(unsigned & np.uint64(2**32 - 1)).astype(np.int64) - 2**31, block_y])
+    if len(tile_x) == 0:
+        tile_x = tile_y = np.zeros(1, dtype=np.int64)
+    min_x, min_y = int(tile_x.min()) - 1, int(tile_y.min()) - 1
+    width, height = int(tile_x.max()) - min_x + 2, int(tile_y.max()) - min_y + 2
+    tile_size = min(tile_size, HEATMAP_MAX_SIZE // max(width, height))
+    if tile_size < 1:
+        return "error drawing heatmap: out of bounds\n"
+
+    colors = np.full((height, width, 3), BACKGROUND_COLOR, dtype=np.uint8)
+    colors[block_y - min_y, block_x - min_x] = BLOCKING_COLOR
+    walk_x, walk_y = tile_x[:len(keys)] - min_x, tile_y[:len(keys)] - min_y
+    colors[walk_y, walk_x] = UNREACHABLE_COLOR
+    reached = distance >= 0
+    if reached.any():
+        scale = 255 / max(1, int(distance[reached].max()))
+        levels = (distance[reached] * scale).astype(np.uint8).reshape(-1, 1)
+        colors[walk_y[reached], walk_x[reached]] = cv2.applyColorMap(levels, cv2.COLORMAP_JET).reshape(-1, 3)
+
+    image = cv2.resize(colors, (width * tile_size, height * tile_size), interpolation=cv2.INTER_NEAREST)
+    _, buffer = cv2.imencode(".png", image)
+    return base64.b64encode(buffer).decode("utf-8")
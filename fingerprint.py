@@ -0,0 +1,159 @@
+# fingerprints of ships, to find lightly edited copies of the same design
+# a fingerprint is the part ID histogram of a ship plus a MinHash signature of its occupancy grid,
+# the grid is turned so the flight direction points up and every occupied tile becomes a shingle
+# made of its part and the parts of its four neighbours, so moving the whole ship does not change it
+# the signature is cut into LSH bands, ships sharing a band bucket are candidates for near-duplicates
+# structure_hash() ignores the cosmetic fields (name, roof colors, ...) that do not change the analysis
+
+import hashlib
+import zlib
+from collections import Counter
+
+import numpy as np
+
+import part_data
+
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS # 4 rows per band, ships above ~50% similarity usually share a bucket
+SEED = 5238
+
+rng = np.random.default_rng(SEED)
+# odd multipliers of the (a * x + b) hash family, one per MinHash function
+hash_a = rng.integers(1, 2**63, NUM_HASHES, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+hash_b = rng.integers(0, 2**63, NUM_HASHES, dtype=np.uint64)
+# multipliers of the center, north, east, south and west tiles of a shingle
+NEIGHBOUR_KEYS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD], dtype=np.uint64)
+
+part_codes = {}
+
+def part_code(part_id):
+    """
+    Stable non zero integer of a part ID, the same in every process.
+    """
+    code = part_codes.get(part_id)
+    if code is None:
+        code = part_codes[part_id] = zlib.crc32(part_id.encode("utf-8")) | 1 << 32
+    return code
+
+def part_histogram(parts):
+    """
+    Number of parts of each ID.
+    """
+    return dict(Counter(part["ID"] for part in parts))
+
+def occupancy_grid(parts, flight_direction):
+    """
+    Grid of the part codes covering each tile, 0 for empty tiles, turned so the flight direction points up.
+
+    Returns:
+        np.ndarray: A 2d uint64 array indexed by [y, x].
+    """
+    tiles_x, tiles_y, codes = [], [], []
+    for part in parts:
+        size = part_data.parts[part["ID"]]["size"] if part["ID"] in part_data.parts else (1, 1)
+        width, height = (size[1], size[0]) if part["Rotation"] in (1, 3) else size
+        x, y = part["Location"]
+        for i in range(width):
+            for j in range(height):
+                tiles_x.append(x + i)
+                tiles_y.append(y + j)
+                codes.append(part_code(part["ID"]))
+    if not codes:
+        return np.zeros((0, 0), dtype=np.uint64)
+    tiles_x = np.array(tiles_x) - min(tiles_x)
+    tiles_y = np.array(tiles_y) - min(tiles_y)
+    grid = np.zeros((tiles_y.max() + 1, tiles_x.max() + 1), dtype=np.uint64)
+    grid[tiles_y, tiles_x] = codes
+    # flight directions go clockwise from 0 = NW, 1 = N, diagonal directions are turned like the next one counterclockwise
+    return np.rot90(grid, ((flight_direction - 1) // 2) % 4)
+
+def grid_shingles(grid):
+    """
+    One shingle per occupied tile, mixing its part with the parts of its four neighbours.
+
+    Returns:
+        np.ndarray: The distinct shingles as uint64.
+    """
+    if grid.size == 0:
+        return np.zeros(0, dtype=np.uint64)
+    padded = np.pad(grid, 1)
+    center = padded[1:-1, 1:-1]
+    occupied = center != 0
+    neighbours = [center, padded[:-2, 1:-1], padded[1:-1, 2:], padded[2:, 1:-1], padded[1:-1, :-2]]
+    with np.errstate(over="ignore"):
+        shingles = np.zeros(int(occupied.sum()), dtype=np.uint64)
+        for key, tiles in zip(NEIGHBOUR_KEYS, neighbours):
+            shingles = (shingles ^ tiles[occupied]) * key
+            shingles ^= shingles >> np.uint64(29)
+    return np.unique(shingles)
+
+def minhash(shingles):
+    """
+    MinHash signature of a set of shingles, NUM_HASHES uint32 values.
+    """
+    if len(shingles) == 0:
+        return np.full(NUM_HASHES, 2**32 - 1, dtype=np.uint32)
+    signature = np.empty(NUM_HASHES, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for i in range(NUM_HASHES):
+            # the high bits of a * x + b mod 2^64 are the well mixed ones
+            signature[i] = ((hash_a[i] * shingles + hash_b[i]) >> np.uint64(32)).min()
+    return signature
+
+def fingerprint(data):
+    """
+    Fingerprint of a decoded ship.
+
+    Args:
+        data (dict): The decoded ship, Ship(...).data.
+
+    Returns:
+        dict: "histogram", the part counts, and "signature", the MinHash signature of the occupancy grid.
+    """
+    parts = data["Parts"]
+    return {
+        "histogram": part_histogram(parts),
+        "signature": minhash(grid_shingles(occupancy_grid(parts, data["FlightDirection"]))),
+    }
+
+def lsh_buckets(signature):
+    """
+    Bucket of the signature in each band.
+
+    Returns:
+        list: One hex string per band.
+    """
+    return [hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).hexdigest() for band in range(BANDS)]
+
+def signature_similarity(signature1, signature2):
+    """
+    Estimated Jaccard similarity of the occupancy grids of two ships.
+    """
+    return float(np.mean(signature1 == signature2))
+
+def histogram_similarity(histogram1, histogram2):
+    """
+    Weighted Jaccard similarity of two part histograms.
+    """
+    ids = set(histogram1) | set(histogram2)
+    union = sum(max(histogram1.get(i, 0), histogram2.get(i, 0)) for i in ids)
+    if union == 0:
+        return 1.0
+    return sum(min(histogram1.get(i, 0), histogram2.get(i, 0)) for i in ids) / union
+
+def structure_hash(data, tag_mask, catalog_version="part_data"):
+    """
+    Hash of everything the analysis of a ship depends on, two ships with the same structure hash only differ in
+    cosmetic fields like the name or the roof colors and share their analysis.
+
+    Args:
+        data (dict): The decoded ship.
+        tag_mask (int): The tag mask of the ship, it carries the missile types of PartUIToggleStates.
+        catalog_version (str): The version of the part numbers the ship is analyzed with, see rules_catalog.catalog_version.
+    """
+    parts = sorted((part["ID"], tuple(part["Location"]), part["Rotation"], bool(part.get("FlipX"))) for part in data["Parts"])
+    doors = sorted((door.get("ID"), tuple(door.get("Cell", ())), door.get("Orientation")) for door in data.get("Doors") or [])
+    storage = sorted(str(item.get("Value")) for item in data.get("NewFlexResourceGridTypes") or [] if isinstance(item, dict))
+    key = repr((data.get("Author"), data.get("FlightDirection"), parts, doors, storage, tag_mask, data.get("ShipRulesID"), catalog_version))
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
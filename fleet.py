@@ -0,0 +1,171 @@
+# fleet files : one payload holding many ships, each one a dictionary with its own "Parts"
+# com() sends fleets here, every ship is analyzed on a pool of worker processes and the results are summed up
+# with draw on, every ship is drawn small by its worker and the drawings are tiled into one overview image,
+# the workers share the sprite atlas and keep their own sprite cache between requests
+# set the environment variable fleet_workers to the number of worker processes, 0 analyzes the ships in the request
+# center_of_mass imports this module, so center_of_mass is imported inside the functions using it
+
+import base64
+import math
+import os
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+FLEET_WORKERS = int(os.getenv("fleet_workers", os.cpu_count() or 1))
+OVERVIEW_CELL = 256 # pixels per ship in the overview image
+OVERVIEW_LABEL = 24 # pixels under every ship for its name
+
+# created on the first fleet, shared by every request of the process
+pool = None
+
+def fleet_ships(data):
+    """
+    Find the ships of a fleet payload.
+
+    Args:
+        data (dict): The decoded payload.
+
+    Returns:
+        list: The data of every ship, or None when the payload is a single ship.
+    """
+    if "Parts" in data:
+        return None
+    ships = []
+
+    def search(node):
+        if isinstance(node, dict):
+            if "Parts" in node and isinstance(node["Parts"], list):
+                ships.append(node)
+                return
+            for value in node.values():
+                search(value)
+        elif isinstance(node, list):
+            for value in node:
+                search(value)
+
+    search(data)
+    if not ships:
+        return None
+    # fields the analysis needs, ships of a fleet may leave them to the fleet
+    defaults = {"Author": data.get("Author", ""), "FlightDirection": 1, "Doors": [], "PartUIToggleStates": []}
+    return [{**defaults, **ship} for ship in ships]
+
+def analyze_fleet_ship(data, args, draw):
+    """
+    Analyze one ship of a fleet, runs in a worker process.
+
+    Returns:
+        dict: The analysis of the ship with its name, and its small drawing as a base64 png in "overview" when draw is set.
+    """
+    import center_of_mass
+
+    ship = types.SimpleNamespace(data=data, image=None)
+    try:
+        if draw:
+            # the fleet has one overview image, no crew heatmap per ship
+            ship_args = {**args, "draw": True, "format": "png", "overlay": None, "max_size": OVERVIEW_CELL, "crew_heatmap": False}
+            result = center_of_mass.analyze_ship(ship, ship_args, upload=lambda base64_output: base64_output)
+            overview = result.pop("url_com")
+            # draw_ship answers with an error message for ships too big to draw
+            result["overview"] = None if overview.startswith("error") else overview
+        else:
+            result = center_of_mass.analyze_ship(ship, {**args, "draw": False, "crew_heatmap": False})
+    except Exception as e:
+        return {"name": data.get("Name"), "error": f"{type(e).__name__}: {e}"}
+    return {"name": data.get("Name"), **result}
+
+def run_ships(ships, args, draw):
+    global pool
+    if FLEET_WORKERS <= 0 or len(ships) == 1:
+        return [analyze_fleet_ship(ship, args, draw) for ship in ships]
+    if pool is None:
+        try:
+            pool = ProcessPoolExecutor(FLEET_WORKERS)
+        except (OSError, NotImplementedError):
+            # serverless platforms may not allow worker processes
+            return [analyze_fleet_ship(ship, args, draw) for ship in ships]
+    return list(pool.map(analyze_fleet_ship, ships, [args] * len(ships), [draw] * len(ships)))
+
+def draw_overview(results):
+    """
+    Tile the small drawings of the ships of a fleet into one image, with the name of each ship under it.
+
+    Returns:
+        str: The image as a base64 png.
+    """
+    import cv2
+    import numpy as np
+
+    columns = math.ceil(math.sqrt(len(results)))
+    rows = math.ceil(len(results) / columns)
+    cell_height = OVERVIEW_CELL + OVERVIEW_LABEL
+    image = np.zeros((rows * cell_height, columns * OVERVIEW_CELL, 3), np.uint8)
+    for i, result in enumerate(results):
+        x = (i % columns) * OVERVIEW_CELL
+        y = (i // columns) * cell_height
+        if result.get("overview"):
+            sprite = cv2.imdecode(np.frombuffer(base64.b64decode(result["overview"]), np.uint8), cv2.IMREAD_COLOR)
+            # drawings are at most OVERVIEW_CELL wide, only the mipmap level picked by max_size may overshoot
+            scale = min(1, OVERVIEW_CELL / max(sprite.shape[:2]))
+            if scale < 1:
+                sprite = cv2.resize(sprite, (int(sprite.shape[1] * scale), int(sprite.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+            offset_x = x + (OVERVIEW_CELL - sprite.shape[1]) // 2
+            offset_y = y + (OVERVIEW_CELL - sprite.shape[0]) // 2
+            image[offset_y:offset_y + sprite.shape[0], offset_x:offset_x + sprite.shape[1]] = sprite
+        label = str(result.get("name") or f"ship {i + 1}")[:30]
+        cv2.putText(image, label, (x + 4, y + cell_height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (220, 220, 220), 1, cv2.LINE_AA)
+    with metrics.stage("imencode"):
+        _, buffer = cv2.imencode(".png", image)
+    return base64.b64encode(buffer).decode("utf-8")
+
+def analyze_fleet(data, args, upload=None):
+    """
+    Analyze every ship of a fleet.
+
+    Args:
+        data (dict): The decoded fleet payload.
+        args (dict): The arguments of the analysis, see center_of_mass.DEFAULT_ARGS.
+        upload (callable, optional): Called with the base64 png of the overview, returns its url.
+
+    Returns:
+        dict: "ships", the analysis of every ship, "fleet", the totals of the fleet, and "url_com", the url of the
+              overview image when args["draw"] is set.
+    """
+    import center_of_mass
+
+    args = {**center_of_mass.DEFAULT_ARGS, **args}
+    ships = fleet_ships(data)
+    draw = bool(args["draw"])
+    metrics.observe("cosmo_ship_parts", sum(len(ship["Parts"]) for ship in ships))
+
+    with metrics.stage("fleet_ships"):
+        results = run_ships(ships, args, draw)
+
+    analyzed = [result for result in results if "error" not in result]
+    slowest = min(analyzed, key=lambda result: result["top_speed"], default=None)
+    totals = {
+        "name": data.get("Name"),
+        "ships": len(results),
+        "errors": len(results) - len(analyzed),
+        "total_price": sum(result["price"] for result in analyzed),
+        "total_crew": sum(result["crew"] for result in analyzed),
+        "total_mass": sum(result["total_mass"] for result in analyzed),
+        "slowest_top_speed": slowest["top_speed"] if slowest else None,
+        "slowest_ship": slowest["name"] if slowest else None,
+        "tags": sorted({tag for result in analyzed for tag in result["tags"]}),
+    }
+
+    response = {"fleet": totals}
+    if draw:
+        with metrics.stage("draw_ship"):
+            base64_output = draw_overview(results)
+        for result in results:
+            result.pop("overview", None)
+        if upload is None:
+            from png_upload import upload_image_to_imgbb as upload
+        with metrics.stage("upload"):
+            response["url_com"] = upload(base64_output)
+    response["ships"] = results
+    return response
@@ -0,0 +1,156 @@
+# pipeline metrics : per stage latency histograms and counters for /analyze
+# exported in the Prometheus text format by the /metrics endpoint of server.py
+# set the environment variable metrics=0 to turn every timer and counter into a no-op
+# usage :
+#   with metrics.stage("decode"):
+#       ...
+#   metrics.observe("cosmo_ship_parts", len(parts))
+
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+enabled = os.getenv("metrics", "1") != "0"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PART_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000)
+BYTE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+
+# flags that change the work done by com(), used to label the stage timings
+ARGS_FLAGS = ["draw", "flip_vectors", "draw_all_com", "draw_all_cot", "draw_cot", "draw_com", "boost"]
+
+def braces(label_text):
+    return "{" + label_text + "}" if label_text else ""
+
+class Histogram():
+    def __init__(self, description, label_names, buckets):
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, value, labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self, name):
+        lines = [f"# HELP {name} {self.description}", f"# TYPE {name} histogram"]
+        for labels, (bucket_counts, total, count) in sorted(self.series.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in zip(self.label_names, labels))
+            separator = "," if label_text else ""
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{label_text}{separator}le="{bound:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label_text}{separator}le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{braces(label_text)} {total:g}")
+            lines.append(f"{name}_count{braces(label_text)} {count}")
+        return lines
+
+class Counter():
+    def __init__(self, description, label_names):
+        self.description = description
+        self.label_names = label_names
+        self.series = {}
+
+    def inc(self, amount, labels):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, name):
+        lines = [f"# HELP {name} {self.description}", f"# TYPE {name} counter"]
+        for labels, value in sorted(self.series.items()):
+            label_text = ",".join(f'{key}="{value}"' for key, value in zip(self.label_names, labels))
+            lines.append(f"{name}{braces(label_text)} {value:g}")
+        return lines
+
+histograms = {
+    "cosmo_stage_seconds": Histogram("Time spent in each stage of the analysis pipeline.", ("stage", "args"), LATENCY_BUCKETS),
+    "cosmo_ship_parts": Histogram("Number of parts per analyzed ship.", (), PART_BUCKETS),
+    "cosmo_payload_bytes": Histogram("Size of the ship payload at each step of decoding.", ("kind",), BYTE_BUCKETS),
+}
+
+counters = {
+    "cosmo_sprite_cache_total": Counter("Sprite lookups by where the sprite came from.", ("result",)),
+    "cosmo_analyze_errors_total": Counter("Analyses that raised an exception, by stage.", ("stage",)),
+    "cosmo_rejected_ships_total": Counter("Ships refused for going over a size limit, by limit.", ("limit",)),
+    "cosmo_render_cache_total": Counter("Ship renders by whether their sprite layer was cached.", ("result",)),
+}
+
+lock = threading.Lock()
+
+# label of the arguments of the analysis running in this context
+current_args = contextvars.ContextVar("current_args", default="")
+# list of (kind, name, value) of the request being profiled in this context, None when not profiling
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def args_label(args):
+    """
+    Label an args combination by the flags that are turned on, e.g. "boost,draw,draw_cot".
+    """
+    return ",".join(flag for flag in ARGS_FLAGS if args.get(flag)) or "none"
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the pipeline into cosmo_stage_seconds, labeled with the current args.
+    """
+    trace = current_trace.get()
+    if not enabled and trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("cosmo_analyze_errors_total", stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if trace is not None:
+            trace.append(("stage", name, elapsed))
+        observe("cosmo_stage_seconds", elapsed, stage=name, args=current_args.get())
+
+def observe(name, value, **labels):
+    """
+    Add a value to a histogram, the labels must match the label names of the histogram.
+    """
+    trace = current_trace.get()
+    if trace is not None and name != "cosmo_stage_seconds":
+        trace.append(("value", ",".join([name, *labels.values()]), value))
+    if not enabled:
+        return
+    histogram = histograms[name]
+    with lock:
+        histogram.observe(value, tuple(labels[key] for key in histogram.label_names))
+
+def inc(name, amount=1, **labels):
+    """
+    Increase a counter, the labels must match the label names of the counter.
+    """
+    if not enabled:
+        return
+    counter = counters[name]
+    with lock:
+        counter.inc(amount, tuple(labels[key] for key in counter.label_names))
+
+def render():
+    """
+    Export every metric in the Prometheus text format.
+    """
+    lines = []
+    with lock:
+        for name, histogram in histograms.items():
+            lines.extend(histogram.render(name))
+        for name, counter in counters.items():
+            lines.extend(counter.render(name))
+    return "\n".join(lines) + "\n"
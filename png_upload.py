@@ -1,13 +1,23 @@
-import requests
 import os
 
-from dotenv import load_dotenv
+# requests and dotenv are only imported by the first upload, analysis without drawing never needs them
+env_loaded = False
 
-load_dotenv()
+def load_env():
+    """
+    Load the .env file once, before the first upload reads the api keys.
+    """
+    global env_loaded
+    if not env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        env_loaded = True
 
 def upload_image_to_imgbb(image_base64):
+    import requests
+    load_env()
     api_key = os.getenv('imagebb_api')
-    url = "https://api.imgbb.com/1/upload"
+    url = os.getenv('imagebb_url', "https://api.imgbb.com/1/upload")
 
     # Prepare the upload request
     payload = {
@@ -30,8 +40,10 @@ def upload_image_to_imgbb(image_base64):
         return upload_image_to_cloudinary(image_base64)
 
 def upload_image_to_cloudinary(image_base64):
+    import requests
+    load_env()
     # Set your Cloudinary credentials
-    cloudinary_url = "https://api.cloudinary.com/v1_1/{cloud_name}/image/upload"
+    cloudinary_url = os.getenv('cloudinary_url', "https://api.cloudinary.com/v1_1/{cloud_name}/image/upload")
     api_key = os.getenv('cloud_api_key')
     api_secret = os.getenv('cloud_api_secret')
     cloud_name = os.getenv('cloud_name')
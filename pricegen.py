@@ -87,6 +87,36 @@ parts_resources = [
 
 resource_cost = [{'ID': 'bullet', 'BuyPrice': 4, 'MaxStackSize': 20}, {'ID': 'carbon', 'BuyPrice': 160, 'MaxStackSize': 5}, {'ID': 'coil', 'BuyPrice': 100, 'MaxStackSize': 20}, {'ID': 'coil2', 'BuyPrice': 300, 'MaxStackSize': 20}, {'ID': 'copper', 'BuyPrice': 80, 'MaxStackSize': 5}, {'ID': 'diamond', 'BuyPrice': 4000, 'MaxStackSize': 5}, {'ID': 'enriched_uranium', 'BuyPrice': 2000, 'MaxStackSize': 10}, {'ID': 'gold', 'BuyPrice': 500, 'MaxStackSize': 5}, {'ID': 'hyperium', 'BuyPrice': 50, 'MaxStackSize': 20}, {'ID': 'iron', 'BuyPrice': 20, 'MaxStackSize': 5}, {'ID': 'mine_part', 'BuyPrice': 52, 'MaxStackSize': 8}, {'ID': 'missile_part_emp', 'BuyPrice': 20, 'MaxStackSize': 10}, {'ID': 'missile_part_he', 'BuyPrice': 8, 'MaxStackSize': 10}, {'ID': 'missile_part_nuke', 'BuyPrice': 36, 'MaxStackSize': 10}, {'ID': 'processor', 'BuyPrice': 2500, 'MaxStackSize': 5}, {'ID': 'steel', 'BuyPrice': 25, 'MaxStackSize': 20}, {'ID': 'sulfur', 'BuyPrice': 20, 'MaxStackSize': 5}, {'ID': 'tristeel', 'BuyPrice': 200, 'MaxStackSize': 20}, {'ID': 'tritanium', 'BuyPrice': 160, 'MaxStackSize': 5}, {'ID': 'uranium', 'BuyPrice': 400, 'MaxStackSize': 5}]
 
+# part ID -> price of the resources of the part, built by the first calculate_price call
+part_prices = None
+part_resources = None
+
+def part_price_catalog():
+    global part_prices
+    if part_prices is None:
+        buy_prices = {cost['ID']: cost['BuyPrice'] for cost in resource_cost}
+        part_prices = {}
+        for part in parts_resources:
+            part_prices[part['ID']] = sum(buy_prices.get(resource[0], 0) * int(resource[1]) for resource in part['Resources'])
+    return part_prices
+
+# crew quarters ID -> (price of the crew, number of crew)
+crew_quarters = {
+    'cosmoteer.crew_quarters_small': (1000, 2),
+    'cosmoteer.crew_quarters_med': (3000, 6),
+}
+
+def part_resource_catalog():
+    """
+    Part ID -> {resource ID: quantity} of the resources needed to build the part.
+    """
+    global part_resources
+    if part_resources is None:
+        part_resources = {}
+        for part in parts_resources:
+            part_resources[part['ID']] = {resource[0]: int(resource[1]) for resource in part['Resources']}
+    return part_resources
+
 def round_to_k(num):
     if num < 1000000:
         return round(num, -4)
@@ -94,7 +124,7 @@ def round_to_k(num):
         return round(num, -5)
 
 # def calculate_price(png_url): ## take json instead of png
-def calculate_price(data_json): ## take json instead of png
+def calculate_price(data_json, prices=None): ## take json instead of png, prices of the rules of the ship or part_price_catalog()
     # json_data = decode_ship_data(png_url)
     # data = json.loads(json_data)
     data = data_json
@@ -108,32 +138,46 @@ def calculate_price(data_json): ## take json instead of png
     
     # calculate price for parts
     total_price = 0
+    if prices is None:
+        prices = part_price_catalog()
 
     for item in parts:
-        item_id = item['ID']
-        resources = None
+        total_price += prices.get(item['ID'], 0)
 
-        for part in parts_resources:
-            if part['ID'] == item_id:
-                resources = part['Resources']
-                break
+    total_price += door_price(doors)
+    
+        # Calculate the price for crew quarters
+    crew_quarters_small_price = 0
+    crew_quarters_med_price = 0
 
-        if resources:
-            item_price = 0
-            for resource in resources:
-                resource_id = resource[0]
-                resource_quantity = int(resource[1])
+    for item in parts:
+        item_id = item['ID']
+        if item_id == 'cosmoteer.crew_quarters_small':
+            crew_quarters_small_price += 1000
+        elif item_id == 'cosmoteer.crew_quarters_med':
+            crew_quarters_med_price += 3000
 
-                for cost in resource_cost:
-                    if cost['ID'] == resource_id:
-                        resource_price = cost['BuyPrice']
-                        item_price += resource_price * resource_quantity
-                        break
+# calculate crew number
+    crew = 0
+    # print('crew calculte before', crew)
+    for item in parts:
+        item_id = item['ID']
+        if item_id == 'cosmoteer.crew_quarters_small':
+            crew += 2
+        elif item_id == 'cosmoteer.crew_quarters_med':
+            crew += 6
+            
+    total_price += crew_quarters_small_price + crew_quarters_med_price
 
-            # print(f"Price for {item_id} at location {location}: {item_price}")
-            total_price += item_price
+    total_price += storage_price(storage)
 
-    # Calculate the price for doors
+    return round_to_k(total_price), crew
+
+def door_price(doors):
+    """
+    Price of the resources of the doors of a ship.
+    """
+    resources = None
     door_price = 0
     if doors is not None and isinstance(doors, list):
         for door in doors:
@@ -154,32 +198,12 @@ def calculate_price(data_json): ## take json instead of png
                             door_price += resource_price * resource_quantity
                             break
 
-    # print(f"Price for doors: {door_price}")
-    total_price += door_price
-    
-        # Calculate the price for crew quarters
-    crew_quarters_small_price = 0
-    crew_quarters_med_price = 0
-
-    for item in parts:
-        item_id = item['ID']
-        if item_id == 'cosmoteer.crew_quarters_small':
-            crew_quarters_small_price += 1000
-        elif item_id == 'cosmoteer.crew_quarters_med':
-            crew_quarters_med_price += 3000
-
-# calculate crew number
-    crew = 0
-    # print('crew calculte before', crew)
-    for item in parts:
-        item_id = item['ID']
-        if item_id == 'cosmoteer.crew_quarters_small':
-            crew += 2
-        elif item_id == 'cosmoteer.crew_quarters_med':
-            crew += 6
-            
-    total_price += crew_quarters_small_price + crew_quarters_med_price
+    return door_price
 
+def storage_price(storage):
+    """
+    Price of the resources stored in the flex storages of a ship, stacks are counted full.
+    """
     # Calculate the price for storage
     storage_price = 0
     if storage is not None:
@@ -192,6 +216,4 @@ def calculate_price(data_json): ## take json instead of png
                         max_stack = cost['MaxStackSize']
                         storage_price += resource_price * max_stack
 
-    total_price += storage_price
-
-    return round_to_k(total_price), crew
\ No newline at end of file
+    return storage_price
@@ -0,0 +1,150 @@
+# on-demand profiling of a single analysis, used by /analyze?profile=1 for admins
+# "deterministic" runs the request under cProfile and stores a .pstats file
+# "sample" samples the stack of the request thread and stores collapsed stacks (flamegraph.pl / speedscope format)
+# both return a per-stage timing breakdown with the part count and payload sizes of the ship
+# the directory keeps the MAX_PROFILES most recently written or downloaded profiles, the others are deleted
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import metrics
+
+PROFILE_DIRECTORY = os.getenv("profile_dir", os.path.join(tempfile.gettempdir(), "cosmo_profiles"))
+SAMPLE_INTERVAL = 0.001 # seconds between two stack samples
+TOP_FUNCTIONS = 25
+MAX_PROFILES = int(os.getenv("max_profiles", 50)) # profiles kept in PROFILE_DIRECTORY, the temp directory may be in memory
+
+def profile_path(profile_id, extension):
+    """
+    Path of a stored profile, profile_id must come from profile_call.
+    """
+    return os.path.join(PROFILE_DIRECTORY, f"{profile_id}.{extension}")
+
+def find_profile(profile_id):
+    """
+    Find a stored profile by ID.
+
+    Returns:
+        str: The path of the profile file, or None if there is no such profile.
+    """
+    # IDs are uuid hex strings, anything else could point outside the profile directory
+    if len(profile_id) != 32 or any(c not in "0123456789abcdef" for c in profile_id):
+        return None
+    for extension in ("pstats", "collapsed"):
+        path = profile_path(profile_id, extension)
+        if os.path.exists(path):
+            # a downloaded profile counts as recently used
+            os.utime(path)
+            return path
+    return None
+
+def prune_profiles(keep=MAX_PROFILES):
+    """
+    Delete the least recently used profiles, keep the newest keep of them.
+    """
+    used = {}
+    for entry in os.scandir(PROFILE_DIRECTORY):
+        if entry.name.endswith((".pstats", ".collapsed")):
+            try:
+                used[entry.path] = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+    if len(used) <= keep:
+        return
+    for path in sorted(used, key=used.get)[:len(used) - keep]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another request pruned it first
+            pass
+
+def sample_stacks(thread_id, stop, samples):
+    """
+    Count the stacks of a thread until stop is set, as "outer;...;inner" strings.
+    """
+    while not stop.is_set():
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(SAMPLE_INTERVAL)
+
+def profile_call(function, *args, mode="deterministic"):
+    """
+    Run function(*args) under a profiler and store the profile.
+
+    Args:
+        function (callable): The function to profile, usually com.
+        args: The arguments of the function.
+        mode (str): "deterministic" for cProfile, "sample" for a stack sampling profiler.
+
+    Returns:
+        tuple: The result of the function and the profile report as a dictionary.
+    """
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    trace = []
+    token = metrics.current_trace.set(trace)
+    start = time.perf_counter()
+    try:
+        if mode == "sample":
+            samples = Counter()
+            stop = threading.Event()
+            sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, samples), daemon=True)
+            sampler.start()
+            try:
+                result = function(*args)
+            finally:
+                stop.set()
+                sampler.join()
+            path = profile_path(profile_id, "collapsed")
+            with open(path, "w") as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            top = [f"{count} {stack.rsplit(';', 1)[-1]}" for stack, count in samples.most_common(TOP_FUNCTIONS)]
+        else:
+            profiler = cProfile.Profile()
+            try:
+                result = profiler.runcall(function, *args)
+            finally:
+                path = profile_path(profile_id, "pstats")
+                profiler.dump_stats(path)
+            text = io.StringIO()
+            pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            top = [line for line in text.getvalue().splitlines() if line.strip()]
+    finally:
+        metrics.current_trace.reset(token)
+        prune_profiles()
+    total = time.perf_counter() - start
+
+    stages = {}
+    values = {}
+    for kind, name, value in trace:
+        if kind == "stage":
+            stages[name] = stages.get(name, 0) + value
+        else:
+            values[name] = value
+
+    report = {
+        "id": profile_id,
+        "mode": "sample" if mode == "sample" else "deterministic",
+        "total_seconds": total,
+        "stages": stages,
+        "parts": values.get("cosmo_ship_parts"),
+        "payload_bytes": {name.split(",")[1]: value for name, value in values.items() if name.startswith("cosmo_payload_bytes")},
+        "top": top,
+        "download": f"/profiles/{profile_id}",
+    }
+    return result, report
@@ -0,0 +1,485 @@
+# game rules catalogs : the part numbers of a version of the game, read from its .rules files
+# part_data.py and pricegen.py are hand-copied from one version of the game, ships carry the ShipRulesID of the rules
+# they were built with, this module imports the rules of a game install into a catalog for that rules id
+# the importer reads every .rules file under the Data folder of the game (or a folder of fixtures) :
+#   parts       : the blocks with an ID and a Size, their Mass (or Density per tile) and Resources [[resource, count], ...]
+#   thrusters   : the components of a part with a Thrust and a Location, their Rotation is the direction they push
+#                 the ship, clockwise from up, as the orientation of part_data.thruster_data
+#   resources   : the blocks with an ID and a BuyPrice
+# inheritance from another file, Part : <../base_part.rules>/Part, is followed, other references are left out,
+# what the rules do not give keeps the number of part_data and pricegen, so a catalog is always complete
+# a catalog is saved as an uncompressed .npz of the arrays the physics works on, loading one takes a millisecond,
+# the catalogs live in the folder set by the environment variable rules_catalogs, one file per rules id,
+# they are loaded the first time a ship of their rules id is analyzed, ships of other rules use part_data
+# the version of a catalog, catalog_version(), names its rules id, format and content, cached analyses are keyed by it
+# bench/rules holds a small folder of fixture rules, python bench/run.py --check imports it and analyzes a ship with it
+# usage : python rules_catalog.py "<game>/Data" --rules-id <ShipRulesID> [-o catalogs/]
+
+import argparse
+import hashlib
+import math
+import os
+import re
+import sys
+import threading
+
+import numpy as np
+
+import part_data
+import pricegen
+
+FORMAT_VERSION = 2 # bumped when the arrays of a catalog change, catalogs of another format are not loaded
+PART_DATA_VERSION = "part_data" # catalog version of the ships analyzed with part_data and pricegen
+CATALOG_DIRECTORY = os.getenv("rules_catalogs", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalogs"))
+BOOST_ONLY = ("cosmoteer.thruster_boost",) # thrusters pushing with a third of their thrust without boost
+
+TOKENS = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<punctuation>[{}\[\]=:,;])
+  | (?P<expression>\((?:[^()]|\([^()]*\))*\))
+  | (?P<atom>[^\s{}\[\]=:,;"]+)
+""", re.VERBOSE | re.DOTALL)
+NUMBER = re.compile(r"([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)(d|%)?")
+INHERITED_FILE = re.compile(r"<([^>]+)>/?(.*)")
+
+# rules id -> catalog, only the rules ids with a catalog file, so the ids of uploaded ships can not fill it
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+class RulesError(ValueError):
+    pass
+
+def atom_value(text):
+    """
+    Value of a bare word of a .rules file : numbers, angles in degrees (90d) as radians, percents as fractions,
+    true and false, anything else stays a string.
+    """
+    if text in ("true", "false"):
+        return text == "true"
+    match = NUMBER.fullmatch(text)
+    if match is None:
+        return text
+    number, unit = match.groups()
+    value = float(number) if any(c in number for c in ".eE") else int(number)
+    if unit == "d":
+        return math.radians(value)
+    if unit == "%":
+        return value / 100
+    return value
+
+def parse_rules(text, path="<rules>"):
+    """
+    Parse the text of a .rules file.
+    Blocks {...} become dicts, lists [...] become lists, the base of a block inheriting from another one is kept in
+    its "__base__" key.
+
+    Returns:
+        dict: The members of the file.
+    """
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None:
+            raise RulesError(f"{path}: unexpected character {text[position]!r} at {position}")
+        position = match.end()
+        if match.lastgroup == "string":
+            tokens.append(("value", re.sub(r"\\(.)", r"\1", match.group()[1:-1])))
+        elif match.lastgroup == "punctuation":
+            tokens.append(("punctuation", match.group()))
+        elif match.lastgroup in ("atom", "expression"):
+            tokens.append(("value", atom_value(match.group())))
+    tokens.append(("end", None))
+    index = 0
+
+    def peek():
+        return tokens[index]
+
+    def take():
+        nonlocal index
+        index += 1
+        return tokens[index - 1]
+
+    def is_punctuation(token, *characters):
+        return token[0] == "punctuation" and token[1] in characters
+
+    def value():
+        kind, token = take()
+        if kind == "punctuation" and token == "{":
+            return members("}")
+        if kind == "punctuation" and token == "[":
+            return items()
+        if kind == "value":
+            return token
+        raise RulesError(f"{path}: unexpected {token!r}")
+
+    def items():
+        result = []
+        while not is_punctuation(peek(), "]"):
+            if peek()[0] == "end":
+                raise RulesError(f"{path}: missing ]")
+            if is_punctuation(peek(), ",", ";"):
+                take()
+                continue
+            result.append(value())
+        take()
+        return result
+
+    def members(end):
+        result = {}
+        while True:
+            kind, token = peek()
+            if (kind == "end" and end is None) or (kind == "punctuation" and token == end):
+                take()
+                return result
+            if kind == "end":
+                raise RulesError(f"{path}: missing {end}")
+            if is_punctuation(peek(), ",", ";"):
+                take()
+                continue
+            if kind != "value":
+                raise RulesError(f"{path}: unexpected {token!r}")
+            key = str(take()[1])
+            base = None
+            if is_punctuation(peek(), ":"):
+                take()
+                base = take()[1]
+                # more bases after a comma are left out
+                while is_punctuation(peek(), ","):
+                    take()
+                    take()
+            if is_punctuation(peek(), "="):
+                take()
+                result[key] = value()
+            elif is_punctuation(peek(), "{", "["):
+                result[key] = value()
+            else:
+                # a key with no value is a flag
+                result[key] = True
+            if base is not None and isinstance(result[key], dict):
+                result[key]["__base__"] = base
+
+    return members(None)
+
+def merged(base, own):
+    """
+    The members of a block inheriting from base, own members win, blocks are merged member by member.
+    """
+    result = dict(base)
+    for key, value in own.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            value = merged(result[key], value)
+        result[key] = value
+    return result
+
+class RulesFiles:
+    """
+    The parsed .rules files of a folder, with the inheritance between files resolved.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.parsed = {}
+
+    def paths(self):
+        for root, directories, files in os.walk(self.directory):
+            directories.sort()
+            for name in sorted(files):
+                if name.endswith(".rules"):
+                    yield os.path.join(root, name)
+
+    def load(self, path):
+        path = os.path.normpath(path)
+        if path not in self.parsed:
+            # a file inheriting from itself ends up with its own unresolved members
+            self.parsed[path] = {}
+            with open(path, encoding="utf-8-sig") as f:
+                self.parsed[path] = self.resolve(parse_rules(f.read(), path), os.path.dirname(path))
+        return self.parsed[path]
+
+    def resolve(self, node, directory):
+        """
+        Replace the base of every block inheriting from a block of another file by the members of that block.
+        """
+        if isinstance(node, list):
+            return [self.resolve(item, directory) for item in node]
+        if not isinstance(node, dict):
+            return node
+        node = {key: self.resolve(value, directory) for key, value in node.items()}
+        base = node.pop("__base__", None)
+        match = INHERITED_FILE.fullmatch(base) if isinstance(base, str) else None
+        if match is None:
+            return node
+        path = os.path.join(directory, match.group(1))
+        if not os.path.isfile(path):
+            return node
+        inherited = self.load(path)
+        for key in filter(None, match.group(2).split("/")):
+            inherited = inherited.get(key) if isinstance(inherited, dict) else None
+        if not isinstance(inherited, dict):
+            return node
+        return merged(inherited, node)
+
+def blocks(node):
+    """
+    Every block of a parsed file, depth first.
+    """
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from blocks(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from blocks(value)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def part_thrusters(part):
+    """
+    Centers of thrust of a part of the rules, (x, y, orientation) in tiles of the unrotated part, and its thrust.
+    """
+    cots = []
+    thrust = 0
+    for component in blocks(part.get("Components", {})):
+        location = component.get("Location")
+        if not is_number(component.get("Thrust")) or not isinstance(location, list) or len(location) != 2:
+            continue
+        if not all(is_number(x) for x in location):
+            continue
+        angle = component.get("Rotation", 0)
+        orientation = round(angle / (math.pi / 2)) % 4 if is_number(angle) else 0
+        cots.append((location[0], location[1], orientation))
+        # part_data keeps one thrust per part, every direction of a multi-direction thruster pushes as hard
+        thrust = thrust or component["Thrust"]
+    return tuple(cots), thrust
+
+def read_rules(directory):
+    """
+    The part tables of the .rules files of a folder, the numbers the rules do not give come from part_data and pricegen.
+
+    Returns:
+        tuple: parts and thrusters like part_data.parts and part_data.thruster_data, part ID -> price like
+               pricegen.part_price_catalog(), and "parts", "thrusters" and "resources", the number of each read.
+    """
+    files = RulesFiles(directory)
+    rules_parts = {}
+    buy_prices = {cost["ID"]: cost["BuyPrice"] for cost in pricegen.resource_cost}
+    found = {"parts": 0, "thrusters": 0, "resources": 0}
+    for path in files.paths():
+        for block in blocks(files.load(path)):
+            if not isinstance(block.get("ID"), str):
+                continue
+            if isinstance(block.get("Size"), list):
+                rules_parts[block["ID"]] = block
+            elif is_number(block.get("BuyPrice")):
+                buy_prices[block["ID"]] = block["BuyPrice"]
+                found["resources"] += 1
+
+    parts = {part_id: dict(part) for part_id, part in part_data.parts.items()}
+    thrusters = dict(part_data.thruster_data)
+    # the parts the rules leave out are priced from the resources of pricegen at the prices of the rules
+    prices = {
+        part["ID"]: sum(buy_prices.get(resource[0], 0) * int(resource[1]) for resource in part["Resources"])
+        for part in pricegen.parts_resources
+    }
+    for part_id, block in rules_parts.items():
+        size = block["Size"]
+        if len(size) != 2 or not all(isinstance(x, int) and x > 0 for x in size):
+            continue
+        part = parts.setdefault(part_id, {})
+        part["size"] = tuple(size)
+        if is_number(block.get("Mass")):
+            part["mass"] = block["Mass"]
+        elif is_number(block.get("Density")):
+            part["mass"] = block["Density"] * size[0] * size[1]
+        if "mass" not in part:
+            # a part of the rules with no mass has nothing for the physics
+            del parts[part_id]
+            continue
+        found["parts"] += 1
+        cots, thrust = part_thrusters(block)
+        if cots:
+            thrusters[part_id] = {"cot": cots, "thrust": thrust}
+            found["thrusters"] += 1
+        resources = block.get("Resources")
+        if isinstance(resources, list) and all(isinstance(r, list) and len(r) == 2 and is_number(r[1]) for r in resources):
+            prices[part_id] = sum(buy_prices.get(str(resource), 0) * count for resource, count in resources)
+    return parts, thrusters, prices, found
+
+def catalog_arrays(parts, thrusters, prices):
+    """
+    The numbers of every part the physics needs, as arrays indexed by a part code, and the prices of the parts.
+
+    Args:
+        parts (dict): Part ID -> {"mass", "size"}, like part_data.parts.
+        thrusters (dict): Part ID -> {"cot", "thrust"}, like part_data.thruster_data.
+        prices (dict): Part ID -> price, like pricegen.part_price_catalog().
+
+    Returns:
+        dict: "codes", part ID -> code, per code "mass", "int_mass" (the mass is given as an int), "width",
+              "height", "thrust", "boost_only" (a third of the thrust without boost), "cot_start" and "cot_count",
+              and the centers of thrust of all parts in the order of the parts, "cot_x", "cot_y" and "cot_orientation",
+              and "prices", part ID -> price.
+    """
+    ids = list(parts)
+    cots = [thrusters.get(part_id, {"cot": ()})["cot"] for part_id in ids]
+    all_cots = np.array([cot for part_cots in cots for cot in part_cots], dtype=float).reshape(-1, 3)
+    counts = np.array([len(part_cots) for part_cots in cots], dtype=np.int64)
+    return {
+        "codes": {part_id: code for code, part_id in enumerate(ids)},
+        "mass": np.array([parts[part_id]["mass"] for part_id in ids], dtype=float),
+        "int_mass": np.array([isinstance(parts[part_id]["mass"], int) for part_id in ids], dtype=bool),
+        "width": np.array([parts[part_id]["size"][0] for part_id in ids], dtype=np.int64),
+        "height": np.array([parts[part_id]["size"][1] for part_id in ids], dtype=np.int64),
+        "thrust": np.array([thrusters.get(part_id, {"thrust": 0})["thrust"] for part_id in ids], dtype=float),
+        "boost_only": np.array([part_id in BOOST_ONLY for part_id in ids], dtype=bool),
+        "cot_start": np.cumsum(counts) - counts,
+        "cot_count": counts,
+        "cot_x": all_cots[:, 0],
+        "cot_y": all_cots[:, 1],
+        "cot_orientation": all_cots[:, 2].astype(np.int64),
+        "prices": dict(prices),
+    }
+
+def catalog_path(rules_id, directory=None):
+    """
+    File of the catalog of a rules id, the characters a file name can not hold are replaced by _.
+    """
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", rules_id)
+    return os.path.join(directory or CATALOG_DIRECTORY, f"{name}.npz")
+
+def save_catalog(catalog, rules_id, directory=None):
+    """
+    Write a catalog as an uncompressed .npz, nothing in it needs pickle to load.
+
+    Returns:
+        str: The path of the file.
+    """
+    path = catalog_path(rules_id, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = {key: value for key, value in catalog.items() if isinstance(value, np.ndarray)}
+    arrays["ids"] = np.array(list(catalog["codes"]), dtype=str)
+    arrays["price_ids"] = np.array(list(catalog["prices"]), dtype=str)
+    arrays["price_values"] = np.array(list(catalog["prices"].values()), dtype=float)
+    digest = hashlib.sha256()
+    for key in sorted(arrays):
+        digest.update(key.encode("utf-8"))
+        digest.update(np.ascontiguousarray(arrays[key]).tobytes())
+    temporary = path + ".tmp.npz"
+    np.savez(temporary, format=np.array(FORMAT_VERSION), rules_id=np.array(rules_id), digest=np.array(digest.hexdigest()), **arrays)
+    # a server loading the catalog never sees half a file
+    os.replace(temporary, path)
+    return path
+
+def load_catalog(path):
+    """
+    Read a catalog written by save_catalog.
+
+    Returns:
+        dict: The catalog like catalog_arrays, None when the file was written for another FORMAT_VERSION.
+    """
+    with np.load(path, allow_pickle=False) as saved:
+        if int(saved["format"]) != FORMAT_VERSION:
+            return None
+        catalog = {key: saved[key] for key in saved.files if key not in ("format", "rules_id", "digest", "ids", "price_ids", "price_values")}
+        catalog["codes"] = {part_id: code for code, part_id in enumerate(saved["ids"].tolist())}
+        # prices read as ints stay ints, like the prices of pricegen
+        catalog["prices"] = {
+            part_id: int(price) if float(price).is_integer() else price
+            for part_id, price in zip(saved["price_ids"].tolist(), saved["price_values"].tolist())
+        }
+        catalog["rules_id"] = str(saved["rules_id"])
+        catalog["version"] = f"{catalog['rules_id']}/{FORMAT_VERSION}/{str(saved['digest'])[:16]}"
+    return catalog
+
+def catalog_version(catalog):
+    """
+    Version of the numbers of an analysis, the "version" of its catalog or PART_DATA_VERSION for no catalog.
+    """
+    return PART_DATA_VERSION if catalog is None else catalog["version"]
+
+def catalog_tables(catalog):
+    """
+    The parts and thrusters of a catalog as tables like part_data.parts and part_data.thruster_data, for the code
+    working part by part, see ship_model.py, and for the code drawing ships.
+
+    Returns:
+        tuple: The part table and the thruster table, built once per catalog, part_data.parts and
+               part_data.thruster_data for no catalog. The parts keep the "sprite_size" of part_data, the sprites
+               are the ones of part_data.
+    """
+    if catalog is None:
+        return part_data.parts, part_data.thruster_data
+    if "tables" not in catalog:
+        parts, thrusters = {}, {}
+        for part_id, code in catalog["codes"].items():
+            mass = float(catalog["mass"][code])
+            parts[part_id] = {
+                "mass": int(mass) if catalog["int_mass"][code] else mass,
+                "size": (int(catalog["width"][code]), int(catalog["height"][code])),
+            }
+            if "sprite_size" in part_data.parts.get(part_id, {}):
+                parts[part_id]["sprite_size"] = part_data.parts[part_id]["sprite_size"]
+            start, count = int(catalog["cot_start"][code]), int(catalog["cot_count"][code])
+            if count:
+                thrust = float(catalog["thrust"][code])
+                cots = zip(catalog["cot_x"][start:start + count].tolist(), catalog["cot_y"][start:start + count].tolist(),
+                           catalog["cot_orientation"][start:start + count].tolist())
+                thrusters[part_id] = {"cot": tuple(cots), "thrust": int(thrust) if thrust.is_integer() else thrust}
+        catalog["tables"] = (parts, thrusters)
+    return catalog["tables"]
+
+def find_catalog(rules_id):
+    """
+    Catalog of a rules id.
+
+    Returns:
+        dict: The catalog, None when there is no catalog file of the current FORMAT_VERSION for this rules id.
+    """
+    if not isinstance(rules_id, str) or not rules_id:
+        return None
+    if rules_id not in catalogs:
+        path = catalog_path(rules_id)
+        catalog = load_catalog(path) if os.path.isfile(path) else None
+        if catalog is None:
+            return None
+        with catalogs_lock:
+            catalogs.setdefault(rules_id, catalog)
+    return catalogs[rules_id]
+
+def ship_catalog(data):
+    """
+    Catalog of the rules a ship was built with.
+
+    Args:
+        data (dict): The decoded ship.
+
+    Returns:
+        dict: The catalog of its ShipRulesID, None for ships of rules with no catalog, they use part_data.
+    """
+    return find_catalog(data.get("ShipRulesID"))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cosmo-rules", description="import the .rules files of the game into a catalog")
+    parser.add_argument("data", help="the Data folder of the game, or any folder of .rules files")
+    parser.add_argument("--rules-id", required=True, help="the ShipRulesID of the ships built with these rules")
+    parser.add_argument("-o", "--output", default=CATALOG_DIRECTORY, help="folder of the catalogs")
+    options = parser.parse_args(argv)
+
+    if not os.path.isdir(options.data):
+        parser.error(f"{options.data} is not a folder")
+    try:
+        parts, thrusters, prices, found = read_rules(options.data)
+    except (RulesError, OSError, UnicodeDecodeError) as e:
+        print(f"error reading the rules: {e}", file=sys.stderr)
+        return 1
+    path = save_catalog(catalog_arrays(parts, thrusters, prices), options.rules_id, options.output)
+    print(f"read {found['parts']} parts, {found['thrusters']} thrusters and {found['resources']} resources", file=sys.stderr)
+    print(f"{len(parts)} parts in the catalog, {len(parts) - found['parts']} of them from part_data", file=sys.stderr)
+    print(path)
+    return 0
+
+if(__name__ == "__main__"):
+    sys.exit(main())
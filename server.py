@@ -1,16 +1,119 @@
 # from shipcomcot import com
-from center_of_mass import com
-from fastapi import FastAPI
+from center_of_mass import com, MIPMAP_LEVELS
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse, JSONResponse, FileResponse
 from fastapi.middleware.gzip import GZipMiddleware
-import uvicorn
+from dotenv import load_dotenv
 import json
+import math
 import os
+import hmac
+import metrics
+import profiling
+import ship_library
+import fingerprint
+import cosmoteer_save_tools
+from ship_model import ShipModel
+import ship_diff
+
+# the session secret is read below, the upload keys are read on the first upload
+load_dotenv()
 
 
 app = FastAPI()
 
+@app.exception_handler(cosmoteer_save_tools.ShipTooLarge)
+def ship_too_large(request: Request, e: cosmoteer_save_tools.ShipTooLarge):
+    # crafted pngs that would inflate past the limits of cosmoteer_save_tools
+    return JSONResponse({"error": str(e)}, status_code=413)
+
+class BadArgument(ValueError):
+    pass
+
+@app.exception_handler(BadArgument)
+def bad_argument(request: Request, e: BadArgument):
+    return JSONResponse({"error": str(e)}, status_code=400)
+
+query_keys = ["draw", "flip_vectors", "draw_all_com", "draw_all_cot", "draw_cot", "draw_com", "boost", "scale", "max_size", "overlay", "format", "crew_heatmap"]
+
+# bounds of the numeric render arguments, scale picks a mipmap level and max_size is a side of the image in pixels
+NUMBER_ARGS = {"scale": (MIPMAP_LEVELS[-1] / MIPMAP_LEVELS[0], 1), "max_size": (1, 16384)}
+
+def number_arg(key, value):
+    """
+    A numeric render argument clamped to its NUMBER_ARGS bounds.
+
+    Raises:
+        BadArgument: If the value is not a positive number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value <= 0:
+        raise BadArgument(f"{key} must be a positive number, not {value!r}")
+    low, high = NUMBER_ARGS[key]
+    return min(max(value, low), high)
+
+def read_args(source):
+    """
+    Read the analysis arguments from query parameters or a json object.
+    Query parameters are strings, so "true"/"false" and numbers are converted.
+
+    Raises:
+        BadArgument: If scale or max_size is not a positive number, the request is answered with a 400.
+    """
+    args = {}
+    for key in query_keys:
+        if key not in source:
+            continue
+        value = source[key]
+        if isinstance(value, str):
+            if value.lower() in ("true", "false"):
+                value = value.lower() == "true"
+            else:
+                try:
+                    value = float(value) if "." in value else int(value)
+                except ValueError:
+                    pass
+        if key in NUMBER_ARGS:
+            if value in (None, ""):
+                # left to the default
+                continue
+            value = number_arg(key, value)
+        args[key] = value
+    return args
+
+def is_admin(request, source):
+    """
+    Check the admin token of a request, sent as the X-Admin-Token header or the admin_token parameter.
+    Without an admin_token in the environment nobody is an admin.
+    """
+    admin_token = os.getenv("admin_token")
+    token = request.headers.get("X-Admin-Token") or source.get("admin_token")
+    if not admin_token or not token:
+        return False
+    return hmac.compare_digest(str(token), admin_token)
+
+def run_com(request, source, url, args):
+    """
+    Run com for a request, under a profiler when an admin asks for it with profile=1 or profile=sample.
+    """
+    placeholder = "placeholder" # we do not output a file here
+    profile = source.get("profile")
+    if profile in (None, "", "0", 0, False):
+        # com labels the analyze timing with its args before the stage ends
+        with metrics.stage("analyze"):
+            result = com(url, placeholder, args)
+        return json.loads(result)
+
+    if not is_admin(request, source):
+        return JSONResponse({"error": "profiling needs an admin token"}, status_code=403)
+    with metrics.stage("analyze"):
+        result, report = profiling.profile_call(com, url, placeholder, args, mode=profile)
+    result = json.loads(result)
+    result["profile"] = report
+    return result
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -20,22 +123,14 @@ async def analyze(request: Request):
     query = request.query_params
     # get data from url
     url = query["url"]
-    args = {}
-    query_keys = ["draw", "flip_vectors", "draw_all_com", "draw_all_cot", "draw_cot", "draw_com", "boost"]
+    args = read_args(query)
 
-    for key in query_keys:
-        if key in query:
-            args[key] = query[key]
-
-    placeholder = "placeholder" # we do not output a file here
     # data = unquote_plus(data)
     # print(data)
     if not url:
         return "No data"
     else:
-        result = com(url, placeholder, args)
-        result = json.loads(result)
-        return result
+        return run_com(request, query, url, args)
 
 @app.post('/analyze') # get a url
 async def analyzepost(request: Request):
@@ -45,30 +140,146 @@ async def analyzepost(request: Request):
     json_args = data_json['args']
     json_image = data_json['image']
     
-    args = {}
-    query_keys = ["draw", "flip_vectors", "draw_all_com", "draw_all_cot", "draw_cot", "draw_com", "boost"]
+    args = read_args(json_args)
 
-    for key in query_keys:
-        if key in json_args:
-            args[key] = json_args[key]
-            
     # print(args)
     if not json_image:
         return "No data"
     else:
         url = json_image
-        placeholder = "placeholder"
-        result = com(url, placeholder, args)
-        result = json.loads(result)
-        print(result)
+        result = run_com(request, json_args, url, args)
+        # print(result)
         return result
     
     
 
+@app.get('/metrics')
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get('/profiles/{profile_id}')
+def read_profile(request: Request, profile_id: str):
+    if not is_admin(request, request.query_params):
+        return JSONResponse({"error": "profiles need an admin token"}, status_code=403)
+    path = profiling.find_profile(profile_id)
+    if path is None:
+        return JSONResponse({"error": "unknown profile"}, status_code=404)
+    return FileResponse(path, filename=os.path.basename(path))
+
+@app.get('/ships/search')
+def search_ships(request: Request):
+    """
+    Search the ship library, e.g. /ships/search?max_price=500000&tags=railgun&order=-top_speed
+    tags, any_tags and exclude_tags are comma separated, parts is a comma separated list of ID:minimum count.
+    """
+    query = request.query_params
+    filters = {key: value for key, value in query.items() if key.startswith("min_") or key.startswith("max_")}
+    filters["author"] = query.get("author")
+    for key in ("tags", "any_tags", "exclude_tags"):
+        filters[key] = [tag for tag in query.get(key, "").split(",") if tag]
+    filters["parts"] = {}
+    for item in query.get("parts", "").split(","):
+        if item:
+            part_id, _, count = item.partition(":")
+            filters["parts"][part_id] = count or 1
+    try:
+        ships = ship_library.search(filters, query.get("order", "-top_speed"), query.get("limit", 20), query.get("offset", 0))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"ships": ships}
+
+@app.get('/ships/similar')
+def similar_ships(request: Request):
+    """
+    Near-duplicates of a ship of the library, /ships/similar?hash=..., or of any ship, /ships/similar?url=...
+    """
+    query = request.query_params
+    content_hash = query.get("hash")
+    if content_hash:
+        ship_fingerprint = ship_library.stored_fingerprint(content_hash)
+        if ship_fingerprint is None:
+            return JSONResponse({"error": "unknown ship"}, status_code=404)
+    elif query.get("url"):
+        ship = cosmoteer_save_tools.Ship(query["url"])
+        content_hash = ship_library.ship_hash(ship)
+        ship_fingerprint = fingerprint.fingerprint(ship.data)
+    else:
+        return JSONResponse({"error": "hash or url is needed"}, status_code=400)
+    try:
+        ships = ship_library.similar(ship_fingerprint, query.get("limit", 10),
+                                     float(query.get("min_similarity", ship_library.MIN_SIMILARITY)), exclude=content_hash)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"hash": content_hash, "ships": ships}
+
+@app.get('/diff')
+def diff_get(request: Request):
+    """
+    What changed between two ships, /diff?before=url&after=url[&draw=true&boost=false]
+    """
+    query = request.query_params
+    if not query.get("before") or not query.get("after"):
+        return JSONResponse({"error": "before and after are needed"}, status_code=400)
+    return ship_diff.diff(query["before"], query["after"], read_args(query))
+
+@app.post('/diff')
+async def diff_post(request: Request):
+    """
+    Same as GET /diff with a json body {"before": ..., "after": ..., "args": {...}}, ships can be base64 pngs.
+    """
+    request_json = await request.json()
+    # like POST /analyze, the body may be a json string holding the json object
+    data_json = json.loads(request_json) if isinstance(request_json, str) else request_json
+    if not data_json.get("before") or not data_json.get("after"):
+        return JSONResponse({"error": "before and after are needed"}, status_code=400)
+    return await run_in_threadpool(ship_diff.diff, data_json["before"], data_json["after"], read_args(data_json.get("args", {})))
+
+@app.websocket('/edit')
+async def edit_ship(websocket: WebSocket):
+    """
+    Live editing of a ship, every message is a json edit answered with the updated analysis of the ship.
+        {"op": "load", "url": ..., "args": {"boost": true}}   load a ship, its parts get the keys 0, 1, 2...
+        {"op": "add", "part": {"ID": ..., "Location": [x, y], "Rotation": 0, "FlipX": false}}
+        {"op": "remove", "key": 3} or {"op": "remove", "location": [x, y]}
+        {"op": "move", "key": 3, "location": [x, y], "rotation": 1, "flipx": false}
+    Answers are {"key": key of the part, "summary": ShipModel.summary()} or {"error": ...}.
+    """
+    await websocket.accept()
+    model = None
+    try:
+        while True:
+            message = await websocket.receive_json()
+            op = message.get("op")
+            key = message.get("key")
+            try:
+                if op == "load":
+                    args = read_args(message.get("args", {}))
+                    ship = await run_in_threadpool(cosmoteer_save_tools.Ship, message["url"])
+                    model = ShipModel.from_data(ship.data, boost=args.get("boost", True))
+                elif model is None:
+                    raise ValueError("load a ship first")
+                elif op == "add":
+                    key = model.add_part(message["part"])
+                elif op == "remove":
+                    if key is None:
+                        key = model.part_at(message["location"])
+                    model.remove_part(key)
+                elif op == "move":
+                    model.move_part(key, message["location"], message.get("rotation"), message.get("flipx"))
+                else:
+                    raise ValueError(f"unknown op {op}")
+            except Exception as e:
+                await websocket.send_json({"error": f"{type(e).__name__}: {e}"})
+                continue
+            await websocket.send_json({"key": key, "summary": model.summary()})
+    except WebSocketDisconnect:
+        pass
+
 app.add_middleware(SessionMiddleware, secret_key=os.getenv("secret_session"))
 app.add_middleware(GZipMiddleware, minimum_size=1000)
 
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run(app, host='127.0.0.1', port=8001)
     # uvicorn.run(app)
 
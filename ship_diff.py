@@ -0,0 +1,199 @@
+# difference between two versions of a ship : which parts were added or removed and what it did to the analysis
+# parts are compared as a multiset of (ID, location, rotation, flip), a moved part is one removed and one added part
+# the analysis of the new version is computed from the changed parts only, by applying them to a ShipModel of the
+# old version, see ship_model.py, both versions use the catalog of their rules, see rules_catalog.py
+# usage : diff_ships(Ship(old_url).data, Ship(new_url).data)
+
+import base64
+from collections import Counter
+
+import metrics
+from center_of_mass import remove_weird_parts
+from rules_catalog import catalog_tables, ship_catalog
+from ship_model import ShipModel, part_tiles
+
+DIFF_TILE_SIZE = 8 # pixels per tile of the diff image
+DIFF_MARGIN = 2 # tiles around the ship
+# BGR colors of the diff image
+UNCHANGED_COLOR = (110, 110, 110)
+ADDED_COLOR = (80, 200, 80)
+REMOVED_COLOR = (60, 60, 230)
+BACKGROUND_COLOR = (30, 30, 30)
+
+def part_key(part):
+    """
+    What makes two parts the same part : ID, location, rotation and flip.
+    """
+    return part["ID"], tuple(part["Location"]), part["Rotation"], bool(part.get("FlipX", False))
+
+def diff_parts(parts_before, parts_after):
+    """
+    Multiset difference of two part lists.
+
+    Returns:
+        tuple: The removed parts, the added parts and the number of unchanged parts.
+    """
+    before = Counter(part_key(part) for part in parts_before)
+    after = Counter(part_key(part) for part in parts_after)
+    removed = before - after
+    added = after - before
+    as_parts = lambda keys: [{"ID": key[0], "Location": list(key[1]), "Rotation": key[2], "FlipX": key[3]} for key in keys.elements()]
+    return as_parts(removed), as_parts(added), sum((before & after).values())
+
+def known_parts(data):
+    """
+    Parts of a ship with the classic IDs upgraded, the parts the catalog of its rules does not know are left out.
+    """
+    catalog = ship_catalog(data)
+    part_table, _ = catalog_tables(catalog)
+    parts, _ = remove_weird_parts(data["Parts"], catalog)
+    return [part for part in parts if part["ID"] in part_table]
+
+def summary_delta(before, after):
+    """
+    after - before for every number of two ShipModel summaries, and the tags that came and went.
+    """
+    delta = {}
+    for key, value in after.items():
+        if isinstance(value, bool) or key not in before:
+            continue
+        if isinstance(value, (int, float)):
+            delta[key] = value - before[key]
+        elif isinstance(value, dict) and key != "center_of_thrust":
+            keys = set(value) | set(before[key])
+            delta[key] = {k: value.get(k, 0) - before[key].get(k, 0) for k in sorted(keys)}
+    delta["center_of_mass"] = [after["center_of_mass_x"] - before["center_of_mass_x"], after["center_of_mass_y"] - before["center_of_mass_y"]]
+    delta["tags"] = {
+        "added": [tag for tag in after["tags"] if tag not in before["tags"]],
+        "removed": [tag for tag in before["tags"] if tag not in after["tags"]],
+    }
+    return delta
+
+def diff_ships(data_before, data_after, boost=True):
+    """
+    Compare two versions of a ship.
+
+    Args:
+        data_before (dict): The decoded old version, Ship(...).data.
+        data_after (dict): The decoded new version.
+        boost (bool): Whether the speeds are computed with boost.
+
+    Returns:
+        dict: "removed" and "added" parts, the number of "unchanged" parts, the "before" and "after" summaries
+              (see ShipModel.summary) and their "delta".
+    """
+    # compare the parts the analysis sees, with classic IDs upgraded and unknown parts left out
+    removed, added, unchanged = diff_parts(known_parts(data_before), known_parts(data_after))
+
+    model = ShipModel.from_data(data_before, boost)
+    before = model.summary()
+
+    if ship_catalog(data_after) is not model.catalog:
+        # the new version was built with other rules, the parts of the model have the numbers of the old rules
+        # and the old rules may not know the added parts
+        after = ShipModel.from_data(data_after, boost).summary()
+    else:
+        keys = {}
+        for key, part in model.parts.items():
+            keys.setdefault(part_key(part), []).append(key)
+        for part in removed:
+            model.remove_part(keys[part_key(part)].pop())
+        for part in added:
+            model.add_part(part)
+        model.set_fields(data_after["FlightDirection"], data_after.get("Author"), data_after.get("Doors"),
+                         data_after.get("NewFlexResourceGridTypes"), data_after.get("PartUIToggleStates"))
+        after = model.summary()
+
+    return {
+        "removed": removed,
+        "added": added,
+        "unchanged": unchanged,
+        "before": before,
+        "after": after,
+        "delta": summary_delta(before, after),
+    }
+
+def draw_diff(parts_before, parts_after, removed, added, tile_size=DIFF_TILE_SIZE, catalog_before=None, catalog_after=None):
+    """
+    Draw the new version of a ship as flat tiles, added parts in green and removed parts as red outlines.
+    No sprites are drawn, so it costs a few milliseconds even for big ships.
+
+    Args:
+        catalog_before (dict, optional): The catalog of the rules of the old version, part_data by default.
+        catalog_after (dict, optional): The catalog of the rules of the new version, part_data by default.
+
+    Returns:
+        str: The image as a base64 png.
+    """
+    import cv2
+    import numpy as np
+
+    # the removed parts have the sizes of the old rules, the others the sizes of the new rules
+    table_before, _ = catalog_tables(catalog_before)
+    table_after, _ = catalog_tables(catalog_after)
+    parts_before = [(part, table_before) for part in parts_before if part["ID"] in table_before]
+    parts_after = [(part, table_after) for part in parts_after if part["ID"] in table_after]
+    removed = [(part, table_before) for part in removed if part["ID"] in table_before]
+
+    added_keys = Counter(part_key(part) for part in added)
+    tiles = [tile for part, part_table in parts_before + parts_after for tile in part_tiles(part, part_table)]
+    if not tiles:
+        tiles = [(0, 0)]
+    min_x = min(x for x, _ in tiles) - DIFF_MARGIN
+    min_y = min(y for _, y in tiles) - DIFF_MARGIN
+    width = max(x for x, _ in tiles) - min_x + 1 + DIFF_MARGIN
+    height = max(y for _, y in tiles) - min_y + 1 + DIFF_MARGIN
+    image = np.full((height * tile_size, width * tile_size, 3), BACKGROUND_COLOR, dtype=np.uint8)
+
+    def rectangle(part, part_table):
+        part_tile_list = part_tiles(part, part_table)
+        x0 = (min(x for x, _ in part_tile_list) - min_x) * tile_size
+        y0 = (min(y for _, y in part_tile_list) - min_y) * tile_size
+        x1 = (max(x for x, _ in part_tile_list) - min_x + 1) * tile_size
+        y1 = (max(y for _, y in part_tile_list) - min_y + 1) * tile_size
+        return x0, y0, x1, y1
+
+    for part, part_table in parts_after:
+        x0, y0, x1, y1 = rectangle(part, part_table)
+        key = part_key(part)
+        color = ADDED_COLOR if added_keys[key] > 0 else UNCHANGED_COLOR
+        if added_keys[key] > 0:
+            added_keys[key] -= 1
+        # one pixel gap between parts keeps their outlines readable
+        image[y0 + 1:y1 - 1, x0 + 1:x1 - 1] = color
+
+    border = max(1, tile_size // 4)
+    for part, part_table in removed:
+        x0, y0, x1, y1 = rectangle(part, part_table)
+        for y_slice, x_slice in ((slice(y0, y0 + border), slice(x0, x1)), (slice(y1 - border, y1), slice(x0, x1)),
+                                 (slice(y0, y1), slice(x0, x0 + border)), (slice(y0, y1), slice(x1 - border, x1))):
+            image[y_slice, x_slice] = REMOVED_COLOR
+
+    _, buffer = cv2.imencode(".png", image)
+    return base64.b64encode(buffer).decode("utf-8")
+
+def diff(input_before, input_after, args={}):
+    """
+    Compare two ships given as png files, base64 strings or urls, like com().
+
+    Args:
+        args (dict, optional): "boost" (default True), and "draw" (default False) to upload a diff image.
+
+    Returns:
+        dict: The result of diff_ships, with the url of the diff image in "url_diff" when drawn.
+    """
+    import cosmoteer_save_tools
+    from png_upload import upload_image_to_imgbb
+
+    with metrics.stage("diff_decode"):
+        data_before = cosmoteer_save_tools.Ship(input_before, lean=True).data
+        data_after = cosmoteer_save_tools.Ship(input_after, lean=True).data
+    with metrics.stage("diff"):
+        result = diff_ships(data_before, data_after, args.get("boost", True))
+    if args.get("draw", False):
+        with metrics.stage("draw_diff"):
+            base64_output = draw_diff(known_parts(data_before), known_parts(data_after), result["removed"], result["added"],
+                                      catalog_before=ship_catalog(data_before), catalog_after=ship_catalog(data_after))
+        with metrics.stage("upload"):
+            result["url_diff"] = upload_image_to_imgbb(base64_output)
+    return result
@@ -0,0 +1,356 @@
+# library of analyzed ships, stored in SQLite and keyed by the hash of the compressed ship data
+# the same ship hidden in another picture has the same key, so a known ship is never decoded twice
+# set the environment variable ship_library to the path of the database to turn it on in com(),
+# batch.py --library fills it in bulk and /ships/search queries it
+# every numeric column, the author and the part counts are indexed, tags are matched on the bits of the tag_mask column
+# load_tag_index() loads the tag masks of every ship into a TagIndex for fast tag queries
+# the fingerprint of every ship is stored with its LSH buckets, similar() finds near-duplicates from the buckets
+# and lookup_structure() reuses the analysis of a copy that only differs in cosmetic fields
+# the stored analysis keeps the fields that depend on boost for both boost states, with_boost() picks one
+# it also keeps the version of the rules catalog it was made with, an analysis of an older catalog is not reused
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import fingerprint
+import rules_catalog
+from tagextractor import PNGTagExtractor, TagIndex, tags_mask
+
+LIBRARY_PATH = os.getenv("ship_library", "ships.db")
+enabled = os.getenv("ship_library") is not None
+
+DIRECTIONS = ["NW", "N", "NE", "E", "SE", "S", "SW", "W"]
+# numeric columns that can be filtered with min_<column> / max_<column> and sorted on
+NUMERIC_COLUMNS = ["parts", "total_mass", "top_speed", "crew", "price", "center_of_mass_x", "center_of_mass_y"] + \
+                  [f"speed_{direction}" for direction in DIRECTIONS]
+# key of each boost state in the "boost_variants" of a stored analysis
+BOOST_VARIANTS = {True: "boost", False: "no_boost"}
+SEARCH_LIMIT = 100
+MIN_SIMILARITY = 0.5
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS ships (
+    hash TEXT PRIMARY KEY,
+    name TEXT,
+    author TEXT,
+    flight_direction INTEGER,
+    tag_mask INTEGER,
+    structure_hash TEXT,
+    {", ".join(f"{column} REAL" for column in NUMERIC_COLUMNS)},
+    analysis TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ship_tags (
+    hash TEXT NOT NULL REFERENCES ships(hash) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (tag, hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ship_parts (
+    hash TEXT NOT NULL REFERENCES ships(hash) ON DELETE CASCADE,
+    part_id TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (part_id, count, hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ship_fingerprints (
+    hash TEXT PRIMARY KEY REFERENCES ships(hash) ON DELETE CASCADE,
+    signature BLOB NOT NULL,
+    histogram TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ship_lsh (
+    band INTEGER NOT NULL,
+    bucket TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES ships(hash) ON DELETE CASCADE,
+    PRIMARY KEY (band, bucket, hash)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ships_author ON ships(author);
+CREATE INDEX IF NOT EXISTS ships_structure_hash ON ships(structure_hash);
+{"".join(f"CREATE INDEX IF NOT EXISTS ships_{column} ON ships({column});" for column in NUMERIC_COLUMNS)}
+"""
+
+# one connection per thread, sqlite connections can not be shared between threads
+local = threading.local()
+
+def connect(path=None):
+    """
+    Open the library, creating the tables on first use.
+
+    Args:
+        path (str, optional): The path of the database. Defaults to LIBRARY_PATH.
+
+    Returns:
+        sqlite3.Connection: The connection of the current thread.
+    """
+    path = path or LIBRARY_PATH
+    connections = getattr(local, "connections", None)
+    if connections is None:
+        connections = local.connections = {}
+    if path not in connections:
+        connection = sqlite3.connect(path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        # several workers may write at once
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        connection.executescript(SCHEMA)
+        connections[path] = connection
+    return connections[path]
+
+def ship_hash(ship):
+    """
+    Content hash of a ship, the sha256 of its compressed data.
+    """
+    return hashlib.sha256(ship.compressed_image_data).hexdigest()
+
+def structure_key(ship):
+    """
+    Structure hash of a decoded ship, see fingerprint.structure_hash.
+    """
+    tag_mask, _ = PNGTagExtractor().extract_tag_mask(ship.data)
+    return fingerprint.structure_hash(ship.data, tag_mask, rules_catalog.catalog_version(rules_catalog.ship_catalog(ship.data)))
+
+def with_boost(analysis, boost):
+    """
+    The analysis of a ship for one boost state, from a stored analysis.
+
+    Returns:
+        dict: The analysis as analyze_ship returns it with this boost, or None when the stored analysis does not have
+              this boost state.
+    """
+    variants = analysis.get("boost_variants")
+    fields = {key: value for key, value in analysis.items() if key not in ("boost_variants", "rules")}
+    if variants is None:
+        # stored before both boost states were kept, with boost on
+        return fields if boost else None
+    fields.update(variants[BOOST_VARIANTS[bool(boost)]])
+    return fields
+
+def record(ship, data, structure=None):
+    """
+    Everything the library stores about an analyzed ship.
+
+    Args:
+        ship (Ship): The decoded ship.
+        data (dict): The result of analyze_ship with variants_kept.
+        structure (str, optional): The structure key of the ship, when already computed.
+
+    Returns:
+        dict: The row of the ship, with its tags and part counts, ready for store().
+    """
+    from center_of_mass import remove_weird_parts
+
+    stored = {key: value for key, value in data.items() if key not in ("url_com", "url_crew", "svg")}
+    stored["rules"] = {"id": ship.data.get("ShipRulesID"), "catalog": rules_catalog.catalog_version(rules_catalog.ship_catalog(ship.data))}
+    # the searchable columns hold the numbers with boost on
+    analysis = with_boost(stored, True)
+    row = {
+        "hash": ship_hash(ship),
+        "name": ship.data.get("Name"),
+        "author": analysis.get("author"),
+        "flight_direction": ship.data.get("FlightDirection"),
+        "tag_mask": tags_mask(analysis.get("tags") or []),
+        "structure_hash": structure or structure_key(ship),
+        "parts": len(ship.data["Parts"]),
+        **{column: analysis.get(column) for column in ("total_mass", "top_speed", "crew", "price", "center_of_mass_x", "center_of_mass_y")},
+        **{f"speed_{direction}": speed for direction, speed in analysis["all_direction_speeds"].items()},
+        "analysis": json.dumps(stored),
+    }
+    # part counts and fingerprint of the parts the analysis sees, with the classic IDs upgraded
+    parts, _ = remove_weird_parts(ship.data["Parts"], rules_catalog.ship_catalog(ship.data))
+    ship_fingerprint = fingerprint.fingerprint({**ship.data, "Parts": parts})
+    return {
+        "row": row,
+        "tags": sorted(set(analysis.get("tags") or [])),
+        "part_counts": dict(Counter(part["ID"] for part in parts)),
+        "signature": ship_fingerprint["signature"].tobytes(),
+        "histogram": json.dumps(ship_fingerprint["histogram"]),
+    }
+
+def store(entry, path=None):
+    """
+    Add or replace a ship in the library, entry comes from record().
+    """
+    connection = connect(path)
+    row = {**entry["row"], "added": time.time()}
+    with connection:
+        connection.execute("DELETE FROM ship_tags WHERE hash = ?", (row["hash"],))
+        connection.execute("DELETE FROM ship_parts WHERE hash = ?", (row["hash"],))
+        connection.execute("DELETE FROM ship_fingerprints WHERE hash = ?", (row["hash"],))
+        connection.execute("DELETE FROM ship_lsh WHERE hash = ?", (row["hash"],))
+        connection.execute(f"INSERT OR REPLACE INTO ships ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})", list(row.values()))
+        connection.executemany("INSERT INTO ship_tags (hash, tag) VALUES (?, ?)", [(row["hash"], tag) for tag in entry["tags"]])
+        connection.executemany("INSERT INTO ship_parts (hash, part_id, count) VALUES (?, ?, ?)",
+                               [(row["hash"], part_id, count) for part_id, count in entry["part_counts"].items()])
+        connection.execute("INSERT INTO ship_fingerprints (hash, signature, histogram) VALUES (?, ?, ?)",
+                           (row["hash"], entry["signature"], entry["histogram"]))
+        signature = np.frombuffer(entry["signature"], dtype=np.uint32)
+        connection.executemany("INSERT INTO ship_lsh (band, bucket, hash) VALUES (?, ?, ?)",
+                               [(band, bucket, row["hash"]) for band, bucket in enumerate(fingerprint.lsh_buckets(signature))])
+
+def ingest(ship, data, structure=None, path=None):
+    """
+    Store the analysis of a ship, see record().
+
+    Returns:
+        str: The hash of the ship.
+    """
+    entry = record(ship, data, structure)
+    store(entry, path)
+    return entry["row"]["hash"]
+
+def lookup(content_hash, path=None):
+    """
+    Find the stored analysis of a ship.
+
+    Returns:
+        dict: The stored analysis, see with_boost, or None for an unknown ship and for an analysis made with another
+              version of the catalog of its rules than the current one.
+    """
+    row = connect(path).execute("SELECT analysis FROM ships WHERE hash = ?", (content_hash,)).fetchone()
+    if row is None:
+        return None
+    analysis = json.loads(row["analysis"])
+    rules = analysis.get("rules")
+    # an analysis stored before the rules were recorded may have been made without the catalog of its rules
+    if rules is None or rules["catalog"] != rules_catalog.catalog_version(rules_catalog.find_catalog(rules["id"])):
+        return None
+    return analysis
+
+def lookup_structure(structure, path=None):
+    """
+    Find the stored analysis of a ship with the same structure hash, a copy with other cosmetic fields.
+
+    Returns:
+        dict: The stored analysis, see with_boost, or None when no ship has this structure.
+    """
+    row = connect(path).execute("SELECT analysis FROM ships WHERE structure_hash = ? LIMIT 1", (structure,)).fetchone()
+    return None if row is None else json.loads(row["analysis"])
+
+def search(filters, order="-top_speed", limit=20, offset=0, path=None):
+    """
+    Find ships in the library.
+
+    Args:
+        filters (dict): Any of
+            min_<column> / max_<column> (float): Bounds on a column of NUMERIC_COLUMNS.
+            author (str): The exact author.
+            tags (list): Tags the ship must all have.
+            any_tags (list): Tags the ship must have at least one of.
+            exclude_tags (list): Tags the ship must not have.
+            The tags are matched on the tag_mask column, an unknown tag raises a ValueError.
+            parts (dict): Minimum count per part ID, e.g. {"cosmoteer.railgun_launcher": 2}.
+        order (str): The column to sort on, prefixed with "-" for descending order.
+        limit (int): The number of ships to return, at most SEARCH_LIMIT.
+        offset (int): The number of ships to skip, for paging.
+
+    Returns:
+        list: The matching ships, their analysis with boost on with the hash and name added.
+    """
+    conditions = []
+    parameters = []
+    for key, value in filters.items():
+        if value is None or value == [] or value == {}:
+            continue
+        if key.startswith("min_") or key.startswith("max_"):
+            column = key[4:]
+            if column not in NUMERIC_COLUMNS:
+                raise ValueError(f"unknown column {column}")
+            conditions.append(f"{column} {'>=' if key.startswith('min_') else '<='} ?")
+            parameters.append(float(value))
+        elif key == "author":
+            conditions.append("author = ?")
+            parameters.append(value)
+        elif key == "tags":
+            # tags are bits of the tag_mask column, see tagextractor.tag_bits
+            mask = tags_mask(value)
+            conditions.append("tag_mask & ? = ?")
+            parameters += [mask, mask]
+        elif key == "any_tags":
+            conditions.append("tag_mask & ? != 0")
+            parameters.append(tags_mask(value))
+        elif key == "exclude_tags":
+            conditions.append("tag_mask & ? = 0")
+            parameters.append(tags_mask(value))
+        elif key == "parts":
+            for part_id, count in value.items():
+                conditions.append("hash IN (SELECT hash FROM ship_parts WHERE part_id = ? AND count >= ?)")
+                parameters += [part_id, int(count)]
+        else:
+            raise ValueError(f"unknown filter {key}")
+
+    column = order.lstrip("-")
+    if column not in NUMERIC_COLUMNS:
+        raise ValueError(f"unknown column {column}")
+    query = "SELECT hash, name, analysis FROM ships"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {column} {'DESC' if order.startswith('-') else 'ASC'} LIMIT ? OFFSET ?"
+    parameters += [max(0, min(int(limit), SEARCH_LIMIT)), max(0, int(offset))]
+
+    return [{"hash": row["hash"], "name": row["name"], **with_boost(json.loads(row["analysis"]), True)}
+            for row in connect(path).execute(query, parameters)]
+
+def load_tag_index(path=None):
+    """
+    Load the tag masks of every ship of the library.
+
+    Returns:
+        TagIndex: The index, keyed by ship hash.
+    """
+    rows = connect(path).execute("SELECT hash, tag_mask FROM ships").fetchall()
+    index = TagIndex(capacity=0)
+    index.add_many([row["hash"] for row in rows], [row["tag_mask"] or 0 for row in rows])
+    return index
+
+def similar(ship_fingerprint, limit=10, min_similarity=MIN_SIMILARITY, exclude=None, path=None):
+    """
+    Find the near-duplicates of a ship, the ships sharing at least one LSH bucket with it.
+
+    Args:
+        ship_fingerprint (dict): The fingerprint of the ship, from fingerprint.fingerprint or stored_fingerprint.
+        limit (int): The number of ships to return, at most SEARCH_LIMIT.
+        min_similarity (float): The smallest estimated similarity of the occupancy grids.
+        exclude (str, optional): A hash to leave out, the ship itself.
+
+    Returns:
+        list: The similar ships, most similar first, with their hash, name, author and similarities.
+    """
+    connection = connect(path)
+    buckets = fingerprint.lsh_buckets(ship_fingerprint["signature"])
+    condition = " OR ".join("(band = ? AND bucket = ?)" for _ in buckets)
+    parameters = [value for band, bucket in enumerate(buckets) for value in (band, bucket)]
+    candidates = connection.execute(
+        f"SELECT DISTINCT ships.hash, name, author, signature, histogram FROM ship_lsh "
+        f"JOIN ships ON ships.hash = ship_lsh.hash JOIN ship_fingerprints ON ship_fingerprints.hash = ship_lsh.hash "
+        f"WHERE {condition}", parameters).fetchall()
+
+    ships = []
+    for row in candidates:
+        if row["hash"] == exclude:
+            continue
+        similarity = fingerprint.signature_similarity(ship_fingerprint["signature"], np.frombuffer(row["signature"], dtype=np.uint32))
+        if similarity < min_similarity:
+            continue
+        ships.append({
+            "hash": row["hash"],
+            "name": row["name"],
+            "author": row["author"],
+            "similarity": similarity,
+            "histogram_similarity": fingerprint.histogram_similarity(ship_fingerprint["histogram"], json.loads(row["histogram"])),
+        })
+    ships.sort(key=lambda ship: (-ship["similarity"], -ship["histogram_similarity"]))
+    return ships[:max(0, min(int(limit), SEARCH_LIMIT))]
+
+def stored_fingerprint(content_hash, path=None):
+    """
+    The fingerprint of a ship of the library, None for an unknown ship.
+    """
+    row = connect(path).execute("SELECT signature, histogram FROM ship_fingerprints WHERE hash = ?", (content_hash,)).fetchone()
+    if row is None:
+        return None
+    return {"signature": np.frombuffer(row["signature"], dtype=np.uint32), "histogram": json.loads(row["histogram"])}
@@ -0,0 +1,375 @@
+# incremental ship model for live editing
+# keeps the running sums behind the analysis of com() : mass moments, thrust moments per direction, engine room
+# contacts, resources, price, crew and tag counts, so adding, removing or moving a part only touches that part
+# and the thrusters next to it instead of the whole ship
+# usage :
+#   model = ShipModel.from_data(Ship(url).data)
+#   key = model.add_part({"ID": "cosmoteer.thruster_small", "Location": [3, 4], "Rotation": 0, "FlipX": False})
+#   model.move_part(key, [3, 5])
+#   model.remove_part(key)
+#   model.summary()
+# ships with a catalog of their rules, see rules_catalog.py, use its masses, sizes, thrusters and prices
+# the float sums are running sums, they are recomputed exactly with math.fsum every RESUM_EDITS edits and reset
+# when their last part goes, so a long editing session does not drift from the analysis of com()
+
+import math
+from collections import Counter
+
+from vector2d import Vector2D
+
+import part_data
+from center_of_mass import ENGINE_ROOM_BONUS, part_center_of_mass, part_center_of_thrust, diagonal_center_of_thrust, top_speed, remove_weird_parts
+from pricegen import part_price_catalog, part_resource_catalog, crew_quarters, door_price, storage_price, round_to_k
+from rules_catalog import catalog_tables, ship_catalog
+from tagextractor import PNGTagExtractor, part_tag_bits, mask_tags
+
+DIRECTIONS = ["NW", "N", "NE", "E", "SE", "S", "SW", "W"]
+ENGINE_ROOM = "cosmoteer.engine_room"
+RESUM_EDITS = 256 # edits between two exact recomputations of the float sums
+
+def part_tiles(part, part_table=None):
+    """
+    Tiles covered by a part, part_table gives the sizes of the parts, part_data.parts by default.
+    """
+    size = (part_table or part_data.parts)[part["ID"]]["size"]
+    if part["Rotation"] == 1 or part["Rotation"] == 3:
+        size = (size[1], size[0])
+    x, y = part["Location"]
+    return [(x + i, y + j) for i in range(size[0]) for j in range(size[1])]
+
+def touching_tiles(tiles):
+    """
+    Tiles of a part and the tiles next to it (except diagonals), the tiles parts_touching looks at.
+    """
+    around = set(tiles)
+    for x, y in tiles:
+        around.update(((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)))
+    return around
+
+class ShipModel():
+    """
+    A ship that can be edited part by part, with its analysis updated in O(affected parts).
+
+    Parts are referred to by the key returned by add_part, the parts given to from_data get the keys 0, 1, 2...
+    """
+    def __init__(self, boost=True, flight_direction=1, author=None, doors=None, storage=None, toggles=None, catalog=None):
+        self.boost = boost
+        # the numbers of the parts, from the catalog of the rules of the ship or from part_data and pricegen
+        self.catalog = catalog
+        self.part_table, self.thruster_table = catalog_tables(catalog)
+        self.prices = part_price_catalog() if catalog is None else catalog["prices"]
+        self.parts = {}
+        self.next_key = 0
+        # tile -> keys of the parts covering it
+        self.tiles = {}
+        # tile -> number of engine room tiles on it
+        self.engine_tiles = Counter()
+        # tile -> keys of the thrusters covering it
+        self.thruster_tiles = {}
+
+        self.mass = 0
+        self.mass_x = 0
+        self.mass_y = 0
+        # per direction 0..3 : total thrust and thrust weighted origin
+        self.thrust = [0, 0, 0, 0]
+        self.thrust_x = [0, 0, 0, 0]
+        self.thrust_y = [0, 0, 0, 0]
+        # per direction 0..3 : number of contributions in the sums above, the sums of a direction are reset at 0
+        self.thrusts = [0, 0, 0, 0]
+        # thruster key -> list of (orientation, thrust, x, y) added to the sums above
+        self.contributions = {}
+
+        self.part_price = 0
+        self.crew = 0
+        self.crew_price = 0
+        self.resources = Counter()
+        self.tag_counts = Counter()
+        # edits since the float sums were last recomputed
+        self.edits = 0
+        self.set_fields(flight_direction, author, doors, storage, toggles)
+
+    def set_fields(self, flight_direction, author, doors, storage, toggles):
+        """
+        Set the fields of the ship that are not parts : flight direction, author, doors, storage and UI toggles.
+        """
+        self.flight_direction = flight_direction
+        self.author = author
+        self.fixed_price = door_price(doors) + storage_price(storage)
+        self.missile_mask, _ = PNGTagExtractor().extract_tag_mask({"Author": author, "Parts": [], "PartUIToggleStates": toggles or []})
+
+    @classmethod
+    def from_data(cls, data, boost=True):
+        """
+        Build a model from a decoded ship, Ship(...).data.
+
+        Returns:
+            ShipModel: The model, its summary matches the analysis of com() for the same ship. Unknown parts are left out.
+        """
+        catalog = ship_catalog(data)
+        parts, _ = remove_weird_parts(data["Parts"], catalog)
+        model = cls(boost, data["FlightDirection"], data.get("Author"), data.get("Doors"),
+                    data.get("NewFlexResourceGridTypes"), data.get("PartUIToggleStates"), catalog)
+        parts = [part for part in parts if part["ID"] in model.part_table]
+        # engine rooms first, every thruster then gets its bonus once instead of being updated for each engine room
+        for part in parts:
+            if part["ID"] == ENGINE_ROOM:
+                model.engine_tiles.update(part_tiles(part, model.part_table))
+        for part in parts:
+            model.insert(model.next_key, part, update_thrusters=False)
+            model.next_key += 1
+        model.resum()
+        return model
+
+    def insert(self, key, part, update_thrusters=True):
+        tiles = part_tiles(part, self.part_table)
+        self.parts[key] = part
+        for tile in tiles:
+            self.tiles.setdefault(tile, set()).add(key)
+
+        mass = self.part_table[part["ID"]]["mass"]
+        x, y = part_center_of_mass(part, self.part_table)
+        self.mass += mass
+        self.mass_x += mass * x
+        self.mass_y += mass * y
+
+        self.part_price += self.prices.get(part["ID"], 0)
+        price, crew = crew_quarters.get(part["ID"], (0, 0))
+        self.crew_price += price
+        self.crew += crew
+        self.resources.update(part_resource_catalog().get(part["ID"], {}))
+        self.tag_counts[part["ID"]] += 1
+
+        if part["ID"] in self.thruster_table:
+            for tile in tiles:
+                self.thruster_tiles.setdefault(tile, set()).add(key)
+            self.add_thrust(key)
+        if part["ID"] == ENGINE_ROOM and update_thrusters:
+            self.engine_tiles.update(tiles)
+            self.update_thrusters(tiles)
+
+    def delete(self, key):
+        part = self.parts.pop(key)
+        tiles = part_tiles(part, self.part_table)
+        for tile in tiles:
+            self.tiles[tile].discard(key)
+            if not self.tiles[tile]:
+                del self.tiles[tile]
+
+        mass = self.part_table[part["ID"]]["mass"]
+        x, y = part_center_of_mass(part, self.part_table)
+        self.mass -= mass
+        self.mass_x -= mass * x
+        self.mass_y -= mass * y
+        if not self.parts:
+            # the rounding errors of the running sums would be left, an empty ship has no mass at all
+            self.mass, self.mass_x, self.mass_y = 0, 0, 0
+
+        self.part_price -= self.prices.get(part["ID"], 0)
+        price, crew = crew_quarters.get(part["ID"], (0, 0))
+        self.crew_price -= price
+        self.crew -= crew
+        self.resources.subtract(part_resource_catalog().get(part["ID"], {}))
+        self.tag_counts[part["ID"]] -= 1
+
+        if key in self.contributions:
+            self.remove_thrust(key)
+            for tile in tiles:
+                self.thruster_tiles[tile].discard(key)
+                if not self.thruster_tiles[tile]:
+                    del self.thruster_tiles[tile]
+        if part["ID"] == ENGINE_ROOM:
+            self.engine_tiles.subtract(tiles)
+            self.update_thrusters(tiles)
+        return part
+
+    def add_thrust(self, key):
+        part = self.parts[key]
+        cots = part_center_of_thrust(part, self.boost, self.part_table, self.thruster_table)
+        if cots == 0:
+            self.contributions[key] = []
+            return
+        # the engine room bonus applies once, however many engine rooms touch the thruster
+        touching = any(self.engine_tiles[tile] > 0 for tile in touching_tiles(part_tiles(part, self.part_table)))
+        contributions = []
+        for origin, orientation, thrust in cots:
+            if touching:
+                thrust = thrust * ENGINE_ROOM_BONUS
+            contributions.append((orientation, thrust, origin.x, origin.y))
+            self.thrusts[orientation] += 1
+            self.thrust[orientation] += thrust
+            self.thrust_x[orientation] += origin.x * thrust
+            self.thrust_y[orientation] += origin.y * thrust
+        self.contributions[key] = contributions
+
+    def remove_thrust(self, key):
+        for orientation, thrust, x, y in self.contributions.pop(key):
+            self.thrusts[orientation] -= 1
+            self.thrust[orientation] -= thrust
+            self.thrust_x[orientation] -= x * thrust
+            self.thrust_y[orientation] -= y * thrust
+            if self.thrusts[orientation] == 0:
+                self.thrust[orientation], self.thrust_x[orientation], self.thrust_y[orientation] = 0, 0, 0
+
+    def update_thrusters(self, tiles):
+        # an engine room came or went, the thrusters touching its tiles may win or lose their bonus
+        keys = set()
+        for tile in touching_tiles(tiles):
+            keys.update(self.thruster_tiles.get(tile, ()))
+        for key in keys:
+            self.remove_thrust(key)
+            self.add_thrust(key)
+
+    def resum(self):
+        """
+        Recompute the float sums exactly from the parts and the thrust contributions.
+        """
+        masses = []
+        for part in self.parts.values():
+            mass = self.part_table[part["ID"]]["mass"]
+            x, y = part_center_of_mass(part, self.part_table)
+            masses.append((mass, mass * x, mass * y))
+        self.mass, self.mass_x, self.mass_y = (math.fsum(column) for column in zip(*masses)) if masses else (0, 0, 0)
+
+        for i in range(4):
+            contributions = [(thrust, x * thrust, y * thrust) for contributions in self.contributions.values()
+                             for orientation, thrust, x, y in contributions if orientation == i]
+            self.thrusts[i] = len(contributions)
+            self.thrust[i], self.thrust_x[i], self.thrust_y[i] = (math.fsum(column) for column in zip(*contributions)) if contributions else (0, 0, 0)
+        self.edits = 0
+
+    def edited(self):
+        # called after every edit, the running sums gain a rounding error at each one
+        self.edits += 1
+        if self.edits >= RESUM_EDITS:
+            self.resum()
+
+    def checked_part(self, part_id, location, rotation, flipx):
+        """
+        A part built from edit input, checked before it touches the model.
+
+        Raises:
+            ValueError: If the part ID is unknown, the location is not two integers or the rotation not an integer.
+        """
+        is_int = lambda value: isinstance(value, int) and not isinstance(value, bool)
+        if part_id not in self.part_table:
+            raise ValueError(f"unknown part {part_id}")
+        if not isinstance(location, (list, tuple)) or len(location) != 2 or not all(is_int(x) for x in location):
+            raise ValueError(f"location must be two integers, not {location!r}")
+        if not is_int(rotation):
+            raise ValueError(f"rotation must be an integer, not {rotation!r}")
+        return {"ID": part_id, "Location": list(location), "Rotation": rotation % 4, "FlipX": bool(flipx)}
+
+    def add_part(self, part):
+        """
+        Add a part to the ship.
+
+        Args:
+            part (dict): The part, with "ID", "Location", "Rotation" and "FlipX" like in Ship(...).data["Parts"].
+
+        Returns:
+            int: The key of the part.
+
+        Raises:
+            ValueError: If the part ID is unknown or its location or rotation are not integers.
+        """
+        part = self.checked_part(part.get("ID"), part.get("Location"), part.get("Rotation", 0), part.get("FlipX", False))
+        key = self.next_key
+        self.next_key += 1
+        self.insert(key, part)
+        self.edited()
+        return key
+
+    def remove_part(self, key):
+        """
+        Remove a part from the ship.
+
+        Returns:
+            dict: The removed part.
+
+        Raises:
+            KeyError: If there is no part with this key.
+        """
+        if key not in self.parts:
+            raise KeyError(f"no part {key}")
+        part = self.delete(key)
+        self.edited()
+        return part
+
+    def move_part(self, key, location, rotation=None, flipx=None):
+        """
+        Move, turn or flip a part, it keeps its key.
+
+        Raises:
+            KeyError: If there is no part with this key.
+            ValueError: If the location or the rotation are not integers, the part stays where it was.
+        """
+        if key not in self.parts:
+            raise KeyError(f"no part {key}")
+        old = self.parts[key]
+        part = self.checked_part(old["ID"], location, old["Rotation"] if rotation is None else rotation,
+                                 old.get("FlipX", False) if flipx is None else flipx)
+        self.delete(key)
+        try:
+            self.insert(key, part)
+        except Exception:
+            # the part is checked, so only a bug gets here, the part is put back so the session does not lose it
+            self.parts.pop(key, None)
+            self.insert(key, old)
+            raise
+        finally:
+            self.edited()
+
+    def part_at(self, tile):
+        """
+        Key of a part covering a tile, None for an empty tile.
+        """
+        keys = self.tiles.get(tuple(tile))
+        return min(keys) if keys else None
+
+    def summary(self):
+        """
+        The analysis of the ship in its current state.
+
+        Returns:
+            dict: The fields of the com() analysis, plus the center of thrust and thrust of every direction and the resources.
+        """
+        if self.mass == 0:
+            com_x, com_y = 0, 0
+        else:
+            com_x, com_y = self.mass_x / self.mass, self.mass_y / self.mass
+
+        origin_thrust = []
+        for i in range(4):
+            if self.thrust[i] == 0:
+                origin_thrust.append(Vector2D(0, 0))
+            else:
+                origin_thrust.append(Vector2D(self.thrust_x[i] / self.thrust[i], self.thrust_y[i] / self.thrust[i]))
+        thrust_vector = [
+            origin_thrust[0] + Vector2D(0, -self.thrust[0]),
+            origin_thrust[1] + Vector2D(self.thrust[1], 0),
+            origin_thrust[2] + Vector2D(0, self.thrust[2]),
+            origin_thrust[3] + Vector2D(-self.thrust[3], 0)
+        ]
+        all_origin_thrust, _, all_thrust = diagonal_center_of_thrust(origin_thrust, thrust_vector, list(self.thrust))
+
+        speeds = {direction: top_speed(self.mass, all_thrust[i]) if self.mass else 0 for i, direction in enumerate(DIRECTIONS)}
+        mask = self.missile_mask
+        for part_id, count in self.tag_counts.items():
+            if count > 0:
+                mask |= part_tag_bits.get(part_id, 0)
+
+        return {
+            "center_of_mass_x": com_x,
+            "center_of_mass_y": com_y,
+            "total_mass": self.mass,
+            "top_speed": speeds[DIRECTIONS[self.flight_direction]],
+            "crew": self.crew,
+            "price": round_to_k(self.part_price + self.fixed_price + self.crew_price),
+            "tags": mask_tags(mask),
+            "author": self.author,
+            "all_direction_speeds": speeds,
+            "center_of_thrust": {direction: [all_origin_thrust[i].x, all_origin_thrust[i].y] for i, direction in enumerate(DIRECTIONS)},
+            "all_direction_thrust": dict(zip(DIRECTIONS, all_thrust)),
+            "resources": {resource: count for resource, count in sorted(self.resources.items()) if count > 0},
+            "parts": len(self.parts),
+        }
@@ -0,0 +1,215 @@
+# ship transforms : rewrite ships and save them as new ship pngs
+# every transform takes the decoded data of a ship, Ship(...).data, and returns new data, the input is not modified
+#   mirror          : flip the ship left to right
+#   rotate          : turn the whole ship by quarter turns clockwise, its flight direction turns with it
+#   set_author      : replace the author, "" strips it
+#   upgrade_parts   : replace the classic part IDs, see center_of_mass.legacy_part_ids
+# parts, doors and the UI toggles and storage types keyed by the location of a part move together,
+# fields this module does not know are copied unchanged, the picture of the ship is kept as it is
+# upgrade classic ships before mirroring or rotating them, the old L and R wedges carry their flip in their ID
+# usage : python ship_transforms.py ships/ -o migrated/ --upgrade [--mirror] [--rotate 1] [--author NAME] [--jobs 8]
+
+import argparse
+import io
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import part_data
+from center_of_mass import legacy_part_ids, upgrade_part
+from cosmoteer_save_tools import Ship
+
+# a door with this orientation sits between its cell and the next cell in this direction
+DOOR_NEIGHBOUR = {0: (1, 0), 1: (0, 1)}
+PNG_COMPRESS_LEVEL = 6
+
+def footprint(part):
+    """
+    Size of a part on the tile grid after rotation, classic parts have the size of the part they are upgraded to.
+    """
+    part_id = legacy_part_ids.get(part["ID"], (part["ID"],))[0]
+    size = part_data.parts[part_id]["size"] if part_id in part_data.parts else (1, 1)
+    if part["Rotation"] == 1 or part["Rotation"] == 3:
+        return size[1], size[0]
+    return size
+
+def move_tiles(data, tile, rotation, flip, flight_direction):
+    """
+    Apply a rigid transform of the tile grid to a ship.
+
+    Args:
+        data (dict): The decoded ship.
+        tile (callable): Maps a tile (x, y) to its new tile.
+        rotation (callable): Maps the rotation of a part to its new rotation.
+        flip (bool): Whether the transform is a mirror, which flips every part.
+        flight_direction (callable): Maps the flight direction to the new one.
+
+    Returns:
+        dict: The transformed ship.
+    """
+    def box(x, y, width, height):
+        # new top left tile of the tiles x..x + width - 1, y..y + height - 1
+        corners = [tile(x, y), tile(x + width - 1, y + height - 1)]
+        return [min(corner[0] for corner in corners), min(corner[1] for corner in corners)]
+
+    data = dict(data)
+    parts = []
+    moved = {}
+    for part in data["Parts"]:
+        width, height = footprint(part)
+        location = box(*part["Location"], width, height)
+        moved[tuple(part["Location"])] = location
+        part = {**part, "Location": location, "Rotation": rotation(part["Rotation"])}
+        if flip:
+            part["FlipX"] = not part.get("FlipX", False)
+        parts.append(part)
+    data["Parts"] = parts
+
+    doors = []
+    for door in data.get("Doors") or []:
+        door = dict(door)
+        if "Cell" in door and door.get("Orientation") in DOOR_NEIGHBOUR:
+            step_x, step_y = DOOR_NEIGHBOUR[door["Orientation"]]
+            x, y = door["Cell"]
+            (x1, y1), (x2, y2) = tile(x, y), tile(x + step_x, y + step_y)
+            door["Cell"] = [min(x1, x2), min(y1, y2)]
+            door["Orientation"] = 0 if y1 == y2 else 1
+        doors.append(door)
+    if "Doors" in data:
+        data["Doors"] = doors
+
+    # UI toggles and storage types refer to their part by its location
+    def move_key(item):
+        if not isinstance(item, dict) or not isinstance(item.get("Key"), list) or not item["Key"]:
+            return item
+        key = item["Key"]
+        if isinstance(key[0], list) and tuple(key[0]) in moved:
+            return {**item, "Key": [moved[tuple(key[0])], *key[1:]]}
+        if len(key) == 2 and all(isinstance(x, int) for x in key) and tuple(key) in moved:
+            return {**item, "Key": moved[tuple(key)]}
+        return item
+
+    for field in ("PartUIToggleStates", "NewFlexResourceGridTypes"):
+        if isinstance(data.get(field), list):
+            data[field] = [move_key(item) for item in data[field]]
+
+    if isinstance(data.get("FlightDirection"), int):
+        data["FlightDirection"] = flight_direction(data["FlightDirection"])
+    return data
+
+def mirror(data):
+    """
+    Flip a ship left to right, around the x = 0 column.
+    """
+    # flight directions go clockwise from 0 = NW, mirroring swaps NW and NE, E and W, SE and SW
+    return move_tiles(data, lambda x, y: (-x, y), lambda rotation: -rotation % 4, True, lambda direction: (2 - direction) % 8)
+
+def rotate(data, turns=1):
+    """
+    Turn a ship by quarter turns clockwise around the tile 0, 0, the flight direction turns with the ship.
+    """
+    for _ in range(turns % 4):
+        data = move_tiles(data, lambda x, y: (-y, x), lambda rotation: (rotation + 1) % 4, False, lambda direction: (direction + 2) % 8)
+    return dict(data)
+
+def set_author(data, author=""):
+    """
+    Replace the author of a ship, the default strips it.
+    """
+    return {**data, "Author": author}
+
+def upgrade_parts(data):
+    """
+    Replace the classic part IDs of a ship with their new IDs, unknown parts are kept as they are.
+    """
+    return {**data, "Parts": [upgrade_part(part) for part in data["Parts"]]}
+
+def ship_png(data, image=None, compress_level=PNG_COMPRESS_LEVEL):
+    """
+    Write a ship into a png.
+
+    Args:
+        data (dict): The decoded ship.
+        image (PIL.Image.Image, optional): The picture to hide the ship in, scaled up when it is too small for it.
+        compress_level (int): zlib level of the png.
+
+    Returns:
+        bytes: The png file.
+    """
+    try:
+        written = Ship.from_data(data, image).write()
+    except ValueError:
+        # the new ship does not fit in the picture, a gray square of the right size gives the smallest picture that fits
+        needed = Ship.from_data(data).image.size[0] ** 2
+        scale = math.ceil(math.sqrt(needed / (image.size[0] * image.size[1])))
+        image = image.resize((image.size[0] * scale, image.size[1] * scale), Image.NEAREST)
+        written = Ship.from_data(data, image).write()
+    buffer = io.BytesIO()
+    written.save(buffer, "PNG", compress_level=compress_level)
+    return buffer.getvalue()
+
+def transform(data, options):
+    """
+    Apply the transforms picked on the command line, classic parts are upgraded first so they have a known size.
+    """
+    if options.upgrade:
+        data = upgrade_parts(data)
+    if options.mirror:
+        data = mirror(data)
+    if options.rotate:
+        data = rotate(data, options.rotate)
+    if options.author is not None:
+        data = set_author(data, options.author)
+    return data
+
+def transform_file(source, destination, options):
+    """
+    Transform one ship png into another, runs in a worker process.
+
+    Returns:
+        str: None, or the error that stopped the ship.
+    """
+    try:
+        ship = Ship(source)
+        png = ship_png(transform(ship.data, options), ship.image, options.compress_level)
+        with open(destination, "wb") as f:
+            f.write(png)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+def main(argv=None):
+    from batch import expand_inputs
+
+    parser = argparse.ArgumentParser(prog="cosmo-transform", description="transform many ships in parallel")
+    parser.add_argument("inputs", nargs="+", help="directories, globs, png files or .txt lists of them")
+    parser.add_argument("-o", "--output", required=True, help="directory of the new pngs, files keep their name")
+    parser.add_argument("--upgrade", action="store_true", help="replace the classic part IDs")
+    parser.add_argument("--mirror", action="store_true", help="flip the ships left to right")
+    parser.add_argument("--rotate", type=int, default=0, help="quarter turns clockwise")
+    parser.add_argument("--author", help="new author, an empty string strips it")
+    parser.add_argument("--compress-level", type=int, default=PNG_COMPRESS_LEVEL, help="zlib level of the pngs, 1 is fastest")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="processes")
+    options = parser.parse_args(argv)
+
+    sources = [source for source in expand_inputs(options.inputs) if not source.startswith(("http://", "https://"))]
+    os.makedirs(options.output, exist_ok=True)
+    destinations = [os.path.join(options.output, os.path.basename(source)) for source in sources]
+
+    start = time.perf_counter()
+    errors = 0
+    with ProcessPoolExecutor(max(1, options.jobs)) as pool:
+        chunksize = max(1, len(sources) // (max(1, options.jobs) * 8))
+        for source, error in zip(sources, pool.map(transform_file, sources, destinations, [options] * len(sources), chunksize=chunksize)):
+            if error is not None:
+                errors += 1
+                print(f"{source}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print(f"transformed {len(sources)} ships in {elapsed:.1f}s, {errors} errors", file=sys.stderr)
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,127 @@
+# sprite atlas : every prepared sprite variant in one memory-mapped file
+# build it once at deploy time with : python sprite_atlas.py
+# every worker process maps the same file read-only, so the sprites are shared
+# through the OS page cache instead of being decoded and resized in each worker
+
+import json
+import os
+import numpy as np
+
+ATLAS_PATH = os.getenv("sprite_atlas", "sprites.atlas")
+MAGIC = b"COSMOATLAS1\n"
+ALIGNMENT = 64 # every sprite starts on a cache line
+
+# None until the first lookup, then {variant key: read-only sprite}, empty if there is no atlas
+atlas = None
+
+def variant_key(part_id, size_factor, rotation, flipx):
+    """
+    Name of a sprite variant in the atlas index.
+    """
+    return f"{part_id}/{size_factor}/{rotation}/{int(bool(flipx))}"
+
+def align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def build_atlas(path=ATLAS_PATH):
+    """
+    Write every sprite at every mipmap level, rotation and flip into one atlas file.
+
+    Args:
+        path (str): The filename of the atlas.
+
+    Returns:
+        int: The size of the atlas in bytes.
+    """
+    # imported here so reading the atlas never needs the drawing code
+    import center_of_mass
+    import part_data
+
+    # prepare the variants from the sprites folder, never from an older atlas
+    global atlas
+    atlas = {}
+    center_of_mass.sprite_mipmaps.clear()
+
+    index = {}
+    variants = []
+    offset = 0
+    for part_id in part_data.parts:
+        sprite_path = center_of_mass.SPRITE_DIRECTORY + part_id.replace("cosmoteer.", "") + ".png"
+        if not os.path.exists(sprite_path):
+            continue
+        for size_factor, sprite in center_of_mass.load_sprite_mipmaps(part_id).items():
+            for rotation in range(4):
+                for flipx in (False, True):
+                    variant = np.ascontiguousarray(center_of_mass.rotate_image(sprite, rotation, flipx))
+                    index[variant_key(part_id, size_factor, rotation, flipx)] = [offset, *variant.shape]
+                    variants.append((offset, variant))
+                    offset = align(offset + variant.nbytes)
+
+    header = json.dumps(index).encode("utf-8")
+    data_start = align(len(MAGIC) + 4 + len(header))
+
+    # write to a temporary file first so running workers never map a half written atlas
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        for variant_offset, variant in variants:
+            f.seek(data_start + variant_offset)
+            f.write(variant.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(path + ".tmp", path)
+
+    return data_start + offset
+
+def load_atlas(path=ATLAS_PATH):
+    """
+    Map the atlas file read-only, the sprites are views into the mapping and cost no copy.
+
+    Args:
+        path (str): The filename of the atlas.
+
+    Returns:
+        dict: A dictionary mapping variant keys to sprites, empty if the atlas does not exist.
+    """
+    global atlas
+    if atlas is not None:
+        return atlas
+
+    if not os.path.exists(path):
+        atlas = {}
+        return atlas
+
+    mapping = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(mapping[:len(MAGIC)]) != MAGIC:
+        print(f"Warning: {path} is not a sprite atlas, sprites are loaded from the sprites folder")
+        atlas = {}
+        return atlas
+
+    header_length = int.from_bytes(bytes(mapping[len(MAGIC):len(MAGIC) + 4]), "little")
+    header_start = len(MAGIC) + 4
+    index = json.loads(bytes(mapping[header_start:header_start + header_length]).decode("utf-8"))
+    data_start = align(header_start + header_length)
+
+    sprites = {}
+    for key, (offset, *shape) in index.items():
+        start = data_start + offset
+        sprites[key] = mapping[start:start + int(np.prod(shape))].reshape(shape)
+
+    atlas = sprites
+    return atlas
+
+def get_variant(part_id, size_factor, rotation, flipx):
+    """
+    Look up a prepared sprite variant.
+
+    Returns:
+        numpy.ndarray: The read-only sprite, or None if it is not in the atlas.
+    """
+    return load_atlas().get(variant_key(part_id, size_factor, rotation, flipx))
+
+if(__name__ == "__main__"):
+    # run the build in the imported module, its atlas is the one center_of_mass reads the sprites from,
+    # the atlas of this __main__ module is never looked at
+    import sprite_atlas
+    size = sprite_atlas.build_atlas()
+    print(f"wrote {ATLAS_PATH} ({size / 1e6:.1f} MB)")
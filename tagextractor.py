@@ -1,84 +1,194 @@
 # tag extractor : takes a base64 png and returns tags as a list
+# every tag is also a bit of a 64 bit mask, so tags can be stored as one integer per ship
+# TagIndex keeps the masks of many ships in a numpy array and answers AND/OR/NOT tag queries with vectorized bitwise operations
 
 # from cosmoteer_save_tools import decode_ship_data
 # import json
 
+import numpy as np
+
+# tags given by the parts of a ship
+part_tags = {
+    'cosmoteer.cannon_med': 'cannon',
+    'cosmoteer.cannon_deck': 'deck_cannon',
+    'cosmoteer.flak_cannon_large': 'flak_battery',
+    'cosmoteer.cannon_large': 'large_cannon',
+    'cosmoteer.railgun_launcher': 'railgun',
+    'cosmoteer.factory_emp': 'factories',
+    'cosmoteer.factory_he': 'factories',
+    'cosmoteer.factory_mine': 'factories',
+    'cosmoteer.factory_nuke': 'factories',
+    'cosmoteer.disruptor': 'disruptors',
+    'cosmoteer.laser_blaster_large': 'heavy_laser',
+    'cosmoteer.ion_beam_emitter': 'ion_beam',
+    'cosmoteer.ion_beam_prism': 'ion_prism',
+    'cosmoteer.laser_blaster_small': 'laser',
+    'cosmoteer.mining_laser_small': 'mining_laser',
+    'cosmoteer.point_defense': 'point_defense',
+    'cosmoteer.thruster_boost': 'boost_thruster',
+    'cosmoteer.airlock': 'airlock',
+    'cosmoteer.factory_coil': 'campaign_factories',
+    'cosmoteer.factory_coil2': 'campaign_factories',
+    'cosmoteer.factory_diamond': 'campaign_factories',
+    'cosmoteer.factory_processor': 'campaign_factories',
+    'cosmoteer.factory_steel': 'campaign_factories',
+    'cosmoteer.factory_tristeel': 'campaign_factories',
+    'cosmoteer.factory_uranium': 'campaign_factories',
+    'cosmoteer.explosive_charge': 'explosive_charges',
+    'cosmoteer.fire_extinguisher': 'fire_extinguisher',
+    'cosmoteer.reactor_large': 'large_reactor',
+    'cosmoteer.shield_gen_large': 'large_shield',
+    'cosmoteer.reactor_med': 'medium_reactor',
+    'cosmoteer.sensor_array': 'sensor',
+    'cosmoteer.hyperdrive_small': 'small_hyperdrive',
+    'cosmoteer.reactor_small': 'small_reactor',
+    'cosmoteer.shield_gen_small': 'small_shield',
+    'cosmoteer.tractor_beam_emitter': 'tractor_beams',
+    'cosmoteer.hyperdrive_beacon': 'hyperdrive_relay'
+}
+
+# tags given by the missile type chosen in a launcher, the value of its missile_type toggle
+missile_tags = {
+    0: 'he_missiles',
+    1: 'emp_missiles',
+    2: 'nukes',
+    3: 'mines'
+}
+
+# every tag in a fixed order, the bit of a tag is its position in this list
+TAGS = list(dict.fromkeys([*part_tags.values(), *missile_tags.values()]))
+assert len(TAGS) <= 64, "tag masks are 64 bit integers"
+tag_bits = {tag: 1 << i for i, tag in enumerate(TAGS)}
+# part ID / missile type -> bit of its tag, precomputed once
+part_tag_bits = {part_id: tag_bits[tag] for part_id, tag in part_tags.items()}
+missile_tag_bits = {missile_type: tag_bits[tag] for missile_type, tag in missile_tags.items()}
+
+def tags_mask(tags):
+    """
+    Mask of a list of tag names.
+
+    Raises:
+        ValueError: If a tag does not exist.
+    """
+    mask = 0
+    for tag in tags:
+        if tag not in tag_bits:
+            raise ValueError(f"unknown tag {tag}")
+        mask |= tag_bits[tag]
+    return mask
+
+def mask_tags(mask):
+    """
+    Tag names of a mask, in the order of TAGS.
+    """
+    return [tag for tag in TAGS if mask & tag_bits[tag]]
+
 class PNGTagExtractor:
     def __init__(self):
-        self.mapping = {
-            'cosmoteer.cannon_med': 'cannon',
-            'cosmoteer.cannon_deck': 'deck_cannon',
-            'cosmoteer.flak_cannon_large': 'flak_battery',
-            'cosmoteer.cannon_large': 'large_cannon',
-            'cosmoteer.railgun_launcher': 'railgun',
-            'cosmoteer.factory_emp': 'factories',
-            'cosmoteer.factory_he': 'factories',
-            'cosmoteer.factory_mine': 'factories',
-            'cosmoteer.factory_nuke': 'factories',
-            'cosmoteer.disruptor': 'disruptors',
-            'cosmoteer.laser_blaster_large': 'heavy_laser',
-            'cosmoteer.ion_beam_emitter': 'ion_beam',
-            'cosmoteer.ion_beam_prism': 'ion_prism',
-            'cosmoteer.laser_blaster_small': 'laser',
-            'cosmoteer.mining_laser_small': 'mining_laser',
-            'cosmoteer.point_defense': 'point_defense',
-            'cosmoteer.thruster_boost': 'boost_thruster',
-            'cosmoteer.airlock': 'airlock',
-            'cosmoteer.factory_coil': 'campaign_factories',
-            'cosmoteer.factory_coil2': 'campaign_factories',
-            'cosmoteer.factory_diamond': 'campaign_factories',
-            'cosmoteer.factory_processor': 'campaign_factories',
-            'cosmoteer.factory_steel': 'campaign_factories',
-            'cosmoteer.factory_tristeel': 'campaign_factories',
-            'cosmoteer.factory_uranium': 'campaign_factories',
-            'cosmoteer.explosive_charge': 'explosive_charges',
-            'cosmoteer.fire_extinguisher': 'fire_extinguisher',
-            'cosmoteer.reactor_large': 'large_reactor',
-            'cosmoteer.shield_gen_large': 'large_shield',
-            'cosmoteer.reactor_med': 'medium_reactor',
-            'cosmoteer.sensor_array': 'sensor',
-            'cosmoteer.hyperdrive_small': 'small_hyperdrive',
-            'cosmoteer.reactor_small': 'small_reactor',
-            'cosmoteer.shield_gen_small': 'small_shield',
-            'cosmoteer.tractor_beam_emitter': 'tractor_beams',
-            'cosmoteer.hyperdrive_beacon': 'hyperdrive_relay'
-        }
-        
-        self.missile_mapping = {
-            0: 'he_missiles',
-            1: 'emp_missiles',
-            2: 'nukes',
-            3: 'mines'
-        }
-        
-    def extract_tags(self, data_json): ## take json
-        # json_data = decode_ship_data(png_file)
-        # data = json.loads(json_data)
+        # the tables are module level, building an extractor costs nothing
+        self.mapping = part_tags
+        self.missile_mapping = missile_tags
+
+    def extract_tag_mask(self, data_json):
+        """
+        Tags of a ship as a mask, see tag_bits.
+
+        Returns:
+            tuple: The mask and the author of the ship.
+        """
         data = data_json
         author = data["Author"]
         parts = data["Parts"]
         toggle = data["PartUIToggleStates"]
-        
-        missile_types = []
+
+        mask = 0
+        for part_id in {item['ID'] for item in parts}:
+            mask |= part_tag_bits.get(part_id, 0)
+
         for item in toggle:
             try:
                 if '__bytes__' in item['Key'][1] and item['Key'][1]['__bytes__'] == '\x0cmissile_type':
-                    missile_types.append(item['Value'])
+                    mask |= missile_tag_bits.get(item['Value'], 0)
             except:
                 continue
 
-        ids = [item['ID'] for item in parts]
-        
-        mapped_output = set()
-        
-        for item in ids:
-            if item in self.mapping:
-                mapped_output.add(self.mapping[item])
-        
-        for item in missile_types:
-            if item in self.missile_mapping:
-                mapped_output.add(self.missile_mapping[item])
-        
-        mapped_output = list(mapped_output)
-        
-        return mapped_output, author
\ No newline at end of file
+        return mask, author
+
+    def extract_tags(self, data_json): ## take json
+        # json_data = decode_ship_data(png_file)
+        # data = json.loads(json_data)
+        mask, author = self.extract_tag_mask(data_json)
+        return mask_tags(mask), author
+
+class TagIndex():
+    """
+    Tag masks of a collection of ships, queried with vectorized bitwise operations.
+
+    usage :
+        index = TagIndex()
+        index.add("ship hash", mask)
+        index.query(all_tags=["railgun"], any_tags=["laser", "heavy_laser"], no_tags=["nukes"])
+    """
+    def __init__(self, capacity=1024):
+        self.keys = []
+        self.array = np.zeros(capacity, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def masks(self):
+        return self.array[:len(self.keys)]
+
+    def reserve(self, count):
+        """
+        Make room for count ships, the array at least doubles so adding ships one by one stays amortized O(1).
+        """
+        if count > len(self.array):
+            array = np.zeros(max(count, 2 * len(self.array)), dtype=np.uint64)
+            array[:len(self.keys)] = self.masks
+            self.array = array
+
+    def add(self, key, mask):
+        self.reserve(len(self.keys) + 1)
+        self.array[len(self.keys)] = mask
+        self.keys.append(key)
+
+    def add_many(self, keys, masks):
+        keys = list(keys)
+        masks = np.asarray(masks, dtype=np.uint64)
+        self.reserve(len(self.keys) + len(keys))
+        self.array[len(self.keys):len(self.keys) + len(keys)] = masks
+        self.keys.extend(keys)
+
+    def select(self, all_tags=(), any_tags=(), no_tags=()):
+        """
+        Find the ships matching a tag query.
+
+        Args:
+            all_tags (list): Tags a ship must all have (AND).
+            any_tags (list): Tags a ship must have at least one of (OR), ignored when empty.
+            no_tags (list): Tags a ship must not have (NOT).
+
+        Returns:
+            np.ndarray: A boolean array, True for the matching ships, in the order they were added.
+        """
+        masks = self.masks
+        selected = np.ones(len(masks), dtype=bool)
+        if all_tags:
+            required = np.uint64(tags_mask(all_tags))
+            selected &= (masks & required) == required
+        if any_tags:
+            selected &= (masks & np.uint64(tags_mask(any_tags))) != 0
+        if no_tags:
+            selected &= (masks & np.uint64(tags_mask(no_tags))) == 0
+        return selected
+
+    def query(self, all_tags=(), any_tags=(), no_tags=()):
+        """
+        Same as select, returns the keys of the matching ships.
+        """
+        return [self.keys[i] for i in np.flatnonzero(self.select(all_tags, any_tags, no_tags))]
+
+    def count(self, all_tags=(), any_tags=(), no_tags=()):
+        return int(np.count_nonzero(self.select(all_tags, any_tags, no_tags)))